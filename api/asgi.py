@@ -0,0 +1,103 @@
+"""ASGI entry point, serving /chat with the async pipeline.
+
+Each open /chat stream is a task in the event loop rather than an OS thread, so a single process
+can hold thousands of them. All the other routes are served by the Flask app in `main`, mounted
+as a WSGI app. Run with e.g.
+
+    uvicorn asgi:app --port 3001
+"""
+import json
+from typing import Callable
+
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+from starlette.types import Receive, Scope, Send
+
+from main import (
+    SSE_CLOSE,
+    app as flask_app,
+    flush_window,
+    format_event,
+    parse_chat_request,
+    saturated_error,
+    sse_event,
+    unknown_prompts_error,
+)
+from stampy_chat.callbacks import astream_callback
+from stampy_chat.chat import arun_query
+from stampy_chat.metrics import STREAMS_IN_FLIGHT
+from stampy_chat.prompt_registry import UnknownPrompts
+from stampy_chat.settings import make_settings
+from stampy_chat.workers import Saturated, async_chat_limit
+
+
+async def astream(src):
+    with STREAMS_IN_FLIGHT.track(server="asgi"):
+        async for message in src:
+            yield sse_event(message)
+        yield SSE_CLOSE
+
+
+class ChatStream(StreamingResponse):
+    """A streamed answer, which gives back its admission slot however the response ends.
+
+    The slot can't be given back by the stream itself, as it never starts if the client goes away first.
+    """
+
+    def __init__(self, content, release: Callable[[], None], **kwargs):
+        super().__init__(content, **kwargs)
+        self.release = release
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.release()
+
+
+def saturated(e: Saturated) -> Response:
+    return JSONResponse(saturated_error(async_chat_limit.stats()), 503, headers={"Retry-After": str(e.retry_after)})
+
+
+async def chat(request: Request) -> Response:
+    body = await request.json()
+    as_stream = body.get("stream", True)
+    try:
+        params = parse_chat_request(body)
+    except UnknownPrompts as e:
+        return JSONResponse(unknown_prompts_error(e), 409)
+    settings = params.pop("settings")
+
+    async def run(callback):
+        return await arun_query(settings=make_settings(**settings), callback=callback, **params)
+
+    try:
+        release = async_chat_limit.acquire()
+    except Saturated as e:
+        return saturated(e)
+
+    if not as_stream:
+        try:
+            return Response(json.dumps((await run(None))["response"]), media_type="application/json")
+        finally:
+            release()
+
+    return ChatStream(
+        astream(astream_callback(run, format_event, flush_window(body))), release, media_type="text/event-stream"
+    )
+
+
+cors = Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["POST"], allow_headers=["Content-Type"])
+
+app = Starlette(
+    routes=[
+        # OPTIONS is needed for CORS preflight requests, which the middleware answers
+        Route("/chat", chat, methods=["POST", "OPTIONS"], middleware=[cors]),
+        Mount("/", WSGIMiddleware(flask_app)),
+    ],
+)
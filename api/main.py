@@ -1,20 +1,30 @@
-import requests
 import json
-import re
+import hmac
+import threading
 import logging
+from functools import wraps
 
 from flask import Flask, jsonify, request, Response, stream_with_context
 from flask_cors import CORS, cross_origin
 
-from stampy_chat import logging
-from stampy_chat.env import FLASK_PORT, SENTRY_API_DSN
-from stampy_chat.settings import Settings
+from stampy_chat import logging, metrics
+from stampy_chat.env import ADMIN_TOKEN, FLASK_PORT, HUMAN_PREFETCH_MAX, SENTRY_API_DSN, STREAM_FLUSH_WINDOW_MS
+from stampy_chat.cache import caches_stats, clear_caches
+from stampy_chat.embedding_cache import embedding_cache
+from stampy_chat.settings import make_settings
 from stampy_chat.chat import run_query
 from stampy_chat.callbacks import stream_callback
 from stampy_chat.citations import get_top_k_blocks
+from stampy_chat.followup_index import followup_index
+from stampy_chat.followups import followup_search
+from stampy_chat.metrics import STREAMS_IN_FLIGHT
+from stampy_chat.human_content import human_content
+from stampy_chat import routing
 from stampy_chat.prompts import inline_all_templates
-from stampy_chat.db.session import make_session
+from stampy_chat.prompt_registry import PromptsTooLarge, UnknownPrompts, registry, resolve_prompts
+from stampy_chat.db.session import item_adder, make_session
 from stampy_chat.db.models import Rating
+from stampy_chat.workers import Saturated, async_chat_limit, chat_pool
 from stampy_chat.citations import Message
 
 
@@ -38,14 +48,47 @@ app = Flask(__name__)
 cors = CORS(app)
 app.config["CORS_HEADERS"] = "Content-Type"
 
+
+def saturated_error(stats: dict) -> dict:
+    return {"error": "the server is busy, please try again later", "queue": stats}
+
+
+@app.errorhandler(Saturated)
+def saturated(e: Saturated):
+    response = jsonify(saturated_error(chat_pool.stats()))
+    response.status_code = 503
+    response.headers["Retry-After"] = str(e.retry_after)
+    return response
+
 # ---------------------------------- sse stuff ---------------------------------
 
 
+SSE_CLOSE = "event: close\n\n"
+
+
+def sse_event(message: str) -> str:
+    return "data: " + "\ndata: ".join(message.splitlines()) + "\n\n"
+
+
 def stream(src):
-    yield from (
-        "data: " + "\ndata: ".join(message.splitlines()) + "\n\n" for message in src
-    )
-    yield "event: close\n\n"
+    with STREAMS_IN_FLIGHT.track(server="wsgi"):
+        yield from (sse_event(message) for message in src)
+        yield SSE_CLOSE
+
+
+def flush_window(body: dict) -> float:
+    """How many seconds to batch up streamed tokens for, from the optional `flushWindowMs` of the request."""
+    try:
+        window = float(body.get("flushWindowMs", STREAM_FLUSH_WINDOW_MS))
+    except (TypeError, ValueError):
+        window = STREAM_FLUSH_WINDOW_MS
+    return max(0.0, min(window, 1000.0)) / 1000
+
+
+def format_event(item) -> str:
+    if isinstance(item, Exception):
+        item = {"state": "error", "error": str(item)}
+    return json.dumps(item)
 
 
 # ------------------------------- semantic search ------------------------------
@@ -74,37 +117,83 @@ def clean_history(history: list[Message]) -> list[Message]:
     return messages
 
 
-@app.route("/chat", methods=["POST"])
+def unknown_prompts_error(e: UnknownPrompts) -> dict:
+    return {"error": "unknown prompts, please upload them again", "promptsHash": e.prompts_hash}
+
+
+def unknown_prompts(e: UnknownPrompts):
+    return jsonify(unknown_prompts_error(e)), 409
+
+
+@app.route("/prompts", methods=["POST"])
 @cross_origin()
-def chat():
-    query = request.json.get("query", None)
-    session_id = request.json.get("sessionId")
-    history = request.json.get("history", [])
-    settings = request.json.get("settings", {})
-    followups = request.json.get("followups", True)
-    as_stream = request.json.get("stream", True)
+def register_prompts():
+    """Upload a prompt set, so that later requests can refer to it by `settings.promptsHash`.
+
+    Uploaded prompts can be evicted at any time, and each worker has its own copy, so clients must upload
+    them again whenever a request that refers to them gets a 409.
+    """
+    prompts = request.json.get("prompts")
+    if not isinstance(prompts, dict):
+        return Response('{"error": "missing prompts"}', 400, mimetype="application/json")
+    try:
+        return jsonify({"promptsHash": registry.register(prompts)})
+    except PromptsTooLarge as e:
+        return jsonify({"error": str(e), "maxBytes": e.max_bytes}), 413
+
+
+@app.route("/prompts/<prompts_hash>", methods=["GET"])
+@cross_origin()
+def check_prompts(prompts_hash):
+    if prompts_hash not in registry:
+        return unknown_prompts(UnknownPrompts(prompts_hash))
+    return jsonify({"promptsHash": prompts_hash})
+
+
+def parse_chat_request(body: dict) -> dict:
+    """Extract the `run_query` arguments from a /chat request body. The settings are left as a dict.
+
+    :raises UnknownPrompts: if the settings refer to prompts that haven't been uploaded to this worker
+    """
+    query = body.get("query", None)
+    # Clients can leave out the history, in which case the stored one is used
+    history = body.get("history", None if query is not None else [])
+    settings = resolve_prompts(body.get("settings", {}))
 
     if query is None and history:
         query = history[-1].get("content")
         history = history[:-1]
 
-    history = clean_history(history)
+    return {
+        "session_id": body.get("sessionId"),
+        "session_token": body.get("sessionToken"),
+        "query": query,
+        "history": clean_history(history) if history is not None else None,
+        "settings": settings,
+        "followups": body.get("followups", True),
+    }
 
-    def formatter(item):
-        if isinstance(item, Exception):
-            item = {"state": "error", "error": str(item)}
-        return json.dumps(item)
+
+@app.route("/chat", methods=["POST"])
+@cross_origin()
+def chat():
+    as_stream = request.json.get("stream", True)
+    try:
+        params = parse_chat_request(request.json)
+    except UnknownPrompts as e:
+        return unknown_prompts(e)
+    settings = params.pop("settings")
+    # Set when the client disconnects, to stop generating an answer nobody will read
+    cancel = threading.Event()
 
     def run(callback):
-        return run_query(
-            session_id, query, history, Settings(**settings), callback, followups
-        )
+        return run_query(settings=make_settings(**settings), callback=callback, cancel=cancel, **params)
 
     if not as_stream:
-        return jsonify(run(None)["response"])
+        return jsonify(chat_pool.submit(run, None).result()["response"])
 
     return Response(
-        stream_with_context(stream(stream_callback(run, formatter))),
+        stream_with_context(stream(stream_callback(run, format_event, flush_window(request.json), cancel))),
         mimetype="text/event-stream",
     )
 
@@ -115,7 +204,7 @@ def chat():
 @app.route("/chat/<path:param>", methods=["GET"])
 @cross_origin()
 def chat_simplified(param=""):
-    res = run_query(None, param, [], Settings())
+    res = run_query(None, param, [], make_settings())
     res = jsonify({k: v for k, v in res.items() if k in ["response", "followups"]})
     return Response(res, mimetype="application/json")
 
@@ -128,24 +217,32 @@ def chat_simplified(param=""):
 @app.route("/human/<id>", methods=["GET"])
 @cross_origin()
 def human(id):
-    r = requests.get(f"https://aisafety.info/questions/{id}")
-    logging.info(
-        f"clicked followup '{json.loads(r.text)['data']['title']}': https://stampy.ai/?state={id}"
-    )
+    page = human_content.get(id)
+    if page is None:
+        response = Response('{"error": "could not fetch the page"}', 502, mimetype="application/json")
+        response.headers["Cache-Control"] = "no-store"
+        return response
 
-    # run a regex to replace all relative links with absolute links. Just doing
-    # a regex for now since we really don't need to parse everything out then
-    # re-serialize it for something this simple.
-    # <a href=\"/?state=6207&question=What%20is%20%22superintelligence%22%3F\">
-    #                               ⬇️
-    # <a href=\"https://stampy.ai/?state=6207&question=What%20is%20%22superintelligence%22%3F\">
-    text = re.sub(
-        r'<a href=\\"/\?state=(\d+.*)\\">',
-        r'<a href=\"https://aisafety.info/?state=\1\\">',
-        r.text,
-    )
+    if page.title:
+        logging.info(f"clicked followup '{page.title}': https://stampy.ai/?state={id}")
+
+    response = Response(page.body, page.status, mimetype="application/json")
+    response.headers["Cache-Control"] = human_content.cache_control(page)
+    if page.status == 200:
+        response.set_etag(page.digest)
+        response.make_conditional(request)
+    return response
 
-    return Response(text, mimetype="application/json")
+
+@app.route("/human/prefetch", methods=["POST"])
+@cross_origin()
+def human_prefetch():
+    """Warm the cache with the pages of the provided ids, e.g. the followups of an answer."""
+    ids = (request.get_json(silent=True) or {}).get("ids")
+    if not isinstance(ids, list) or not all(isinstance(id, (str, int)) for id in ids):
+        return Response('{"error": "ids must be a list of page ids"}', 400, mimetype="application/json")
+    started = human_content.prefetch([str(id) for id in ids[:HUMAN_PREFETCH_MAX]])
+    return jsonify({"prefetching": started}), 202
 
 
 # ------------------------------------------------------------------------------
@@ -183,12 +280,75 @@ def ratings():
     return jsonify({"status": "ok"})
 
 
+# ----------------------------------- admin ------------------------------------
+
+
+def admin_only(func):
+    """Only allow requests with `Authorization: Bearer <ADMIN_TOKEN>`. Admin endpoints are disabled without a token."""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        auth = request.headers.get("Authorization", "")
+        if not ADMIN_TOKEN or not hmac.compare_digest(auth, f"Bearer {ADMIN_TOKEN}"):
+            return Response('{"error": "forbidden"}', 403, mimetype="application/json")
+        return func(*args, **kwargs)
+    return wrapper
+
+
+@app.route("/admin/caches", methods=["GET"])
+@admin_only
+def admin_caches():
+    """The stats of this worker's caches."""
+    stats = caches_stats()
+    if embedding_cache:
+        stats["embeddings"] = embedding_cache.stats()
+    return jsonify(stats)
+
+
+@app.route("/admin/caches", methods=["DELETE"])
+@app.route("/admin/caches/<name>", methods=["DELETE"])
+@admin_only
+def admin_flush_caches(name=None):
+    """Flush this worker's caches, or just the named one. The embeddings cache is shared by all workers."""
+    cleared = clear_caches(*([name] if name else []))
+    if embedding_cache and name == "embeddings":
+        embedding_cache.clear()
+        cleared.append(name)
+    return jsonify({"cleared": cleared})
+
+
+@app.route("/admin/workers", methods=["GET"])
+@admin_only
+def admin_workers():
+    """How busy this worker's pools and queues are, and how its upstream services are doing."""
+    return jsonify({
+        "chat": chat_pool.stats(),
+        "chat_async": async_chat_limit.stats(),
+        "db_writer": item_adder.stats(),
+        "logging": logging.log_stats(),
+        "followups": followup_search.stats(),
+        "followup_index": followup_index.stats(),
+        "human": human_content.stats(),
+        "llm": routing.stats(),
+    })
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    """This worker's metrics, for Prometheus to scrape."""
+    if not metrics.authorized(request.headers.get("Authorization")):
+        return Response('{"error": "forbidden"}', 403, mimetype="application/json")
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
 @app.route("/inline-prompts", methods=["POST"])
 @cross_origin()
 def inline_prompts():
-    settings = request.json.get("settings", {})
+    try:
+        settings = resolve_prompts(request.json.get("settings", {}))
+    except UnknownPrompts as e:
+        return unknown_prompts(e)
     prompts = settings.get("prompts", {})
-    
+
     inlined_prompts = inline_all_templates(prompts)
     
     return jsonify(inlined_prompts)
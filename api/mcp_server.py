@@ -7,15 +7,29 @@ Provides RAG search tools via Model Context Protocol for remote access.
 
 from datetime import datetime
 from fastmcp import FastMCP
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse
 from stampy_chat.citations import get_top_k_blocks, Block
 from stampy_chat.prompts import format_blocks
-from stampy_chat import logging
+from stampy_chat import logging, metrics
 
 logger = logging.getLogger(__name__)
 
 # Initialize MCP server
 mcp = FastMCP("Stampy Backend RAG")
 
+SEARCH_SECONDS = metrics.Histogram(
+    "stampy_chat_mcp_search_seconds", "How long MCP searches took, including embedding the query"
+)
+
+
+@mcp.custom_route("/metrics", methods=["GET"])
+async def metrics_endpoint(request: Request) -> PlainTextResponse:
+    """The MCP server's metrics, for Prometheus to scrape."""
+    if not metrics.authorized(request.headers.get("Authorization")):
+        return PlainTextResponse("forbidden", status_code=403)
+    return PlainTextResponse(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
 
 @mcp.tool
 def search_alignment_research(
@@ -67,7 +81,8 @@ def search_alignment_research(
     snippets_per_doc = max(1, min(10, snippets_per_doc))
 
     try:
-        blocks = get_top_k_blocks(query, k, filter, snippets_per_doc)
+        with SEARCH_SECONDS.time():
+            blocks = get_top_k_blocks(query, k, filter, snippets_per_doc)
         logger.info(f"MCP search returned {len(blocks)} results")
 
         if format == "json":
@@ -0,0 +1,26 @@
+"""Mark interactions whose client disconnected mid answer
+
+Revision ID: b3f1c2d4e5a6
+Revises: 5813982e9665
+Create Date: 2026-10-17 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'b3f1c2d4e5a6'
+down_revision = '5813982e9665'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        'interactions',
+        sa.Column('cancelled', sa.Boolean(), nullable=False, server_default=sa.false()),
+    )
+
+
+def downgrade() -> None:
+    op.drop_column('interactions', 'cancelled')
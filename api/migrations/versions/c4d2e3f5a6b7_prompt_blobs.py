@@ -0,0 +1,172 @@
+"""Store prompts as content addressed blobs
+
+Revision ID: c4d2e3f5a6b7
+Revises: b3f1c2d4e5a6
+Create Date: 2026-10-17 14:00:00.000000
+
+"""
+import ast
+import hashlib
+import pprint
+import zlib
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+# revision identifiers, used by Alembic.
+revision = 'c4d2e3f5a6b7'
+down_revision = 'b3f1c2d4e5a6'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 500
+
+# A frozen copy of how `stampy_chat.prompt_store` segmented prompts when this migration was written,
+# so that later changes to it can't change what this migration does
+PARAGRAPH = "\n\n"
+BLOB_MIN_CHARS = 1024
+BOUNDARY_MODULUS = 4
+CHUNK_MAX_CHARS = 64 * 1024
+
+interactions = sa.table(
+    'interactions',
+    sa.column('id', sa.Integer),
+    sa.column('prompt', mysql.LONGTEXT),
+    sa.column('prompt_segments', sa.JSON),
+)
+prompt_blobs = sa.table(
+    'prompt_blobs',
+    sa.column('hash', sa.CHAR(64)),
+    sa.column('content', mysql.LONGTEXT),
+)
+
+
+def content_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def split_content(text):
+    chunks, current, size = [], [], 0
+    for paragraph in text.split(PARAGRAPH):
+        current.append(paragraph)
+        size += len(paragraph) + len(PARAGRAPH)
+        boundary = zlib.crc32(paragraph.encode("utf-8")) % BOUNDARY_MODULUS == 0
+        if (size >= BLOB_MIN_CHARS and boundary) or size >= CHUNK_MAX_CHARS:
+            chunks.append(PARAGRAPH.join(current))
+            current, size = [], 0
+    if current:
+        chunks.append(PARAGRAPH.join(current))
+    return chunks
+
+
+def segment_prompt(messages):
+    segmented, blobs = [], {}
+    for message in messages:
+        segments = []
+        for chunk in split_content(message.get("content") or ""):
+            if len(chunk) >= BLOB_MIN_CHARS:
+                blob_hash = content_hash(chunk)
+                blobs[blob_hash] = chunk
+                segments.append({"blob": blob_hash})
+            else:
+                segments.append(chunk)
+        segmented.append({"role": message.get("role"), "content": segments})
+    return segmented, blobs
+
+
+def reconstruct_prompt(segmented, blobs):
+    return [
+        {
+            "role": message["role"],
+            "content": PARAGRAPH.join(
+                blobs[segment["blob"]] if isinstance(segment, dict) else segment for segment in message["content"]
+            ),
+        }
+        for message in segmented
+    ]
+
+
+def parse_prompt(prompt):
+    """Old prompts were stored as the `pprint.pformat` of the list of messages."""
+    try:
+        messages = ast.literal_eval(prompt)
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+        return None
+    if not isinstance(messages, list) or not all(isinstance(m, dict) and isinstance(m.get('content'), str) for m in messages):
+        return None
+    return messages
+
+
+def upgrade() -> None:
+    op.create_table(
+        'prompt_blobs',
+        sa.Column('hash', sa.CHAR(64), nullable=False),
+        sa.Column('content', mysql.LONGTEXT(), nullable=False),
+        sa.Column('date_created', sa.DateTime(), nullable=False, server_default=sa.func.now()),
+        sa.PrimaryKeyConstraint('hash'),
+    )
+    op.add_column('interactions', sa.Column('prompt_segments', sa.JSON(), nullable=True))
+
+    conn = op.get_bind()
+    insert_blobs = sa.insert(prompt_blobs).prefix_with('IGNORE', dialect='mysql').prefix_with('OR IGNORE', dialect='sqlite')
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            sa.select(interactions.c.id, interactions.c.prompt)
+            .where(interactions.c.id > last_id, interactions.c.prompt.is_not(None))
+            .order_by(interactions.c.id)
+            .limit(BATCH_SIZE)
+        ).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+
+        blobs, updates = {}, []
+        for row in rows:
+            messages = parse_prompt(row.prompt)
+            if messages is None:
+                # Leave anything that can't be parsed as it is
+                continue
+            segments, row_blobs = segment_prompt(messages)
+            blobs.update(row_blobs)
+            updates.append({'row_id': row.id, 'segments': segments})
+
+        if blobs:
+            conn.execute(insert_blobs, [{'hash': h, 'content': c} for h, c in blobs.items()])
+        if updates:
+            conn.execute(
+                sa.update(interactions)
+                .where(interactions.c.id == sa.bindparam('row_id'))
+                .values(prompt_segments=sa.bindparam('segments'), prompt=None),
+                updates,
+            )
+
+
+def downgrade() -> None:
+    conn = op.get_bind()
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            sa.select(interactions.c.id, interactions.c.prompt_segments)
+            .where(interactions.c.id > last_id, interactions.c.prompt_segments.is_not(None))
+            .order_by(interactions.c.id)
+            .limit(BATCH_SIZE)
+        ).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+
+        hashes = {s['blob'] for row in rows for m in row.prompt_segments for s in m['content'] if isinstance(s, dict)}
+        blobs = dict(
+            conn.execute(sa.select(prompt_blobs.c.hash, prompt_blobs.c.content).where(prompt_blobs.c.hash.in_(hashes))).all()
+        )
+        conn.execute(
+            sa.update(interactions)
+            .where(interactions.c.id == sa.bindparam('row_id'))
+            .values(prompt=sa.bindparam('text')),
+            [{'row_id': row.id, 'text': pprint.pformat(reconstruct_prompt(row.prompt_segments, blobs))} for row in rows],
+        )
+
+    op.drop_column('interactions', 'prompt_segments')
+    op.drop_table('prompt_blobs')
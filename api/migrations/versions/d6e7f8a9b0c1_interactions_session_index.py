@@ -0,0 +1,22 @@
+"""Index interactions by session, for rebuilding conversations
+
+Revision ID: d6e7f8a9b0c1
+Revises: c4d2e3f5a6b7
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'd6e7f8a9b0c1'
+down_revision = 'c4d2e3f5a6b7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_index('interactions_session_id', 'interactions', ['session_id', 'interaction_no'])
+
+
+def downgrade() -> None:
+    op.drop_index('interactions_session_id', table_name='interactions')
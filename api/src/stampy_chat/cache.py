@@ -0,0 +1,158 @@
+"""In-process caches bounded by memory use, with per entry expiry and stats.
+
+`functools.lru_cache` only limits the number of entries, which says nothing about how much memory
+they take, and it never expires anything, so e.g. index updates never show up. These caches
+account for the (approximate) size of their entries in bytes, evict the least recently used entries
+once they're full, and drop entries once their TTL has passed.
+
+All caches register themselves in `CACHES` (unless told not to, e.g. in tests), so they can be
+inspected and flushed from the admin endpoints.
+"""
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, NamedTuple
+
+CACHES: dict[str, "TTLCache"] = {}
+
+MISSING = object()
+
+
+def sizeof(obj: Any, _seen: set | None = None) -> int:
+    """Approximate the number of bytes used by `obj`, including anything it contains."""
+    if _seen is None:
+        _seen = set()
+    if id(obj) in _seen:
+        return 0
+    _seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (str, bytes, int, float, bool)) or obj is None:
+        return size
+    if isinstance(obj, dict):
+        return size + sum(sizeof(k, _seen) + sizeof(v, _seen) for k, v in obj.items())
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return size + sum(sizeof(item, _seen) for item in obj)
+    if hasattr(obj, "__dict__"):
+        return size + sizeof(vars(obj), _seen)
+    return size
+
+
+class Entry(NamedTuple):
+    value: Any
+    size: int
+    expires: float
+
+
+# Roughly what an OrderedDict item costs on top of its key and value: a slot in the hash table, and a
+# node in the linked list that keeps the order
+ORDERED_DICT_ITEM = 100
+# What each entry costs apart from its key and value - the `Entry` with its size and expiry, and its OrderedDict item
+ENTRY_OVERHEAD = sys.getsizeof(Entry(None, 0, 0.0)) + sys.getsizeof(2**40) + sys.getsizeof(0.0) + ORDERED_DICT_ITEM
+
+
+def entry_size(key: Hashable, value: Any) -> int:
+    """Approximate how many bytes caching `value` under `key` takes. Anything they share is only counted once."""
+    seen = set()
+    return sizeof(key, seen) + sizeof(value, seen) + ENTRY_OVERHEAD
+
+
+class TTLCache:
+    """A thread safe LRU cache, bounded by the total size of its entries.
+
+    :param str name: the name under which the cache is registered in `CACHES`
+    :param int max_bytes: the maximum total size of all entries, including their keys and bookkeeping
+    :param float ttl: the default number of seconds after which entries expire
+    :param bool register: whether to add the cache to `CACHES`
+    """
+
+    def __init__(self, name: str, max_bytes: int, ttl: float, register: bool = True):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries: OrderedDict[Hashable, Entry] = OrderedDict()
+        self._lock = threading.Lock()
+        if register:
+            CACHES[name] = self
+
+    def _remove(self, key: Hashable) -> Entry:
+        entry = self._entries.pop(key)
+        self.bytes -= entry.size
+        return entry
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.get(key, MISSING)
+            if entry is MISSING:
+                self.misses += 1
+                return default
+            if entry.expires < time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry.value
+
+    def set(self, key: Hashable, value: Any, ttl: float | None = None) -> None:
+        size = entry_size(key, value)
+        if size > self.max_bytes:
+            return
+
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = Entry(value, size, expires)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry.expires >= time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict[str, int | float]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+def caches_stats() -> dict[str, dict[str, int | float]]:
+    return {name: cache.stats() for name, cache in CACHES.items()}
+
+
+def clear_caches(*names: str) -> list[str]:
+    """Clear the named caches (or all of them, if no names are given), returning which were cleared."""
+    cleared = []
+    for name, cache in CACHES.items():
+        if not names or name in names:
+            cache.clear()
+            cleared.append(name)
+    return cleared
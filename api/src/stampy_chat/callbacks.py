@@ -1,19 +1,28 @@
+import asyncio
 import threading
+import time
 import traceback
-from queue import Queue
-from typing import Any, Callable, Iterator, Sequence
-import pprint
+from queue import Empty, Full, Queue
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterator, Sequence
 
 import mysql.connector.errors
 from sqlalchemy.exc import DatabaseError
 
 from stampy_chat import logging
 from stampy_chat.citations import Block, Message
+from stampy_chat.env import STREAM_MAX_BATCH_CHARS, STREAM_QUEUE_SIZE, STREAM_SEND_TIMEOUT
+from stampy_chat.workers import ChatPool, chat_pool
 
 logger = logging.getLogger(__name__)
 
+# How often (in seconds) a blocked `stream_callback` iterator checks whether the stream was cancelled
+CANCEL_POLL = 0.1
+
 
 class CallbackHandler:
+    def on_session(self, session_id: str, session_token: str) -> None:
+        pass
+
     def on_history(self, history: list[Message]):
         pass
 
@@ -28,6 +37,9 @@ class CallbackHandler:
     ) -> None:
         pass
 
+    def on_context_packed(self, tokens: dict[str, int]) -> None:
+        pass
+
     def on_llm_start(self) -> Any:
         pass
 
@@ -37,6 +49,9 @@ class CallbackHandler:
     def on_response(self, response: str) -> None:
         pass
 
+    def on_usage(self, usage: dict[str, int]) -> None:
+        pass
+
     def on_llm_end(self, response, **kwargs: Any) -> Any:
         pass
 
@@ -50,8 +65,13 @@ class CallbackHandler:
 class BroadcastCallbackHandler(CallbackHandler):
     """A callback handler that will broadcast any events to all listeners."""
 
-    def __init__(self, broadcaster, *args, **kwargs) -> None:
+    def __init__(self, broadcaster, *args, echo_history: bool = True, **kwargs) -> None:
+        """
+        :param bool echo_history: whether the history can be sent back in the prompt - not if it came from the
+          session store rather than from the client
+        """
         self.broadcaster = broadcaster
+        self.echo_history = echo_history
         super().__init__(*args, **kwargs)
 
     def broadcast(self, value: Any) -> None:
@@ -61,8 +81,13 @@ class BroadcastCallbackHandler(CallbackHandler):
     def on_prompt(
         self, prompt: list[Message], query: str, history: list[Message]
     ) -> None:
+        if not self.echo_history:
+            prompt = [m for m in prompt[:-1] if m["role"] == "system"] + list(prompt[-1:])
         self.broadcast({"state": "prompt", "promptedHistory": prompt})
 
+    def on_session(self, session_id: str, session_token: str) -> None:
+        self.broadcast({"state": "session", "sessionId": session_id, "sessionToken": session_token})
+
     def on_response(self, chunk: str) -> None:
         self.broadcast({"state": "streaming", "content": chunk})
 
@@ -107,6 +132,7 @@ class LoggerCallbackHandler(CallbackHandler):
         self.context = None
         self.prompted_history = None
         self.hyde = None
+        self.usage = None
         super().__init__(*args, **kwargs)
 
     def on_history(self, history: list[Message]):
@@ -118,7 +144,31 @@ class LoggerCallbackHandler(CallbackHandler):
     def on_citations_retrieved(self, citations: list[Block]) -> None:
         self.context = citations
 
-    def on_llm_end(self, response: str, **kwargs: Any) -> Any:
+    def on_usage(self, usage: dict[str, int]) -> None:
+        self.usage = usage
+        logger.info(
+            "prompt cache: %s tokens read, %s tokens written, %s uncached input tokens, %s output tokens",
+            usage.get("cache_read_input_tokens", 0),
+            usage.get("cache_creation_input_tokens", 0),
+            usage.get("input_tokens", 0),
+            usage.get("output_tokens", 0),
+        )
+
+    def on_context_packed(self, tokens: dict[str, int]) -> None:
+        logger.info(
+            "prompt: %s tokens (system %s, history %s, message %s), context: %s/%s tokens in %s blocks, %s trimmed, %s dropped",
+            tokens["prompt_tokens"],
+            tokens["system_tokens"],
+            tokens["history_tokens"],
+            tokens["message_tokens"],
+            tokens["context_tokens"],
+            tokens["context_budget"],
+            tokens["blocks"],
+            tokens["trimmed"],
+            tokens["dropped"],
+        )
+
+    def on_llm_end(self, response: str, cancelled: bool = False, **kwargs: Any) -> Any:
         try:
             logger.interaction(
                 self.session_id,
@@ -126,10 +176,9 @@ class LoggerCallbackHandler(CallbackHandler):
                 + (f"\n\n(hyde: {self.hyde})" if self.hyde is not None else ""),
                 response,
                 self.history,
-                pprint.pformat(
-                    self.prompted_history
-                ),  # todo: what is logger.interaction?
+                self.prompted_history,
                 self.context,
+                cancelled=cancelled,
             )
         except (DatabaseError, mysql.connector.errors.DatabaseError):
             logger.error(traceback.format_exc())
@@ -142,9 +191,64 @@ class LoggerCallbackHandler(CallbackHandler):
 
 Callback = Callable[[Any], None]
 
+# Consecutive messages with these states can be merged into one by concatenating their contents
+COALESCED_STATES = ("streaming", "thinking")
+
+
+class Coalescer:
+    """Merge consecutive streaming and thinking messages into batches.
+
+    A message is sent straight away if nothing was sent in the last `window` seconds, so the first
+    token (or the first one after a pause) isn't delayed. Otherwise it's held back until the window
+    has passed, along with anything else that arrives in the meantime. Any other message flushes the
+    current batch first, so the order of messages doesn't change.
+
+    :param float window: the minimum number of seconds between batches. 0 disables coalescing
+    :param int max_chars: send the batch as soon as it has this many characters
+    """
+
+    def __init__(self, window: float, max_chars: int = STREAM_MAX_BATCH_CHARS):
+        self.window = window
+        self.max_chars = max_chars
+        self.pending: dict | None = None
+        self.last_flush = float("-inf")
+
+    def timeout(self) -> float | None:
+        """How long until the pending batch should be sent, or `None` if there is nothing pending."""
+        if self.pending is None:
+            return None
+        return max(0.0, self.last_flush + self.window - time.monotonic())
+
+    def flush(self) -> list:
+        if self.pending is None:
+            return []
+        pending, self.pending = self.pending, None
+        self.last_flush = time.monotonic()
+        return [pending]
+
+    def add(self, message: Any) -> list:
+        """Add the message, returning any messages that should be sent now."""
+        if not (isinstance(message, dict) and message.get("state") in COALESCED_STATES):
+            return self.flush() + [message]
+
+        ready = []
+        if self.pending is not None and self.pending["state"] == message["state"]:
+            self.pending["content"] += message["content"]
+        else:
+            ready = self.flush()
+            self.pending = dict(message)
+
+        if len(self.pending["content"]) >= self.max_chars or self.timeout() == 0:
+            ready += self.flush()
+        return ready
+
 
 def stream_callback(
-    function: Callable[[Callback], Any], formatter: Callable[[Any], str] = str
+    function: Callable[[Callback], Any],
+    formatter: Callable[[Any], str] = str,
+    flush_window: float = 0,
+    cancel: threading.Event | None = None,
+    pool: ChatPool | None = None,
 ) -> Iterator:
     """Stream the items that are sent via a callback.
 
@@ -168,14 +272,25 @@ def stream_callback(
     not what Flask expects, hence the magic here with Queues and Threads to pretend that a
     function is a yieldable.
 
+    The function is run in the shared chat pool, and the queue between it and the iterator is
+    bounded, so a slow client makes `function` wait rather than buffering without limit. If the
+    client hasn't taken anything for `STREAM_SEND_TIMEOUT` seconds, it's treated as gone.
+
     Sending a `None` to the callable will close the iterator.
 
     :param Callable[[Callback], Any] function: the function that will generate the data
     :param Callable[[Any], str] formatter: an optional formatter of all received messages
+    :param float flush_window: how many seconds to batch up streaming chunks for - see `Coalescer`
+    :param threading.Event cancel: an event that will be set if the iterator is closed before `function`
+      is done, e.g. because the client disconnected. `function` should stop working when it's set
+    :param ChatPool pool: the pool to run `function` in - the shared `chat_pool` by default
 
+    :raises Saturated: if the pool is full. Nothing will have been started in that case
     :returns: An iterator will all calls to the `callback` provided to `function`. This is till the first `None`
     """
-    queue = Queue()
+    queue = Queue(maxsize=STREAM_QUEUE_SIZE)
+    if cancel is None:
+        cancel = threading.Event()
 
     def generate(rq: Queue):
         """Tranform a Queue into an iterator.
@@ -183,16 +298,47 @@ def stream_callback(
         This will iterate over items from the Queue until it gets a `None`.
         Items are added in a child thread.
         """
-        while (message := rq.get()) is not None:
-            yield formatter(message)
+        coalescer = Coalescer(flush_window)
+        finished = False
+        try:
+            while True:
+                # Wake up every so often to check whether the stream was cancelled - once that happens,
+                # `callback` drops everything, including the closing `None`
+                timeout = coalescer.timeout()
+                try:
+                    message = rq.get(timeout=CANCEL_POLL if timeout is None else min(timeout, CANCEL_POLL))
+                except Empty:
+                    if cancel.is_set() and coalescer.timeout() is None:
+                        break
+                    ready = coalescer.flush() if coalescer.timeout() == 0 else []
+                else:
+                    if message is None:
+                        break
+                    ready = coalescer.add(message)
+                yield from (formatter(item) for item in ready)
+            yield from (formatter(item) for item in coalescer.flush())
+            finished = True
+        finally:
+            # The WSGI server closes the iterator when the client goes away
+            if not finished:
+                cancel.set()
 
     def callback(value: Any):
         """The callback provided to `function`.
 
         This just adds the values to the queue. This happens in the child thread; they get
         fetched from the queue in the main thread (i.e. the caller of `stream_callback`).
+        If the queue is full, this waits for the client to catch up, giving up if it has gone.
         """
-        queue.put(value)
+        deadline = time.monotonic() + STREAM_SEND_TIMEOUT
+        while not cancel.is_set():
+            try:
+                queue.put(value, timeout=0.1)
+                return
+            except Full:
+                if time.monotonic() > deadline:
+                    logger.warning("Client stopped reading for %ss, cancelling the stream", STREAM_SEND_TIMEOUT)
+                    cancel.set()
 
     def error_handler(function, callback):
         """Catch any errors from the `function`, but also make sure the generated iterator gets closed properly."""
@@ -205,13 +351,89 @@ def stream_callback(
 
         callback(None)
 
-    # Call the `function` in a child thread - all callback items will be added to the queue and read from
+    # Call the `function` in a pool thread - all callback items will be added to the queue and read from
     # this thread, i.e. the one in which `stream_callback` was called
-    threading.Thread(
-        target=error_handler,
-        args=(
-            function,
-            callback,
-        ),
-    ).start()
+    (pool or chat_pool).submit(error_handler, function, callback)
     return generate(queue)
+
+
+async def astream_callback(
+    function: Callable[[Callback], Awaitable[Any]], formatter: Callable[[Any], str] = str, flush_window: float = 0
+) -> AsyncIterator:
+    """The async version of `stream_callback`.
+
+    `function` is run as a task in the current event loop rather than in a new thread. The callback
+    it gets can be called from any thread. If the iterator is closed or cancelled before `function`
+    is done (e.g. because the client disconnected), the task is cancelled.
+
+    The callback can't block the event loop to wait for a slow client, so instead it has an async
+    `drain` method, which `function` should await every so often (e.g. after each streamed chunk).
+    That waits while `STREAM_QUEUE_SIZE` messages are waiting to be sent, cancelling the task if the
+    client hasn't taken anything for `STREAM_SEND_TIMEOUT` seconds.
+
+    :param Callable[[Callback], Awaitable[Any]] function: the coroutine function that will generate the data
+    :param Callable[[Any], str] formatter: an optional formatter of all received messages
+    :param float flush_window: how many seconds to batch up streaming chunks for - see `Coalescer`
+
+    :returns: An async iterator with all calls to the `callback` provided to `function`, until the first `None`
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    room = asyncio.Event()
+
+    def callback(value: Any):
+        try:
+            on_loop = asyncio.get_running_loop() is loop
+        except RuntimeError:
+            on_loop = False
+        # Values from the loop's own thread go straight in, so `drain` sees them
+        if on_loop:
+            queue.put_nowait(value)
+        else:
+            loop.call_soon_threadsafe(queue.put_nowait, value)
+
+    async def drain():
+        # Let any values sent from other threads land in the queue before checking its size
+        await asyncio.sleep(0)
+        while queue.qsize() >= STREAM_QUEUE_SIZE:
+            room.clear()
+            try:
+                await asyncio.wait_for(room.wait(), timeout=STREAM_SEND_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.warning("Client stopped reading for %ss, cancelling the stream", STREAM_SEND_TIMEOUT)
+                raise asyncio.CancelledError()
+
+    callback.drain = drain
+
+    async def error_handler():
+        try:
+            await function(callback)
+        except Exception as e:
+            logger.error(f"Error in stream callback function: {str(e)}", exc_info=True)
+            callback(e)
+        finally:
+            callback(None)
+
+    # Keep a reference to the task, otherwise it could get garbage collected mid way
+    task = loop.create_task(error_handler())
+    coalescer = Coalescer(flush_window)
+    try:
+        while True:
+            try:
+                message = await asyncio.wait_for(queue.get(), timeout=coalescer.timeout())
+            except asyncio.TimeoutError:
+                ready = coalescer.flush()
+            else:
+                if queue.qsize() < STREAM_QUEUE_SIZE:
+                    room.set()
+                if message is None:
+                    break
+                ready = coalescer.add(message)
+            for item in ready:
+                yield formatter(item)
+        for item in coalescer.flush():
+            yield formatter(item)
+        await asyncio.wait({task})
+    finally:
+        if not task.done():
+            task.cancel()
@@ -1,103 +1,506 @@
+import asyncio
+import inspect
+import json
 import re
-import functools
-import dataclasses
-from typing import Any, Callable, Optional, cast
+import threading
+from contextlib import aclosing, closing
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from typing import Any, Callable, Hashable, Optional, Sequence, cast
 
 from frozendict import frozendict
 
+from stampy_chat.cache import TTLCache
 from stampy_chat.callbacks import (
     BroadcastCallbackHandler,
     CallbackHandler,
     LoggerCallbackHandler,
 )
 from stampy_chat.settings import Settings
-from stampy_chat.llms import query_llm
-from stampy_chat.citations import retrieve_docs, Message
-from stampy_chat.prompts import inject_guidance, inject_guidance_hyde
-from stampy_chat.followups import search_followups, Followup
+from stampy_chat.llms import LLMChunk, aquery_llm, query_llm
+from stampy_chat.citations import (
+    Block,
+    Match,
+    Message,
+    asearch_queries,
+    blocks_from_matches,
+    fuse_results,
+    search_queries,
+)
+from stampy_chat.env import (
+    HYDE_CACHE_BYTES,
+    HYDE_CACHE_TTL,
+    HYDE_TIMEOUT,
+    PINECONE_NAMESPACE,
+    RETRIEVAL_CACHE_BYTES,
+    RETRIEVAL_CACHE_TTL,
+    RETRIEVAL_WORKERS,
+    VOYAGEAI_EMBEDDINGS_MODEL,
+)
+from stampy_chat.prompts import inject_guidance, inject_guidance_hyde, pack_blocks, prompt_tokens
+from stampy_chat.followups import search_followups, start_followups, Followup
+from stampy_chat.history_summary import apply_summary, summarize_later
+from stampy_chat.sessions import Conversation, session_store
+from stampy_chat import logging
+from stampy_chat.metrics import HYDE_SECONDS, PROMPT_BUILD_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# HyDE is run in the background, so that retrieval with the raw query can start immediately
+hyde_executor = ThreadPoolExecutor(max_workers=RETRIEVAL_WORKERS, thread_name_prefix="hyde")
+
+hyde_cache = TTLCache("hyde", max_bytes=HYDE_CACHE_BYTES, ttl=HYDE_CACHE_TTL)
+retrieval_cache = TTLCache("retrieval", max_bytes=RETRIEVAL_CACHE_BYTES, ttl=RETRIEVAL_CACHE_TTL)
+
+
+def hyde_key(query: str, history: Sequence[frozendict], settings: Settings) -> Hashable:
+    """Only the things that go into the HyDE prompt, so that changing e.g. the main prompts doesn't bust the cache."""
+    return (
+        query,
+        tuple(history),
+        settings.model,
+        settings.hyde_max_tokens,
+        settings.history_tokens,
+        settings.hyde_system_prompt,
+        settings.history_prompt,
+        settings.hyde_pre_message_prompt,
+        settings.hyde_post_message_prompt,
+        settings.message_format,
+        settings.instruction_wrapper,
+    )
+
+
+def retrieval_key(query: str, settings: Settings) -> Hashable:
+    """Only the things that affect which matches are returned for the query."""
+    return (
+        query,
+        json.dumps(settings.miri_filters, sort_keys=True),
+        PINECONE_NAMESPACE,
+        VOYAGEAI_EMBEDDINGS_MODEL,
+    )
+
+
+def generate_hyde(query: str, history: Sequence[frozendict], settings: Settings) -> str | None:
+    """Write a hypothetical answer to the query, to search with. Returns None if the model didn't write one
+    (e.g. it spent all its tokens thinking).
+    """
+    key = hyde_key(query, history, settings)
+    if (hyde_document := hyde_cache.get(key)) is not None:
+        return hyde_document
 
-@functools.lru_cache(maxsize=128)
-def generate_hyde(query: str, history: frozendict, settings: Settings) -> str:
     hyde_history = inject_guidance_hyde(query, list(history), settings)
-    return cast(
-        str,
+    hyde_document = cast(
+        str | None,
         query_llm(
             hyde_history,
             settings,
             stream=False,
             max_tokens=settings.hyde_max_tokens,
             thinking_budget=0,
+            # Retrieval is waiting on this, so don't wait for a slow provider
+            hedge=True,
+            timer=HYDE_SECONDS,
         ),
     )
+    if not (hyde_document or "").strip():
+        logger.warning("HyDE returned an empty document, retrieving without it")
+        return None
+    hyde_cache.set(key, hyde_document)
+    return hyde_document
 
-@functools.lru_cache(maxsize=128)
-def retrieve_docs_cached(query: str, settings: Settings):
-    return retrieve_docs(query, settings)
 
+async def agenerate_hyde(query: str, history: Sequence[frozendict], settings: Settings) -> str | None:
+    """The async version of `generate_hyde`."""
+    key = hyde_key(query, history, settings)
+    if (hyde_document := hyde_cache.get(key)) is not None:
+        return hyde_document
 
-def run_query(
+    hyde_history = inject_guidance_hyde(query, list(history), settings)
+    hyde_document = cast(
+        str | None,
+        await aquery_llm(
+            hyde_history,
+            settings,
+            stream=False,
+            max_tokens=settings.hyde_max_tokens,
+            thinking_budget=0,
+            # Retrieval is waiting on this, so don't wait for a slow provider
+            hedge=True,
+            timer=HYDE_SECONDS,
+        ),
+    )
+    if not (hyde_document or "").strip():
+        logger.warning("HyDE returned an empty document, retrieving without it")
+        return None
+    hyde_cache.set(key, hyde_document)
+    return hyde_document
+
+
+def search_queries_cached(queries: Sequence[str], settings: Settings) -> list[list[Match]]:
+    """Return the matches for each of the queries, only searching for the ones that aren't cached."""
+    keys = [retrieval_key(query, settings) for query in queries]
+    results = [retrieval_cache.get(key) for key in keys]
+
+    missing = [i for i, result in enumerate(results) if result is None]
+    if missing:
+        found = search_queries([queries[i] for i in missing], settings)
+        for i, matches in zip(missing, found):
+            retrieval_cache.set(keys[i], matches)
+            results[i] = matches
+    return results
+
+
+async def asearch_queries_cached(queries: Sequence[str], settings: Settings) -> list[list[Match]]:
+    keys = [retrieval_key(query, settings) for query in queries]
+    results = [retrieval_cache.get(key) for key in keys]
+
+    missing = [i for i, result in enumerate(results) if result is None]
+    if missing:
+        found = await asearch_queries([queries[i] for i in missing], settings)
+        for i, matches in zip(missing, found):
+            retrieval_cache.set(keys[i], matches)
+            results[i] = matches
+    return results
+
+
+def retrieve_docs_cached(query: str, settings: Settings) -> list[Block]:
+    return blocks_from_matches(fuse_results(search_queries_cached([query], settings)))
+
+
+def query_variants(query: str, history: list[Message]) -> list[str]:
+    """Return the raw query, and if there is a previous question, a version with it as context."""
+    previous = [m["content"] for m in history if m.get("role") == "user" and m.get("content")]
+    if not previous:
+        return [query]
+    return [query, previous[-1] + "\n\n" + query]
+
+
+def retrieve_with_hyde(
+    query: str, history: list[Message], settings: Settings, callbacks: list[CallbackHandler]
+) -> list[Block]:
+    """Retrieve blocks for the query variants and a HyDE document, fusing the results.
+
+    The hypothetical document is generated in the background while the raw query variants are
+    being embedded and searched for. If it's already cached, all variants are embedded with one
+    call. Retrieval won't wait more than `HYDE_TIMEOUT` seconds for it.
+    """
+    frozen_history = tuple(frozendict(m) for m in history)
+    queries = query_variants(query, history)
+
+    if (hyde_document := hyde_cache.get(hyde_key(query, frozen_history, settings))) is not None:
+        for call in callbacks:
+            call.on_hyde_done(hyde_document)
+        results = search_queries_cached([hyde_document] + queries, settings)
+        return blocks_from_matches(fuse_results(results))
+
+    hyde = hyde_executor.submit(generate_hyde, query, frozen_history, settings)
+    results = search_queries_cached(queries, settings)
+    try:
+        hyde_document = hyde.result(timeout=HYDE_TIMEOUT)
+    except TimeoutError:
+        logger.warning("HyDE took longer than %ss, retrieving without it", HYDE_TIMEOUT)
+    except Exception as e:
+        logger.error("HyDE failed, retrieving without it: %s", e)
+    else:
+        if hyde_document:
+            for call in callbacks:
+                call.on_hyde_done(hyde_document)
+            results = search_queries_cached([hyde_document], settings) + results
+    return blocks_from_matches(fuse_results(results))
+
+
+async def aretrieve_with_hyde(
+    query: str, history: list[Message], settings: Settings, callbacks: list[CallbackHandler]
+) -> list[Block]:
+    """The async version of `retrieve_with_hyde`."""
+    frozen_history = tuple(frozendict(m) for m in history)
+    queries = query_variants(query, history)
+
+    if (hyde_document := hyde_cache.get(hyde_key(query, frozen_history, settings))) is not None:
+        for call in callbacks:
+            call.on_hyde_done(hyde_document)
+        results = await asearch_queries_cached([hyde_document] + queries, settings)
+        return blocks_from_matches(fuse_results(results))
+
+    hyde = asyncio.create_task(agenerate_hyde(query, frozen_history, settings))
+    results = await asearch_queries_cached(queries, settings)
+    try:
+        # Shielded, so that a slow HyDE document still ends up in the cache for next time
+        hyde_document = await asyncio.wait_for(asyncio.shield(hyde), timeout=HYDE_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning("HyDE took longer than %ss, retrieving without it", HYDE_TIMEOUT)
+    except Exception as e:
+        logger.error("HyDE failed, retrieving without it: %s", e)
+    else:
+        if hyde_document:
+            for call in callbacks:
+                call.on_hyde_done(hyde_document)
+            results = await asearch_queries_cached([hyde_document], settings) + results
+    return blocks_from_matches(fuse_results(results))
+
+
+def make_callbacks(
     session_id: str,
     query: str,
     history: list[Message],
+    callback: Optional[Callable[[Any], None]] = None,
+    echo_history: bool = True,
+) -> list[CallbackHandler]:
+    callbacks: list[CallbackHandler] = [
+        LoggerCallbackHandler(session_id=session_id, query=query, history=history)
+    ]
+    if callback:
+        callbacks += [BroadcastCallbackHandler(callback, echo_history=echo_history)]
+    return callbacks
+
+
+def handle_chunk(chunk: LLMChunk, callbacks: list[CallbackHandler]) -> str:
+    """Pass the chunk on to the callbacks, returning any text that should be added to the response."""
+    chunk_type, text = chunk.get("type"), chunk.get("text")
+    if chunk_type == "thinking":
+        for call in callbacks:
+            call.on_thinking(text)
+    elif chunk_type == "response":
+        for call in callbacks:
+            call.on_response(text)
+        return text
+    elif chunk_type == "usage":
+        for call in callbacks:
+            call.on_usage(chunk["usage"])
+    return ""
+
+
+@PROMPT_BUILD_SECONDS.time()
+def build_prompt(
+    session_id: str,
+    query: str,
+    history: list[Message],
+    docs: list[Block],
+    settings: Settings,
+    callbacks: list[CallbackHandler],
+    counts: Sequence[int] | None = None,
+) -> list[Message]:
+    """Pack as many of the retrieved blocks as fit into the context budget, and build the prompt around them.
+
+    If the older part of the conversation has already been summarized, the summary is used instead.
+
+    :param Sequence[int] counts: the number of tokens in each message of `history`, if already known
+    """
+    docs, packing = pack_blocks(docs, settings.context_tokens, settings.topKBlocks)
+    for call in callbacks:
+        call.on_citations_retrieved(docs)
+
+    recent, summary = apply_summary(session_id, history)
+    if counts is not None:
+        counts = counts[len(counts) - len(recent):]
+    prompted_history = inject_guidance(query, recent, docs, settings, summary, counts)
+    tokens = {**prompt_tokens(prompted_history), **packing}
+    for call in callbacks:
+        call.on_prompt(prompted_history, query, history)
+        call.on_context_packed(tokens)
+    return prompted_history
+
+
+def load_conversation(
+    session_id: str | None, history: list[Message] | None, session_token: str | None = None
+) -> tuple[Conversation, str | None]:
+    """Get the conversation so far from the session store, unless the client sent it.
+
+    The stored conversation is only used (or updated) for clients with the session's token, which is
+    handed out to whoever starts the session with an empty history. Anyone else gets an empty
+    conversation unless they send the history themselves.
+
+    :returns: the conversation, and the session's token if the client may use the stored conversation
+    """
+    if session_store.check_token(session_id, session_token):
+        token = session_token
+    elif history == []:
+        token = session_store.start(session_id)
+    else:
+        token = None
+
+    stored_id = session_id if token else None
+    if history is None:
+        return session_store.get(stored_id), token
+    return session_store.set(stored_id, history), token
+
+
+def finish_turn(
+    session_id: str | None,
+    conversation: Conversation,
+    query: str,
+    response: str,
+    settings: Settings,
+    session_token: str | None = None,
+):
+    """Record the answer in the session store, and update the conversation's summary in the background."""
+    conversation = session_store.add_turn(session_id if session_token else None, conversation, query, response)
+    summarize_later(session_id, list(conversation.messages), settings)
+
+
+def start_session(
+    session_id: str | None,
+    query: str,
+    history: list[Message] | None,
+    session_token: str | None,
+    callback: Optional[Callable[[Any], None]],
+) -> tuple[Conversation, str | None, list[CallbackHandler]]:
+    """Load the conversation, and set up the callbacks, telling the client its session token."""
+    conversation, session_token = load_conversation(session_id, history, session_token)
+    # Only send back the history the client sent itself
+    callbacks = make_callbacks(session_id, query, list(conversation.messages), callback, echo_history=history is not None)
+    if session_token:
+        for call in callbacks:
+            call.on_session(session_id, session_token)
+    return conversation, session_token, callbacks
+
+
+def run_query(
+    session_id: str,
+    query: str,
+    history: list[Message] | None,
     settings: Settings,
     callback: Optional[Callable[[Any], None]] = None,
     followups=True,
+    cancel: threading.Event | None = None,
+    session_token: str | None = None,
 ) -> dict[str, str | list[Followup]]:
     """Execute the query.
 
     :param str query: the phrase that was input by the user
-    :param list[Message] history: any previous interactions with the user
+    :param list[Message] history: any previous interactions with the user, or None to use the stored ones
+    :param str session_token: the token of the session, needed to use the stored history
     :param Settings settings: the system settings
     :param Callable[[Any], None] callback: an optional callback that will be called at various key parts of the chain
+    :param threading.Event cancel: set when the client has gone away. This stops the LLM generation and
+      skips the followups, with whatever was generated so far being logged as cancelled
     :returns: the result of the chain
     """
-    callbacks: list[CallbackHandler] = [
-        LoggerCallbackHandler(session_id=session_id, query=query, history=history)
-    ]
-    if callback:
-        callbacks += [BroadcastCallbackHandler(callback)]
+    conversation, session_token, callbacks = start_session(session_id, query, history, session_token, callback)
+    history = list(conversation.messages)
 
-    # Convert history to frozendict for caching
-    frozen_history = tuple(frozendict(m) for m in history)
-    docs_settings = dataclasses.replace(settings, thinking_budget=0, max_response_tokens=settings.hyde_max_tokens)
+    def cancelled():
+        return cancel is not None and cancel.is_set()
+
+    # The followups for the query don't depend on anything else, so start looking for them straight away
+    query_followups = start_followups(query) if followups else None
 
-    retrieval_query = query
+    docs_settings = settings.docs_settings
     if settings.enable_hyde:
-        retrieval_query = generate_hyde(query, frozen_history, docs_settings)
+        docs = retrieve_with_hyde(query, history, docs_settings, callbacks)
+    else:
+        docs = retrieve_docs_cached(query, docs_settings)
+    prompted_history = build_prompt(session_id, query, history, docs, settings, callbacks, conversation.counts)
+
+    response = ""
+    if not cancelled():
         for call in callbacks:
-            call.on_hyde_done(retrieval_query)
+            call.on_llm_start()
 
-    docs = retrieve_docs_cached(retrieval_query, docs_settings)
-    docs = docs[:settings.topKBlocks]
-    for call in callbacks:
-        call.on_citations_retrieved(docs)
+        # Closing the chunks generator closes the provider stream
+        with closing(query_llm(prompted_history, settings)) as chunks:
+            for chunk in chunks:
+                if cancelled():
+                    break
+                response += handle_chunk(chunk, callbacks)
 
-    prompted_history = inject_guidance(query, history, docs, settings)
-    for call in callbacks:
-        call.on_prompt(prompted_history, query, history)
+    if cancelled():
+        logger.info("Client disconnected, stopped generating after %s characters", len(response))
+        if query_followups:
+            query_followups.cancel()
+        for call in callbacks:
+            call.on_llm_end(response, cancelled=True)
+        if callback:
+            callback(None)
+        return {"response": response, "followups": []}
 
     for call in callbacks:
-        call.on_llm_start()
+        call.on_llm_end(response)
+    finish_turn(session_id, conversation, query, response, settings, session_token)
+
+    follows = []
+    if followups:
+        follows = search_followups(query, response, callbacks, query_followups)
+
+    print("result", response)
+
+    if callback:
+        callback({"state": "done"})
+        callback(None)
+    return {"response": response, "followups": follows}
+
+
+async def wait_for_client(callback: Optional[Callable[[Any], None]]):
+    """Let a slow client catch up, if the callback supports it - see `astream_callback`."""
+    drain = getattr(callback, "drain", None)
+    if inspect.iscoroutinefunction(drain):
+        await drain()
+
+
+async def arun_query(
+    session_id: str,
+    query: str,
+    history: list[Message] | None,
+    settings: Settings,
+    callback: Optional[Callable[[Any], None]] = None,
+    followups=True,
+    session_token: str | None = None,
+) -> dict[str, str | list[Followup]]:
+    """The async version of `run_query`.
+
+    Provider calls and embeddings use the async clients, so a single event loop can serve many
+    requests at once. The blocking bits (index lookups, followups and the database write) are
+    run in worker threads, so `callback` can be called from other threads.
+
+    Cancelling the task is the equivalent of setting `cancel` in `run_query` - the provider stream
+    is closed, and the partial response is logged as cancelled. If `callback` has a `drain` method
+    (see `astream_callback`), it's awaited after every chunk, so a slow client holds the stream back.
+    """
+    # Loading the conversation might need the database
+    conversation, session_token, callbacks = await asyncio.to_thread(
+        start_session, session_id, query, history, session_token, callback
+    )
+    history = list(conversation.messages)
+
+    query_followups = start_followups(query) if followups else None
 
     response = ""
-    for chunk in query_llm(prompted_history, settings):
-        chunk_type, text = chunk.get("type"), chunk.get("text")
-        if chunk_type == "thinking":
-            for call in callbacks:
-                call.on_thinking(text)
-        elif chunk_type == "response":
-            response += text
+    try:
+        docs_settings = settings.docs_settings
+        if settings.enable_hyde:
+            docs = await aretrieve_with_hyde(query, history, docs_settings, callbacks)
+        else:
+            docs = blocks_from_matches(fuse_results(await asearch_queries_cached([query], docs_settings)))
+        prompted_history = build_prompt(session_id, query, history, docs, settings, callbacks, conversation.counts)
+
+        for call in callbacks:
+            call.on_llm_start()
+
+        # Closing the chunks generator closes the provider stream, also when this task is cancelled
+        async with aclosing(await aquery_llm(prompted_history, settings)) as chunks:
+            async for chunk in chunks:
+                response += handle_chunk(chunk, callbacks)
+                await wait_for_client(callback)
+    except asyncio.CancelledError:
+        logger.info("Client disconnected, stopped generating after %s characters", len(response))
+        if query_followups:
+            query_followups.cancel()
+
+        def log_cancelled():
             for call in callbacks:
-                call.on_response(text)
+                call.on_llm_end(response, cancelled=True)
 
+        # This task is being cancelled, so it can't wait for the database write
+        asyncio.get_running_loop().run_in_executor(None, log_cancelled)
+        raise
+
+    # The logger writes the interaction to the database
     for call in callbacks:
-        call.on_llm_end(response)
+        await asyncio.to_thread(call.on_llm_end, response)
+    finish_turn(session_id, conversation, query, response, settings, session_token)
 
     follows = []
     if followups:
-        follows = search_followups(query, response, callbacks)
-
-    print("result", response)
+        follows = await asyncio.to_thread(search_followups, query, response, callbacks, query_followups)
 
     if callback:
         callback({"state": "done"})
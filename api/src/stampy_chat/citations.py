@@ -1,20 +1,28 @@
-from typing import TypedDict, Literal
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Sequence, TypedDict, Literal
 import re
 import urllib.parse
 
-from stampy_chat.settings import Settings
-from pinecone import Pinecone
-import voyageai
+from stampy_chat.settings import Settings, make_settings
+from stampy_chat.clients import async_voyage_client, voyage_client
+from stampy_chat.embedding_cache import embedding_cache
 from stampy_chat.env import (
-    VOYAGEAI_API_KEY,
+    VECTOR_BACKEND,
     VOYAGEAI_EMBEDDINGS_MODEL,
-    PINECONE_NAMESPACE,
-    PINECONE_API_KEY,
-    PINECONE_ENVIRONMENT,
-    PINECONE_INDEX_NAME,
+    RETRIEVAL_WORKERS,
 )
+from stampy_chat.metrics import EMBEDDING_SECONDS, VECTOR_SEARCH_SECONDS
+from stampy_chat.vector_index import Match, vector_index
 from datetime import datetime, date
 
+# The constant used for reciprocal rank fusion - 60 is the value from the original paper
+RRF_K = 60
+TOP_K = 50
+
+# Used to query the vector index for multiple query variants at once
+executor = ThreadPoolExecutor(max_workers=RETRIEVAL_WORKERS, thread_name_prefix="retrieval")
+
 
 class Message(TypedDict):
     role: Literal["user", "assistant", "system", "deleted", "error"]
@@ -32,20 +40,75 @@ class Block(TypedDict):
     text: str
 
 
+def embedding_input_type() -> str | None:
+    return "query" if VOYAGEAI_EMBEDDINGS_MODEL == "voyage-context-3" else None
+
+
+def cached_embeddings(queries: Sequence[str]) -> list[list[float] | None]:
+    if embedding_cache:
+        return embedding_cache.get_many(VOYAGEAI_EMBEDDINGS_MODEL, embedding_input_type(), queries)
+    return [None] * len(queries)
+
+
+def store_embeddings(embeddings: list, missing: list[int], texts: Sequence[str], new_embeddings: Sequence):
+    if embedding_cache:
+        embedding_cache.put_many(VOYAGEAI_EMBEDDINGS_MODEL, embedding_input_type(), texts, new_embeddings)
+    for i, embedding in zip(missing, new_embeddings):
+        embeddings[i] = embedding
+
+
+def embed_queries(queries: Sequence[str], settings: Settings) -> list[list[float] | list[int]]:
+    """Embed all the provided queries with a single API call, skipping any that are already cached."""
+    embeddings = cached_embeddings(queries)
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    if not missing:
+        return embeddings
+
+    voyageai_client = voyage_client()
+    texts = [queries[i] for i in missing]
+    with EMBEDDING_SECONDS.time(model=VOYAGEAI_EMBEDDINGS_MODEL, provider="voyageai"):
+        if VOYAGEAI_EMBEDDINGS_MODEL == "voyage-context-3":
+            # voyage-context-3 requires contextualized API with single-chunk documents
+            result = voyageai_client.contextualized_embed(
+                inputs=[[text] for text in texts],
+                model=VOYAGEAI_EMBEDDINGS_MODEL,
+                input_type=embedding_input_type(),
+            )
+            new_embeddings = [item.embeddings[0] for item in result.results]
+        else:
+            new_embeddings = voyageai_client.embed(texts, model=VOYAGEAI_EMBEDDINGS_MODEL).embeddings
+
+    store_embeddings(embeddings, missing, texts, new_embeddings)
+    return embeddings
+
+
+async def aembed_queries(queries: Sequence[str], settings: Settings) -> list[list[float] | list[int]]:
+    """The async version of `embed_queries`."""
+    embeddings = cached_embeddings(queries)
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    if not missing:
+        return embeddings
+
+    voyageai_client = async_voyage_client()
+    texts = [queries[i] for i in missing]
+    with EMBEDDING_SECONDS.time(model=VOYAGEAI_EMBEDDINGS_MODEL, provider="voyageai"):
+        if VOYAGEAI_EMBEDDINGS_MODEL == "voyage-context-3":
+            result = await voyageai_client.contextualized_embed(
+                inputs=[[text] for text in texts],
+                model=VOYAGEAI_EMBEDDINGS_MODEL,
+                input_type=embedding_input_type(),
+            )
+            new_embeddings = [item.embeddings[0] for item in result.results]
+        else:
+            new_embeddings = (await voyageai_client.embed(texts, model=VOYAGEAI_EMBEDDINGS_MODEL)).embeddings
+
+    store_embeddings(embeddings, missing, texts, new_embeddings)
+    return embeddings
+
+
 def embed_query(query: str, settings: Settings) -> list[float] | list[int]:
     """Embed the query."""
-    voyageai_client = voyageai.Client(api_key=VOYAGEAI_API_KEY)
-
-    if VOYAGEAI_EMBEDDINGS_MODEL == "voyage-context-3":
-        # voyage-context-3 requires contextualized API with single-chunk documents
-        result = voyageai_client.contextualized_embed(
-            inputs=[[query]],
-            model=VOYAGEAI_EMBEDDINGS_MODEL,
-            input_type="query",
-        )
-        return result.results[0].embeddings[0]
-    else:
-        return voyageai_client.embed([query], model=VOYAGEAI_EMBEDDINGS_MODEL).embeddings[0]
+    return embed_queries([query], settings)[0]
 
 
 def clean_block(reference: int, block) -> Block:
@@ -95,29 +158,58 @@ def set_text_fragment(url, text, max_length=24):
     return urllib.parse.urlunparse(parsed._replace(fragment=fragment))
 
 
-def retrieve_docs(query: str, settings: Settings, filter: dict | None = None, snippets_per_doc: int = 1) -> list[Block]:
-    """Retrieve the documents for the query, keeping up to snippets_per_doc chunks per document."""
-    pc = Pinecone(
-        api_key=PINECONE_API_KEY,
-        environment=PINECONE_ENVIRONMENT,
-    )
-
-    index = pc.Index(PINECONE_INDEX_NAME)
+def search_vector(vector: list[float] | list[int], query_filter: dict) -> list[Match]:
+    """Return the matches for the given vector from the configured index, best first."""
+    with VECTOR_SEARCH_SECONDS.time(backend=VECTOR_BACKEND):
+        return vector_index().query(vector, TOP_K, query_filter)
 
-    vector = embed_query(query, settings)
 
+def search_queries(queries: Sequence[str], settings: Settings, filter: dict | None = None) -> list[list[Match]]:
+    """Embed all the queries in one go, and then fetch the matches for each of them concurrently."""
     # Use custom filter if provided, otherwise use settings filters
     query_filter = filter if filter is not None else settings.miri_filters
 
-    results = index.query_namespaces(
-        vector=list(vector),
-        metric="cosine",
-        top_k=50,
-        include_metadata=True,
-        namespaces=[PINECONE_NAMESPACE],
-        filter=query_filter,
+    vectors = embed_queries(queries, settings)
+    if len(vectors) == 1:
+        return [search_vector(vectors[0], query_filter)]
+    return list(executor.map(lambda vector: search_vector(vector, query_filter), vectors))
+
+
+async def asearch_queries(
+    queries: Sequence[str], settings: Settings, filter: dict | None = None
+) -> list[list[Match]]:
+    """The async version of `search_queries`. The index lookups still block, so they're run in the retrieval threads."""
+    query_filter = filter if filter is not None else settings.miri_filters
+
+    vectors = await aembed_queries(queries, settings)
+    loop = asyncio.get_running_loop()
+    return list(
+        await asyncio.gather(*(loop.run_in_executor(executor, search_vector, vector, query_filter) for vector in vectors))
     )
 
+
+def fuse_results(results: Sequence[Sequence[Match]], k: int = RRF_K) -> list[tuple[float, Match]]:
+    """Merge multiple lists of matches with reciprocal rank fusion.
+
+    Each match gets a score of `sum(1 / (k + rank))` over all the lists it's in, so things that
+    rank well for multiple queries get boosted. A single list keeps its original scores.
+
+    :returns: a list of `(score, match)` tuples, sorted by score, best first
+    """
+    if len(results) == 1:
+        return [(match.score, match) for match in results[0]]
+
+    scores: dict[str, float] = {}
+    matches: dict[str, Match] = {}
+    for result in results:
+        for rank, match in enumerate(result, start=1):
+            scores[match.id] = scores.get(match.id, 0) + 1 / (k + rank)
+            matches.setdefault(match.id, match)
+    return sorted(((scores[i], matches[i]) for i in scores), key=lambda x: x[0], reverse=True)
+
+
+def blocks_from_matches(scored_matches: Sequence[tuple[float, Match]], snippets_per_doc: int = 1) -> list[Block]:
+    """Convert the `(score, match)` tuples into blocks, keeping up to snippets_per_doc chunks per document."""
     # Track chunks per document, deduplicating by title and URL separately
     # seen_docs: key -> list of (score, match) tuples, sorted by score desc
     seen_docs = {}  # key: normalized_key, value: list[(score, match)]
@@ -126,7 +218,7 @@ def retrieve_docs(query: str, settings: Settings, filter: dict | None = None, sn
     seen_urls = {}   # base_url -> normalized_key
     reference_counter = 1
 
-    for match in results.matches:
+    for score, match in scored_matches:
         metadata = match.metadata
         title = metadata.get("title", "").strip()
         url = metadata.get("url", "")
@@ -135,8 +227,6 @@ def retrieve_docs(query: str, settings: Settings, filter: dict | None = None, sn
         parsed_url = urllib.parse.urlparse(url)
         base_url = urllib.parse.urlunparse(parsed_url._replace(fragment=""))
 
-        score = match.score
-
         # Check if we've seen this document before (by title or URL)
         doc_key = None
         if title and title in seen_titles:
@@ -170,8 +260,21 @@ def retrieve_docs(query: str, settings: Settings, filter: dict | None = None, sn
     return [clean_block(ref_num, match.metadata) for _, match, ref_num in all_chunks]
 
 
+def retrieve_docs_multi(
+    queries: Sequence[str], settings: Settings, filter: dict | None = None, snippets_per_doc: int = 1
+) -> list[Block]:
+    """Retrieve the documents for all the query variants, fusing the results into one ranking."""
+    results = search_queries(queries, settings, filter)
+    return blocks_from_matches(fuse_results(results), snippets_per_doc)
+
+
+def retrieve_docs(query: str, settings: Settings, filter: dict | None = None, snippets_per_doc: int = 1) -> list[Block]:
+    """Retrieve the documents for the query, keeping up to snippets_per_doc chunks per document."""
+    return retrieve_docs_multi([query], settings, filter, snippets_per_doc)
+
+
 def get_top_k_blocks(query: str, k: int, filter: dict | None = None, snippets_per_doc: int = 1) -> list[Block]:
-    return retrieve_docs(query, Settings(), filter, snippets_per_doc)[:k]
+    return retrieve_docs(query, make_settings(), filter, snippets_per_doc)[:k]
 
 def fix_text(received_text: str|None) -> str|None:
     """
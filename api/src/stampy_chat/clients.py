@@ -0,0 +1,212 @@
+"""Process-wide pooled provider clients.
+
+Creating an SDK client also creates a new HTTP connection pool, so building one per call means a
+fresh TCP + TLS handshake before the first token can arrive. Instead, a single keep-alive client is
+created per provider/base URL per process and shared between all request threads (the underlying
+httpx clients are thread safe).
+
+Connection pools must not be shared across a fork, so the registry is emptied in any child
+process - gunicorn workers will lazily build their own clients on first use.
+
+The async clients used by the ASGI app are kept per event loop, as their connection pools are
+bound to the loop they were created in.
+"""
+import asyncio
+import os
+import threading
+import weakref
+from typing import Any, Callable, Hashable
+
+import anthropic
+import httpx
+import openai
+import voyageai
+from google import genai
+
+from stampy_chat.env import (
+    ANTHROPIC_API_KEY,
+    FOLLOWUPS_CONNECT_TIMEOUT,
+    FOLLOWUPS_TIMEOUT,
+    FOLLOWUPS_WORKERS,
+    GOOGLE_API_KEY,
+    HUMAN_CONNECT_TIMEOUT,
+    HUMAN_TIMEOUT,
+    HUMAN_WORKERS,
+    LLM_CONNECT_TIMEOUT,
+    LLM_KEEPALIVE_CONNECTIONS,
+    LLM_KEEPALIVE_EXPIRY,
+    LLM_MAX_CONNECTIONS,
+    LLM_MAX_RETRIES,
+    LLM_TIMEOUT,
+    OPENAI_API_KEY,
+    OPENROUTER_API_KEY,
+    VOYAGEAI_API_KEY,
+)
+
+OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
+
+_clients: dict[Hashable, Any] = {}
+_lock = threading.Lock()
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict[Hashable, Any]]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def pool_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=LLM_MAX_CONNECTIONS,
+        max_keepalive_connections=LLM_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+    )
+
+
+def pool_timeout() -> httpx.Timeout:
+    return httpx.Timeout(LLM_TIMEOUT, connect=LLM_CONNECT_TIMEOUT)
+
+
+def get_client(key: Hashable, factory: Callable[[], Any]) -> Any:
+    """Return the shared client for `key`, creating it with `factory` if this is the first use."""
+    if (client := _clients.get(key)) is not None:
+        return client
+
+    with _lock:
+        # Another thread could have created it while we were waiting for the lock
+        if (client := _clients.get(key)) is None:
+            client = _clients[key] = factory()
+    return client
+
+
+def get_async_client(key: Hashable, factory: Callable[[], Any]) -> Any:
+    """Return the shared async client for `key` in the running event loop, creating it if needed."""
+    # Each loop only runs in one thread, so no need for locks here
+    clients = _async_clients.setdefault(asyncio.get_running_loop(), {})
+    if (client := clients.get(key)) is None:
+        client = clients[key] = factory()
+    return client
+
+
+def reset_clients() -> None:
+    """Forget all pooled clients, e.g. after a fork. New ones will be created on demand."""
+    global _lock
+    _clients.clear()
+    _async_clients.clear()
+    # The lock could have been held by another thread at the moment of forking
+    _lock = threading.Lock()
+
+
+def anthropic_client() -> anthropic.Anthropic:
+    return get_client(
+        ("anthropic", None),
+        lambda: anthropic.Anthropic(
+            api_key=ANTHROPIC_API_KEY,
+            max_retries=LLM_MAX_RETRIES,
+            timeout=pool_timeout(),
+            http_client=anthropic.DefaultHttpxClient(limits=pool_limits(), timeout=pool_timeout()),
+        ),
+    )
+
+
+def openai_client(base_url: str | None = None, api_key: str | None = OPENAI_API_KEY) -> openai.OpenAI:
+    return get_client(
+        ("openai", base_url),
+        lambda: openai.OpenAI(
+            base_url=base_url,
+            api_key=api_key,
+            max_retries=LLM_MAX_RETRIES,
+            timeout=pool_timeout(),
+            http_client=openai.DefaultHttpxClient(limits=pool_limits(), timeout=pool_timeout()),
+        ),
+    )
+
+
+def openrouter_client() -> openai.OpenAI:
+    return openai_client(base_url=OPENROUTER_BASE_URL, api_key=OPENROUTER_API_KEY)
+
+
+def google_client() -> genai.Client:
+    return get_client(
+        ("google", None),
+        lambda: genai.Client(
+            api_key=GOOGLE_API_KEY,
+            http_options=genai.types.HttpOptions(
+                timeout=int(LLM_TIMEOUT * 1000),  # Gemini wants milliseconds
+                client_args={"limits": pool_limits()},
+            ),
+        ),
+    )
+
+
+def voyage_client() -> voyageai.Client:
+    return get_client(("voyageai", None), lambda: voyageai.Client(api_key=VOYAGEAI_API_KEY))
+
+
+def followups_client() -> httpx.Client:
+    return get_client(
+        ("followups", None),
+        lambda: httpx.Client(
+            timeout=httpx.Timeout(FOLLOWUPS_TIMEOUT, connect=FOLLOWUPS_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=FOLLOWUPS_WORKERS * 2, max_keepalive_connections=FOLLOWUPS_WORKERS),
+        ),
+    )
+
+
+def human_content_client() -> httpx.Client:
+    return get_client(
+        ("human", None),
+        lambda: httpx.Client(
+            timeout=httpx.Timeout(HUMAN_TIMEOUT, connect=HUMAN_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=HUMAN_WORKERS * 4, max_keepalive_connections=HUMAN_WORKERS * 2),
+            follow_redirects=True,
+        ),
+    )
+
+
+def async_anthropic_client() -> anthropic.AsyncAnthropic:
+    return get_async_client(
+        ("anthropic", None),
+        lambda: anthropic.AsyncAnthropic(
+            api_key=ANTHROPIC_API_KEY,
+            max_retries=LLM_MAX_RETRIES,
+            timeout=pool_timeout(),
+            http_client=anthropic.DefaultAsyncHttpxClient(limits=pool_limits(), timeout=pool_timeout()),
+        ),
+    )
+
+
+def async_openai_client(base_url: str | None = None, api_key: str | None = OPENAI_API_KEY) -> openai.AsyncOpenAI:
+    return get_async_client(
+        ("openai", base_url),
+        lambda: openai.AsyncOpenAI(
+            base_url=base_url,
+            api_key=api_key,
+            max_retries=LLM_MAX_RETRIES,
+            timeout=pool_timeout(),
+            http_client=openai.DefaultAsyncHttpxClient(limits=pool_limits(), timeout=pool_timeout()),
+        ),
+    )
+
+
+def async_openrouter_client() -> openai.AsyncOpenAI:
+    return async_openai_client(base_url=OPENROUTER_BASE_URL, api_key=OPENROUTER_API_KEY)
+
+
+def async_google_client():
+    """The async interface (`client.aio`) of a Gemini client."""
+    return get_async_client(
+        ("google", None),
+        lambda: genai.Client(
+            api_key=GOOGLE_API_KEY,
+            http_options=genai.types.HttpOptions(
+                timeout=int(LLM_TIMEOUT * 1000),
+                async_client_args={"limits": pool_limits()},
+            ),
+        ).aio,
+    )
+
+
+def async_voyage_client() -> voyageai.AsyncClient:
+    return get_async_client(("voyageai", None), lambda: voyageai.AsyncClient(api_key=VOYAGEAI_API_KEY))
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_clients)
@@ -4,7 +4,7 @@ from datetime import datetime
 from typing import Optional
 
 from sqlalchemy import (
-    BINARY, JSON, DateTime, Integer, String, and_, func, select
+    BINARY, CHAR, JSON, Boolean, DateTime, Index, Integer, String, and_, false, func, select
 )
 from sqlalchemy.dialects.mysql import LONGTEXT
 from sqlalchemy.ext.hybrid import hybrid_property
@@ -40,6 +40,8 @@ class Base(DeclarativeBase):
 
 class Interaction(Base):
     __tablename__ = "interactions"
+    # Conversations are looked up (and rebuilt) by session
+    __table_args__ = (Index("interactions_session_id", "session_id", "interaction_no"),)
 
     id: Mapped[int] = mapped_column("id", primary_key=True)
 
@@ -53,9 +55,13 @@ class Interaction(Base):
     # The actual query provided by the user
     query: Mapped[str] = mapped_column(String(1028))
 
-    # The full prompt as sent to the LLM
+    # The full prompt as sent to the LLM. Only set on old interactions - see `prompt_segments`
     prompt: Mapped[Optional[str]] = mapped_column(LONGTEXT)
 
+    # The messages sent to the LLM, with any large chunks of text replaced by references to `PromptBlob`s.
+    # Use `stampy_chat.prompt_store.load_prompt` to get the full prompt back
+    prompt_segments: Mapped[Optional[JSON]] = mapped_column(JSON)
+
     # Whatever the LLM returns
     response: Mapped[Optional[str]] = mapped_column(LONGTEXT)
 
@@ -66,6 +72,9 @@ class Interaction(Base):
     # Any moderation data
     moderation: Mapped[Optional[JSON]] = mapped_column(JSON, default="{}")
 
+    # Whether the client went away before the response was finished, in which case `response` is partial
+    cancelled: Mapped[bool] = mapped_column(Boolean, default=False, server_default=false())
+
     @hybrid_property
     def history(self):
         return Session.object_session(self).query(Interaction).filter(
@@ -92,6 +101,22 @@ class Interaction(Base):
         return f"Interaction(session={self.session_id!r}, no={self.interaction_no!r}, query={self.query!r}, response={self.response!r})"
 
 
+class PromptBlob(Base):
+    __tablename__ = "prompt_blobs"
+    # The same blob will be added by many interactions, so existing ones are ignored when inserting
+    __insert_ignore__ = True
+
+    # The sha256 of the contents
+    hash: Mapped[str] = mapped_column(CHAR(64), primary_key=True)
+
+    content: Mapped[str] = mapped_column(LONGTEXT)
+
+    date_created: Mapped[datetime] = mapped_column(DateTime, default=func.now())
+
+    def __repr__(self) -> str:
+        return f"PromptBlob(hash={self.hash!r})"
+
+
 class Rating(Base):
     __tablename__ = "ratings"
 
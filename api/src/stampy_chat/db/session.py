@@ -1,10 +1,26 @@
+import atexit
+import os
+import signal
+import threading
 import time
 import logging
 from contextlib import contextmanager
-from sqlalchemy import create_engine
+from queue import Empty, Full, Queue
+from typing import Any, Callable
+
+from sqlalchemy import create_engine, insert, inspect
 from sqlalchemy.orm import Session
-from sqlalchemy.exc import SQLAlchemyError
-from stampy_chat.env import DB_CONNECTION_URI
+from sqlalchemy.exc import InterfaceError, OperationalError, SQLAlchemyError
+from tenacity import Retrying, retry_if_exception, stop_after_attempt, wait_exponential
+
+from stampy_chat.metrics import DB_WRITE_LAG_SECONDS, Gauge
+from stampy_chat.env import (
+    DB_CONNECTION_URI,
+    DB_WRITER_EXIT_TIMEOUT,
+    DB_WRITER_LAG_WARNING,
+    DB_WRITER_QUEUE_SIZE,
+    DB_WRITER_RETRIES,
+)
 
 
 logger = logging.getLogger(__name__)
@@ -12,6 +28,9 @@ logger = logging.getLogger(__name__)
 # We create a single engine for the entire application
 engine = create_engine(DB_CONNECTION_URI, echo=False)
 
+# MySQL errors that are worth retrying: lock wait timeout, deadlock, server gone away, lost connection
+TRANSIENT_MYSQL_ERRORS = {1205, 1213, 2006, 2013}
+
 
 @contextmanager
 def make_session(auto_commit=False):
@@ -21,50 +40,219 @@ def make_session(auto_commit=False):
             session.commit()
 
 
+def is_transient(error: BaseException) -> bool:
+    """Whether the error is worth retrying, e.g. a dropped connection or a deadlock."""
+    if isinstance(error, (OperationalError, InterfaceError)) or getattr(error, "connection_invalidated", False):
+        return True
+    return getattr(getattr(error, "orig", None), "errno", None) in TRANSIENT_MYSQL_ERRORS
+
+
+def as_row(item) -> dict:
+    """The column values that were set on the ORM object, for a bulk insert."""
+    state = inspect(item)
+    return {attr.key: getattr(item, attr.key) for attr in state.mapper.column_attrs if attr.key in state.dict}
+
+
 class ItemAdder:
-    """A helper class to manage adding and flushing items to the database.
+    """A helper class to write items to the database in the background.
+
+    This class exposes an `add(*items)` method which puts the provided items on a bounded queue
+    and returns straight away. A dedicated writer thread takes them off the queue and inserts them
+    in batches with `executemany`, retrying transient errors with exponential backoff. If the
+    queue is full (e.g. the database is down), new items are dropped rather than blocking requests.
 
-    This class exposes an `add(*items)` method which will add any provided items to the
-    session, and if needed commit it. It will also handle rollbacks if an error occurs
-    while writing.
+    Commits happen whenever `batch_size` items are waiting, or `save_every` seconds have passed
+    since the oldest one was added - whichever is first. Anything still queued is written when
+    the process exits (including on SIGTERM).
 
-    Commits happen whenever more than `batch_size` items have been added since the last
-    commit, or more than `save_every` seconds have passed - whichever is first.
+    Functions added to `on_written` are called (on the writer thread) with the items of every
+    batch that was committed.
     """
 
-    def __init__(self, engine=None, batch_size=100, save_every=1):
+    def __init__(
+        self,
+        engine=None,
+        batch_size=100,
+        save_every=1,
+        max_queue=DB_WRITER_QUEUE_SIZE,
+        max_retries=DB_WRITER_RETRIES,
+    ):
         """Initialise the adder.
 
         :param sqlalchemy.Engine engine: The engine to be used for connections. Will create one if not provided
-        :param int batch_size: will commit the session once this many items have been added
-        :param int save_every: will commit the session if this many seconds have passed since the last addition
+        :param int batch_size: will commit once this many items are waiting
+        :param int save_every: will commit once the oldest waiting item is this many seconds old
+        :param int max_queue: how many items can be waiting before new ones are dropped
+        :param int max_retries: how many times to try writing a batch before giving up on it
         """
         self.engine = engine or create_engine(DB_CONNECTION_URI, echo=False)
         self.batch_size = batch_size
         self.save_every = save_every
-        self.batch = []
+        self.max_retries = max_retries
+        self.queue: Queue = Queue(maxsize=max_queue)
+        self.on_written: list[Callable[[list], None]] = []
+
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.retries = 0
+        # How long the items of the last batch were waiting before being committed
+        self.lag = 0.0
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def _ensure_thread(self):
+        # Threads don't survive a fork, so each (gunicorn worker) process needs its own
+        if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+                    self._pid = os.getpid()
+                    self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+                    self._thread.start()
+
+    def add(self, *items):
+        """Queue the provided items to be written to the database."""
+        self._ensure_thread()
+        for item in items:
+            try:
+                self.queue.put_nowait((time.monotonic(), item))
+            except Full:
+                with self._lock:
+                    self.dropped += 1
+                logger.warning('Database writer queue is full, dropped %s', item)
+
+    def _next_batch(self) -> tuple[list, list[threading.Event]]:
+        """Wait for the next batch of items, along with anyone waiting for them to be flushed."""
+        items, waiters = [], []
+        deadline = None
+        while len(items) < self.batch_size:
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            try:
+                added, item = self.queue.get(timeout=timeout)
+            except Empty:
+                break
+            if isinstance(item, threading.Event):
+                # A flush was requested - write whatever we have straight away
+                waiters.append(item)
+                break
+            items.append((added, item))
+            if deadline is None:
+                deadline = added + self.save_every
+        return items, waiters
+
+    def _run(self):
+        while True:
+            items, waiters = self._next_batch()
+            if items:
+                self.commit(items)
+            for waiter in waiters:
+                waiter.set()
+
+    def write(self, items: list):
+        """Insert the items, with one `executemany` per table.
 
-        self.session = Session(self.engine)
-        self._last_save = time.time()
+        Models with `__insert_ignore__` set are content addressed, so rows that already exist are skipped.
+        """
+        rows: dict[type, list[dict]] = {}
+        for item in items:
+            rows.setdefault(type(item), []).append(as_row(item))
+        with Session(self.engine) as session:
+            for model, values in rows.items():
+                stmt = insert(model)
+                if getattr(model, "__insert_ignore__", False):
+                    stmt = stmt.prefix_with("IGNORE", dialect="mysql").prefix_with("OR IGNORE", dialect="sqlite")
+                session.execute(stmt, values)
+            session.commit()
+
+    def commit(self, items: list[tuple[float, Any]]):
+        def retrying(state):
+            with self._lock:
+                self.retries += 1
+            logger.warning('Retrying database write after error: %s', state.outcome.exception())
 
-    def commit(self):
         try:
-            with Session(self.engine) as session:
-                session.add_all(self.batch)
-                session.commit()
-                logger.debug('added %s items', len(self.batch))
-            self.batch = []
-            self._last_save = time.time()
+            Retrying(
+                retry=retry_if_exception(is_transient),
+                wait=wait_exponential(multiplier=0.5, max=30),
+                stop=stop_after_attempt(self.max_retries),
+                before_sleep=retrying,
+                reraise=True,
+            )(self.write, [item for _, item in items])
         except SQLAlchemyError as e:
-            logger.warn('Got error when trying to commit to database: %s', e)
+            with self._lock:
+                self.failed += len(items)
+            logger.error('Could not write %s items to the database: %s', len(items), e)
+            return
 
-    def add(self, *items):
-        """Add the provided items to the database, commiting them if needed."""
-        self.batch += items
+        now = time.monotonic()
+        with self._lock:
+            self.written += len(items)
+            self.lag = now - items[0][0]
+        for added, _ in items:
+            DB_WRITE_LAG_SECONDS.observe(now - added)
+        logger.debug('added %s items', len(items))
+        for callback in self.on_written:
+            try:
+                callback([item for _, item in items])
+            except Exception as e:
+                logger.error('Error in callback after writing items: %s', e)
+        if self.lag > DB_WRITER_LAG_WARNING:
+            logger.warning('Database writes are lagging by %.1fs', self.lag)
+
+    def flush(self, timeout: float | None = None) -> bool:
+        """Wait until everything added so far has been written, returning whether that happened in time."""
+        if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+            return self.queue.empty()
+        done = threading.Event()
+        try:
+            self.queue.put((time.monotonic(), done), timeout=timeout)
+        except Full:
+            return False
+        return done.wait(timeout)
+
+    def stats(self) -> dict[str, int | float]:
+        with self._lock:
+            return {
+                "queued": self.queue.qsize(),
+                "written": self.written,
+                "dropped": self.dropped,
+                "failed": self.failed,
+                "retries": self.retries,
+                "lag": self.lag,
+            }
+
+
+# Shared by all loggers, so there's only one writer thread per process
+item_adder = ItemAdder()
+Gauge(
+    "stampy_chat_db_writer_queue_depth",
+    "How many items are waiting to be written to the database",
+    function=item_adder.queue.qsize,
+)
+
+
+def flush_on_exit():
+    if not item_adder.flush(timeout=DB_WRITER_EXIT_TIMEOUT):
+        logger.error('Could not write all items to the database before exiting: %s', item_adder.stats())
+
+
+def install_sigterm_handler():
+    """Flush the writer on SIGTERM, before passing it on to whatever was handling it already."""
+    if threading.current_thread() is not threading.main_thread():
+        return
+    previous = signal.getsignal(signal.SIGTERM)
+
+    def handler(signum, frame):
+        flush_on_exit()
+        if callable(previous):
+            previous(signum, frame)
+        else:
+            signal.signal(signum, signal.SIG_DFL)
+            os.kill(os.getpid(), signum)
+
+    signal.signal(signal.SIGTERM, handler)
 
-        if (len(self.batch) > self.batch_size) or time.time() - self._last_save > self.save_every:
-            self.commit()
 
-    def __del__(self):
-        logger.debug('cleaning up session')
-        self.commit()
+atexit.register(flush_on_exit)
+install_sigterm_handler()
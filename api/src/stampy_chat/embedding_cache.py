@@ -0,0 +1,198 @@
+"""An on-disk cache of query embeddings, shared by all the workers on a host.
+
+Embeddings are keyed by the model, input type and (whitespace normalized) text, and stored in a
+SQLite database as compact float32 or int8 vectors. SQLite handles the locking between processes,
+so every gunicorn worker can read what the others have computed, and the cache survives restarts.
+
+Any problems with the database are logged and treated as cache misses - the cache must never
+break retrieval.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Literal, Sequence
+
+import numpy as np
+
+from stampy_chat import logging
+from stampy_chat.env import EMBEDDING_CACHE_DTYPE, EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_SIZE
+
+logger = logging.getLogger(__name__)
+
+Dtype = Literal["float32", "int8"]
+Vector = list[float]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS embeddings (
+    key BLOB PRIMARY KEY,
+    dtype TEXT NOT NULL,
+    scale REAL NOT NULL,
+    vector BLOB NOT NULL,
+    last_used REAL NOT NULL
+)
+"""
+
+
+def normalize(text: str) -> str:
+    return " ".join(text.split())
+
+
+def cache_key(model: str, input_type: str | None, text: str) -> bytes:
+    return hashlib.sha256(f"{model}\0{input_type or ''}\0{normalize(text)}".encode("utf-8")).digest()
+
+
+def encode(vector: Sequence[float], dtype: Dtype) -> tuple[float, bytes]:
+    """Encode the vector as bytes, returning the scale needed to decode it."""
+    array = np.asarray(vector, dtype=np.float32)
+    if dtype == "int8":
+        scale = float(np.abs(array).max()) / 127 or 1.0
+        return scale, np.round(array / scale).astype(np.int8).tobytes()
+    return 1.0, array.tobytes()
+
+
+def decode(dtype: Dtype, scale: float, data: bytes) -> Vector:
+    if dtype == "int8":
+        return (np.frombuffer(data, dtype=np.int8).astype(np.float32) * scale).tolist()
+    return np.frombuffer(data, dtype=np.float32).tolist()
+
+
+class EmbeddingCache:
+    """A size bounded, least recently used cache of embeddings in a SQLite database.
+
+    :param str path: the SQLite file to use. All processes using the same file share the cache
+    :param int max_entries: how many embeddings to keep - the least recently used ones are evicted
+    :param str dtype: how to store new vectors - `int8` is 4 times smaller, but lossy
+    :param int prune_every: how many embeddings each process stores between evictions, as counting the
+      entries means scanning the table. The cache can go over `max_entries` by this much per process.
+      By default 1% of `max_entries`
+    """
+
+    def __init__(
+        self, path: str, max_entries: int = 100_000, dtype: Dtype = "float32", prune_every: int | None = None
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self.dtype = dtype
+        self.prune_every = prune_every or max(1, max_entries // 100)
+        self._since_prune = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.errors = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        # SQLite connections can't be shared between threads or across forks
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(SCHEMA)
+            conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _count(self, hits=0, misses=0, evictions=0, errors=0):
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+            self.evictions += evictions
+            self.errors += errors
+
+    def get_many(self, model: str, input_type: str | None, texts: Sequence[str]) -> list[Vector | None]:
+        """Return the cached embeddings of `texts`, with `None` for any that aren't cached."""
+        if not texts:
+            return []
+        keys = [cache_key(model, input_type, text) for text in texts]
+        try:
+            conn = self._connection()
+            rows = conn.execute(
+                f"SELECT key, dtype, scale, vector FROM embeddings WHERE key IN ({','.join('?' * len(keys))})",
+                keys,
+            ).fetchall()
+            if rows:
+                conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                    [(time.time(), row[0]) for row in rows],
+                )
+        except sqlite3.Error as e:
+            logger.warning("Could not read from the embedding cache: %s", e)
+            self._count(misses=len(keys), errors=1)
+            return [None] * len(keys)
+
+        found = {key: decode(dtype, scale, data) for key, dtype, scale, data in rows}
+        results = [found.get(key) for key in keys]
+        hits = sum(result is not None for result in results)
+        self._count(hits=hits, misses=len(keys) - hits)
+        return results
+
+    def put_many(self, model: str, input_type: str | None, texts: Sequence[str], vectors: Sequence[Sequence[float]]):
+        """Store the embeddings of `texts`, evicting the least recently used ones if the cache is full."""
+        now = time.time()
+        rows = [
+            (cache_key(model, input_type, text), self.dtype, *encode(vector, self.dtype), now)
+            for text, vector in zip(texts, vectors)
+        ]
+        try:
+            conn = self._connection()
+            conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, dtype, scale, vector, last_used) VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            if self._should_prune(len(rows)):
+                self.evict(conn)
+        except sqlite3.Error as e:
+            logger.warning("Could not write to the embedding cache: %s", e)
+            self._count(errors=1)
+
+    def _should_prune(self, added: int) -> bool:
+        with self._lock:
+            self._since_prune += added
+            if self._since_prune < self.prune_every:
+                return False
+            self._since_prune = 0
+            return True
+
+    def evict(self, conn: sqlite3.Connection):
+        (count,) = conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        if count <= self.max_entries:
+            return
+        deleted = conn.execute(
+            "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+            (count - self.max_entries,),
+        ).rowcount
+        self._count(evictions=deleted)
+
+    def clear(self):
+        try:
+            self._connection().execute("DELETE FROM embeddings")
+        except sqlite3.Error as e:
+            logger.warning("Could not clear the embedding cache: %s", e)
+
+    def stats(self) -> dict[str, int | str]:
+        """The hit/miss counters of this process, along with the number of entries in the shared cache."""
+        try:
+            (entries,) = self._connection().execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        except sqlite3.Error:
+            entries = -1
+        with self._lock:
+            return {
+                "path": self.path,
+                "entries": entries,
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "errors": self.errors,
+            }
+
+
+# An empty path disables the cache
+embedding_cache = (
+    EmbeddingCache(EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_SIZE, EMBEDDING_CACHE_DTYPE) if EMBEDDING_CACHE_PATH else None
+)
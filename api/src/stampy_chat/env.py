@@ -1,4 +1,6 @@
+import json
 import os
+import tempfile
 
 # import openai
 from pinecone import Pinecone
@@ -17,6 +19,16 @@ FLASK_PORT = int(os.environ.get("FLASK_PORT", "3001"))
 LOG_LEVEL = os.environ.get("LOG_LEVEL", "WARNING").upper()
 DISCORD_LOG_LEVEL = os.environ.get("DISCORD_LOG_LEVEL", "WARNING").upper()
 DISCORD_LOGGING_URL = os.environ.get("LOGGING_URL")
+# Log records are handled in a background thread - if this many are waiting, new ones are dropped
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+# Discord messages are collected for this many seconds, then sent together
+DISCORD_BATCH_WINDOW = float(os.environ.get("DISCORD_BATCH_WINDOW", "5"))
+# The minimum number of seconds between webhook calls (Discord allows ~30 per minute per channel)
+DISCORD_SEND_INTERVAL = float(os.environ.get("DISCORD_SEND_INTERVAL", "2"))
+# How many log messages can be waiting for the next batch - any more are counted and dropped
+DISCORD_MAX_PENDING = int(os.environ.get("DISCORD_MAX_PENDING", "100"))
+# How many webhook calls a single batch can use
+DISCORD_MAX_BATCHES = int(os.environ.get("DISCORD_MAX_BATCHES", "5"))
 
 ### OpenAI ###
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
@@ -26,6 +38,92 @@ OPENROUTER_API_KEY = os.environ.get("OPENROUTER_API_KEY")
 
 SENTRY_API_DSN = os.environ.get("SENTRY_API_DSN")
 
+### LLM connection pools ###
+LLM_MAX_CONNECTIONS = int(os.environ.get("LLM_MAX_CONNECTIONS", "100"))
+LLM_KEEPALIVE_CONNECTIONS = int(os.environ.get("LLM_KEEPALIVE_CONNECTIONS", "20"))
+LLM_KEEPALIVE_EXPIRY = float(os.environ.get("LLM_KEEPALIVE_EXPIRY", "60"))
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", "600"))
+LLM_CONNECT_TIMEOUT = float(os.environ.get("LLM_CONNECT_TIMEOUT", "5"))
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", "2"))
+
+# Mark the static prefix of Anthropic prompts (system prompt, earlier turns) as cacheable
+ANTHROPIC_PROMPT_CACHING = os.environ.get("ANTHROPIC_PROMPT_CACHING", "true").lower() in ("1", "true", "yes")
+
+### LLM routing ###
+# The equivalent models to fall back to (or hedge with) when a model's provider is failing or slow, as
+# JSON - keys can be full model names or providers. The defaults can all answer without thinking, as
+# models that always think can use up small token budgets (e.g. HyDE's) before writing anything
+LLM_FALLBACK_MODELS = json.loads(os.environ.get("LLM_FALLBACK_MODELS", json.dumps({
+    "anthropic": ["openai/gpt-4.1"],
+    "google": ["anthropic/claude-sonnet-4-20250514"],
+    "openai": ["anthropic/claude-sonnet-4-20250514"],
+    "openrouter": ["anthropic/claude-sonnet-4-20250514"],
+})))
+# A provider's circuit breaker opens once this fraction of its calls in the last LLM_BREAKER_WINDOW
+# seconds failed (if there were at least LLM_BREAKER_MIN_CALLS of them)...
+LLM_BREAKER_ERROR_RATE = float(os.environ.get("LLM_BREAKER_ERROR_RATE", "0.5"))
+LLM_BREAKER_WINDOW = float(os.environ.get("LLM_BREAKER_WINDOW", "60"))
+LLM_BREAKER_MIN_CALLS = int(os.environ.get("LLM_BREAKER_MIN_CALLS", "5"))
+# ...and stays open for this many seconds, before letting a probe call through
+LLM_BREAKER_COOLDOWN = float(os.environ.get("LLM_BREAKER_COOLDOWN", "30"))
+# How many recent latencies to keep per provider (and per model, for hedged calls)
+LLM_LATENCY_SAMPLES = int(os.environ.get("LLM_LATENCY_SAMPLES", "200"))
+# Hedged calls (e.g. HyDE) are also sent to the fallback model if the first one takes longer than this
+# percentile of its recent latencies...
+LLM_HEDGE_PERCENTILE = float(os.environ.get("LLM_HEDGE_PERCENTILE", "90"))
+LLM_HEDGE_MIN_SAMPLES = int(os.environ.get("LLM_HEDGE_MIN_SAMPLES", "20"))
+# ...or than this many seconds, until there are LLM_HEDGE_MIN_SAMPLES latencies
+LLM_HEDGE_DELAY = float(os.environ.get("LLM_HEDGE_DELAY", "3"))
+# Threads for hedged calls - 0 means two per RETRIEVAL_WORKERS, so every HyDE call can have its hedge running
+LLM_HEDGE_WORKERS = int(os.environ.get("LLM_HEDGE_WORKERS", "0"))
+
+### Prompts ###
+# How many distinct uploaded prompt sets to keep per process, and how many bytes (of JSON) they can take up in total
+PROMPT_REGISTRY_SIZE = int(os.environ.get("PROMPT_REGISTRY_SIZE", "256"))
+PROMPT_REGISTRY_BYTES = int(os.environ.get("PROMPT_REGISTRY_BYTES", str(32 * 1024 * 1024)))
+# The largest prompt set (in bytes of JSON) that can be uploaded. The default prompts are ~150 KB
+PROMPTS_MAX_BYTES = int(os.environ.get("PROMPTS_MAX_BYTES", str(1024 * 1024)))
+# The tiktoken encoding used to count prompt tokens. None of the providers' tokenizers are public,
+# so this is an approximation, but a much better one than counting characters
+TOKENIZER_ENCODING = os.environ.get("TOKENIZER_ENCODING", "cl100k_base")
+TOKEN_CACHE_BYTES = int(os.environ.get("TOKEN_CACHE_BYTES", str(1024 * 1024)))
+
+### Followups ###
+FOLLOWUPS_WORKERS = int(os.environ.get("FOLLOWUPS_WORKERS", "16"))
+FOLLOWUPS_URL = os.environ.get("FOLLOWUPS_URL", "https://nlp.stampy.ai/api/search")
+# Followups are optional, so a slow search is given up on rather than holding up the end of the answer
+FOLLOWUPS_TIMEOUT = float(os.environ.get("FOLLOWUPS_TIMEOUT", "3"))
+FOLLOWUPS_CONNECT_TIMEOUT = float(os.environ.get("FOLLOWUPS_CONNECT_TIMEOUT", "1"))
+FOLLOWUPS_CACHE_BYTES = int(os.environ.get("FOLLOWUPS_CACHE_BYTES", str(8 * 1024 * 1024)))
+FOLLOWUPS_CACHE_TTL = float(os.environ.get("FOLLOWUPS_CACHE_TTL", "3600"))
+# "remote" to search FOLLOWUPS_URL, or "local" to search an in-process index of the authored questions
+# built with `python -m stampy_chat.followup_index` (falling back to remote until there is one)
+FOLLOWUPS_BACKEND = os.environ.get("FOLLOWUPS_BACKEND", "remote")
+FOLLOWUP_INDEX_PATH = os.environ.get("FOLLOWUP_INDEX_PATH", "followup_index.npz")
+# A JSON (lines) file or URL of {"pageid", "title"} objects to periodically rebuild the local index from
+FOLLOWUP_INDEX_SOURCE = os.environ.get("FOLLOWUP_INDEX_SOURCE", "")
+# How often (in seconds) to check for a new snapshot of the local index, and how old it can get before being rebuilt
+FOLLOWUP_INDEX_REFRESH = float(os.environ.get("FOLLOWUP_INDEX_REFRESH", "3600"))
+# The minimum cosine similarity for a question from the local index to be suggested. This is separate from the
+# remote search's threshold, as embedding similarities between any two English questions are already fairly high
+FOLLOWUP_INDEX_THRESHOLD = float(os.environ.get("FOLLOWUP_INDEX_THRESHOLD", "0.6"))
+
+### aisafety.info content ###
+# The /human/<id> route proxies these pages, to get around CORS
+HUMAN_CONTENT_URL = os.environ.get("HUMAN_CONTENT_URL", "https://aisafety.info/questions/{id}")
+HUMAN_TIMEOUT = float(os.environ.get("HUMAN_TIMEOUT", "10"))
+HUMAN_CONNECT_TIMEOUT = float(os.environ.get("HUMAN_CONNECT_TIMEOUT", "2"))
+# Pages are served from the cache for this many seconds...
+HUMAN_CACHE_TTL = float(os.environ.get("HUMAN_CACHE_TTL", "300"))
+# ...then served stale for this many more while they're revalidated in the background...
+HUMAN_STALE_TTL = float(os.environ.get("HUMAN_STALE_TTL", "3600"))
+# ...and kept for this long in total, to be revalidated with a conditional request (or served if that fails)
+HUMAN_CACHE_KEEP = float(os.environ.get("HUMAN_CACHE_KEEP", "86400"))
+HUMAN_CACHE_BYTES = int(os.environ.get("HUMAN_CACHE_BYTES", str(32 * 1024 * 1024)))
+# Threads for background revalidation and prefetching
+HUMAN_WORKERS = int(os.environ.get("HUMAN_WORKERS", "4"))
+HUMAN_PREFETCH_MAX = int(os.environ.get("HUMAN_PREFETCH_MAX", "50"))
+
 ### Models ###
 SUMMARY_MODEL = os.environ.get("SUMMARY_MODEL", "anthropic/claude-sonnet-4-20250514")
 MODEL = os.environ.get(
@@ -50,6 +148,13 @@ if PINECONE_API_KEY:
 
     PINECONE_INDEX = pc.Index(PINECONE_INDEX_NAME)
 
+### Vector index ###
+# "pinecone", or "local" to search an in-process index built with `python -m stampy_chat.vector_index`
+VECTOR_BACKEND = os.environ.get("VECTOR_BACKEND", "pinecone")
+LOCAL_INDEX_PATH = os.environ.get("LOCAL_INDEX_PATH", "vector_index")
+# How many IVF lists to search in the local index - more is slower, but more accurate
+LOCAL_INDEX_NPROBE = int(os.environ.get("LOCAL_INDEX_NPROBE", "16"))
+
 ### MySQL ###
 user = os.environ.get("CHAT_DB_USER", "user")
 password = os.environ.get("CHAT_DB_PASSWORD", "we all live in a yellow submarine")
@@ -57,6 +162,13 @@ host = os.environ.get("CHAT_DB_HOST", "127.0.0.1")
 port = os.environ.get("CHAT_DB_PORT", "3306")
 db_name = os.environ.get("CHAT_DB_NAME", "stampy_chat")
 DB_CONNECTION_URI = f"mysql+mysqlconnector://{user}:{password}@{host}:{port}/{db_name}"
+# Interactions are written in the background - these many can be waiting before new ones are dropped
+DB_WRITER_QUEUE_SIZE = int(os.environ.get("DB_WRITER_QUEUE_SIZE", "10000"))
+DB_WRITER_RETRIES = int(os.environ.get("DB_WRITER_RETRIES", "5"))
+# Log a warning if items wait longer than this many seconds to be written
+DB_WRITER_LAG_WARNING = float(os.environ.get("DB_WRITER_LAG_WARNING", "30"))
+# How long to wait for pending writes when shutting down
+DB_WRITER_EXIT_TIMEOUT = float(os.environ.get("DB_WRITER_EXIT_TIMEOUT", "10"))
 
 ### Local testing helpers ###
 REMOTE_CHAT_INSTANCE = os.environ.get(
@@ -69,3 +181,64 @@ VOYAGEAI_EMBEDDINGS_MODEL = os.environ.get(
     "VOYAGEAI_EMBEDDINGS_MODEL", "voyage-context-3"
 )
 MAX_EMBEDDING_TOKENS = int(os.environ.get("MAX_EMBEDDING_TOKENS", "120000"))
+# A SQLite file shared by all workers on this host - set to an empty string to disable the cache
+EMBEDDING_CACHE_PATH = os.environ.get(
+    "EMBEDDING_CACHE_PATH", os.path.join(tempfile.gettempdir(), "stampy-chat-embeddings.sqlite3")
+)
+EMBEDDING_CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE", "100000"))
+EMBEDDING_CACHE_DTYPE = os.environ.get("EMBEDDING_CACHE_DTYPE", "float32")  # or "int8"
+
+### Retrieval ###
+RETRIEVAL_WORKERS = int(os.environ.get("RETRIEVAL_WORKERS", "16"))
+# How long to wait for the hypothetical document before retrieving without it
+HYDE_TIMEOUT = float(os.environ.get("HYDE_TIMEOUT", "15"))
+# In-process caches of Pinecone matches and HyDE documents, bounded by memory and expiring after a TTL in seconds
+RETRIEVAL_CACHE_BYTES = int(os.environ.get("RETRIEVAL_CACHE_BYTES", str(64 * 1024 * 1024)))
+RETRIEVAL_CACHE_TTL = float(os.environ.get("RETRIEVAL_CACHE_TTL", "3600"))
+HYDE_CACHE_BYTES = int(os.environ.get("HYDE_CACHE_BYTES", str(8 * 1024 * 1024)))
+HYDE_CACHE_TTL = float(os.environ.get("HYDE_CACHE_TTL", "3600"))
+
+### History summaries ###
+# The model used to summarize the older parts of long conversations. Set to "" to just truncate them
+HISTORY_SUMMARY_MODEL = os.environ.get("HISTORY_SUMMARY_MODEL", "openai/gpt-4.1-mini")
+# How many of the latest messages are always sent as they are, rather than summarized
+HISTORY_RECENT_MESSAGES = int(os.environ.get("HISTORY_RECENT_MESSAGES", "6"))
+HISTORY_SUMMARY_WORKERS = int(os.environ.get("HISTORY_SUMMARY_WORKERS", "4"))
+HISTORY_SUMMARY_CACHE_BYTES = int(os.environ.get("HISTORY_SUMMARY_CACHE_BYTES", str(16 * 1024 * 1024)))
+HISTORY_SUMMARY_TTL = float(os.environ.get("HISTORY_SUMMARY_TTL", str(24 * 60 * 60)))
+
+### Sessions ###
+# Conversations are kept server side, so clients can send just the latest query rather than the whole history
+SESSION_CACHE_BYTES = int(os.environ.get("SESSION_CACHE_BYTES", str(64 * 1024 * 1024)))
+SESSION_TTL = float(os.environ.get("SESSION_TTL", str(24 * 60 * 60)))
+# Whether to rebuild conversations that aren't in memory (e.g. handled by another worker) from the interactions table
+SESSION_LOAD_FROM_DB = os.environ.get("SESSION_LOAD_FROM_DB", "true").lower() in ("1", "true", "yes")
+# Used to sign the session tokens that give clients access to their stored conversations. Set this in production, to
+# the same value for all workers. If it's not set, each process makes up its own (and logs a warning), so a token only
+# works on the worker that issued it, until that restarts - on any other, the stored history is silently not used
+SESSION_SECRET = os.environ.get("SESSION_SECRET", "")
+
+### Chat workers ###
+# How many chat pipelines can run at once, and how many can be running or waiting before new ones get a 503
+CHAT_WORKERS = int(os.environ.get("CHAT_WORKERS", "64"))
+CHAT_MAX_IN_FLIGHT = int(os.environ.get("CHAT_MAX_IN_FLIGHT", "128"))
+# The Retry-After (in seconds) sent with the 503
+CHAT_RETRY_AFTER = int(os.environ.get("CHAT_RETRY_AFTER", "5"))
+# How many /chat requests the ASGI app handles at once before new ones get a 503. These are tasks rather
+# than threads, so there can be a lot more of them
+CHAT_ASYNC_MAX_IN_FLIGHT = int(os.environ.get("CHAT_ASYNC_MAX_IN_FLIGHT", "1024"))
+
+### Streaming ###
+# Streamed tokens are batched up for this many milliseconds before being sent. Can be overridden per request
+STREAM_FLUSH_WINDOW_MS = float(os.environ.get("STREAM_FLUSH_WINDOW_MS", "40"))
+STREAM_MAX_BATCH_CHARS = int(os.environ.get("STREAM_MAX_BATCH_CHARS", "2048"))
+# How many messages can be waiting to be sent to a client before the pipeline waits for it
+STREAM_QUEUE_SIZE = int(os.environ.get("STREAM_QUEUE_SIZE", "256"))
+# Give up on clients that haven't read anything for this many seconds
+STREAM_SEND_TIMEOUT = float(os.environ.get("STREAM_SEND_TIMEOUT", "60"))
+
+### Admin ###
+# Needed as a bearer token for the /admin endpoints, which are disabled if this isn't set
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+# If set, /metrics (on both the API and the MCP server) requires `Authorization: Bearer <METRICS_TOKEN>`
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
@@ -0,0 +1,239 @@
+"""An in-process index of the authored aisafety.info questions, for suggesting followups.
+
+Rather than asking nlp.stampy.ai for the questions most similar to some text, the titles and page
+ids of all the questions are kept in memory with their embeddings, as a normalized float32 matrix,
+so finding the most similar ones is a single vectorized dot product. The titles are embedded with
+the same model (and cache) as retrieval queries, so the query's embedding can be reused as is -
+answering a question never needs another embeddings API call. The similarities are on a different
+scale to nlp.stampy.ai's scores, so they're cut off at `FOLLOWUP_INDEX_THRESHOLD` instead.
+
+An index is built from a JSON (or JSON lines) list of `{"pageid": ..., "title": ...}` objects,
+which can be a file or a URL:
+
+    python -m stampy_chat.followup_index build questions.json followup_index.npz
+
+Set `FOLLOWUPS_BACKEND=local` and `FOLLOWUP_INDEX_PATH=followup_index.npz` to use it. Each worker
+reloads the snapshot whenever it changes. If `FOLLOWUP_INDEX_SOURCE` is set, the snapshot is also
+rebuilt from there once it's older than `FOLLOWUP_INDEX_REFRESH` seconds - only new titles need
+embedding, as the rest are in the embeddings cache.
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from typing import Callable, Iterable, Sequence
+
+import httpx
+import numpy as np
+
+from stampy_chat import logging
+from stampy_chat.citations import embed_queries
+from stampy_chat.env import FOLLOWUP_INDEX_PATH, FOLLOWUP_INDEX_REFRESH, FOLLOWUP_INDEX_SOURCE
+from stampy_chat.settings import make_settings
+from stampy_chat.vector_index import normalize_rows
+
+logger = logging.getLogger(__name__)
+
+# How many titles to embed per API call
+EMBED_BATCH_SIZE = 128
+
+Embedder = Callable[[Sequence[str]], Sequence[Sequence[float]]]
+
+
+def embed_titles(titles: Sequence[str]) -> list:
+    return embed_queries(titles, make_settings())
+
+
+class FollowupIndex:
+    """The embeddings of the authored questions, along with their page ids and titles."""
+
+    def __init__(self, vectors: np.ndarray, pageids: Sequence[str], titles: Sequence[str]):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        self.vectors = normalize_rows(vectors.reshape(len(pageids), -1) if len(pageids) else vectors.reshape(0, 0))
+        self.pageids = list(pageids)
+        self.titles = list(titles)
+
+    def __len__(self) -> int:
+        return len(self.pageids)
+
+    @classmethod
+    def build(cls, questions: Iterable[dict], embed: Embedder | None = None) -> "FollowupIndex":
+        """Embed the titles of the questions, skipping any without one, and any repeated page ids.
+
+        :param embed: how to embed a batch of titles - by default the same way as retrieval queries
+        """
+        embed = embed or embed_titles
+        unique = {}
+        for question in questions:
+            if question.get("pageid") and (question.get("title") or "").strip():
+                unique.setdefault(str(question["pageid"]), question["title"].strip())
+        pageids, titles = list(unique), list(unique.values())
+
+        vectors = []
+        for start in range(0, len(titles), EMBED_BATCH_SIZE):
+            vectors.extend(embed(titles[start:start + EMBED_BATCH_SIZE]))
+        return cls(np.asarray(vectors, dtype=np.float32), pageids, titles)
+
+    @classmethod
+    def load(cls, path: str) -> "FollowupIndex":
+        with np.load(path) as data:
+            return cls(data["vectors"], data["pageids"].tolist(), data["titles"].tolist())
+
+    def save(self, path: str):
+        """Write the snapshot to a temporary file first, so workers never see a half written one."""
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, vectors=self.vectors, pageids=np.array(self.pageids), titles=np.array(self.titles))
+        os.replace(tmp, path)
+
+    def search(self, vectors: Sequence[Sequence[float]], threshold: float, limit: int) -> list[list[dict]]:
+        """Find the `limit` questions most similar to each of the vectors, with a score over `threshold`.
+
+        :returns: a list of `{"text", "pageid", "score"}` dicts per vector, best first
+        """
+        if not len(self) or not len(vectors):
+            return [[] for _ in vectors]
+
+        queries = normalize_rows(np.asarray(vectors, dtype=np.float32))
+        scores = queries @ self.vectors.T
+        results = []
+        for row in scores:
+            candidates = np.flatnonzero(row > threshold)
+            best = candidates[np.argsort(-row[candidates], kind="stable")[:limit]]
+            results.append([
+                {"text": self.titles[i], "pageid": self.pageids[i], "score": float(row[i])} for i in best
+            ])
+        return results
+
+
+def read_questions(source: str) -> list[dict]:
+    """Read the questions from a JSON or JSON lines file or URL."""
+    if source.startswith(("http://", "https://")):
+        response = httpx.get(source, timeout=60, follow_redirects=True)
+        response.raise_for_status()
+        text = response.text
+    else:
+        with open(source) as f:
+            text = f.read()
+
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+class FollowupIndexLoader:
+    """Keeps this process' copy of the followup index up to date.
+
+    The snapshot is loaded on first use. After that, a background thread checks every `refresh`
+    seconds whether it has changed (rebuilding it from `source` first, if set and it's stale), and
+    swaps in the new one.
+    """
+
+    def __init__(
+        self,
+        path: str = FOLLOWUP_INDEX_PATH,
+        source: str = FOLLOWUP_INDEX_SOURCE,
+        refresh: float = FOLLOWUP_INDEX_REFRESH,
+    ):
+        self.path = path
+        self.source = source
+        self.refresh = refresh
+        self.index: FollowupIndex | None = None
+        self.mtime: float | None = None
+        self.loaded_at: float | None = None
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def get(self) -> FollowupIndex | None:
+        """Return the current index, or None if there isn't a snapshot yet."""
+        self._ensure_thread()
+        return self.index
+
+    def reload(self) -> bool:
+        """Load the snapshot if it has changed since it was last loaded."""
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            return False
+        if mtime == self.mtime:
+            return False
+
+        index = FollowupIndex.load(self.path)
+        self.index, self.mtime, self.loaded_at = index, mtime, time.time()
+        logger.info("Loaded followup index with %s questions from %s", len(index), self.path)
+        return True
+
+    def rebuild(self) -> bool:
+        """Rebuild the snapshot from the source, if it's older than `refresh` seconds."""
+        if not self.source:
+            return False
+        try:
+            if time.time() - os.stat(self.path).st_mtime < self.refresh:
+                return False
+        except FileNotFoundError:
+            pass
+
+        index = FollowupIndex.build(read_questions(self.source))
+        index.save(self.path)
+        logger.info("Rebuilt followup index with %s questions from %s", len(index), self.source)
+        return True
+
+    def update(self):
+        try:
+            self.rebuild()
+        except Exception as e:
+            logger.warning("Could not rebuild the followup index: %s", e)
+        try:
+            self.reload()
+        except Exception as e:
+            logger.warning("Could not load the followup index: %s", e)
+
+    def _ensure_thread(self):
+        # Threads don't survive a fork, so each (gunicorn worker) process needs its own
+        if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+                    if self._pid is None:
+                        # Load whatever is already there straight away - rebuilding can take a while
+                        try:
+                            self.reload()
+                        except Exception as e:
+                            logger.warning("Could not load the followup index: %s", e)
+                    self._pid = os.getpid()
+                    self._thread = threading.Thread(target=self._run, name="followup-index", daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            self.update()
+            time.sleep(self.refresh)
+
+    def stats(self) -> dict[str, int | float | None]:
+        return {
+            "questions": len(self.index) if self.index is not None else 0,
+            "loaded_at": self.loaded_at,
+        }
+
+
+followup_index = FollowupIndexLoader()
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(description="Manage the local followup index")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    build = commands.add_parser("build", help="Embed the authored questions into a followup index")
+    build.add_argument("source", help="A JSON or JSON lines file or URL of {pageid, title} objects")
+    build.add_argument("path", nargs="?", default=FOLLOWUP_INDEX_PATH)
+
+    args = parser.parse_args(argv)
+    index = FollowupIndex.build(read_questions(args.source))
+    index.save(args.path)
+    print(f"Built a followup index of {len(index)} questions in {args.path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,38 @@
-import requests
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
 from typing import TypedDict
-from urllib.parse import quote
+
+import httpx
 
 from stampy_chat import logging
+from stampy_chat.cache import TTLCache
 from stampy_chat.callbacks import CallbackHandler
+from stampy_chat.citations import cached_embeddings
+from stampy_chat.clients import followups_client
+from stampy_chat.env import (
+    FOLLOWUPS_BACKEND,
+    FOLLOWUPS_CACHE_BYTES,
+    FOLLOWUPS_CACHE_TTL,
+    FOLLOWUPS_TIMEOUT,
+    FOLLOWUPS_URL,
+    FOLLOWUPS_WORKERS,
+    FOLLOWUP_INDEX_THRESHOLD,
+)
+from stampy_chat.followup_index import FollowupIndex, followup_index
+from stampy_chat.metrics import FOLLOWUPS_SECONDS
 
 logger = logging.getLogger(__name__)
 
 SIMILARITY_THRESHOLD = 0.4  # bit of a shot in the dark - play with this later
 MAX_FOLLOWUPS = 3
+MAX_QUERY_LEN = 4093
+
+# Followup searches are just waiting on the network, so they're run in the background to
+# overlap with the rest of the chat pipeline
+executor = ThreadPoolExecutor(max_workers=FOLLOWUPS_WORKERS, thread_name_prefix="followups")
+
+followups_cache = TTLCache("followups", max_bytes=FOLLOWUPS_CACHE_BYTES, ttl=FOLLOWUPS_CACHE_TTL)
 
 
 class Followup(TypedDict):
@@ -17,41 +41,161 @@ class Followup(TypedDict):
     score: float
 
 
-# do a search like this:
-# https://nlp.stampy.ai/api/search?query=what%20is%20agi
+def normalize_query(query: str) -> str:
+    """The same question asked with different whitespace or capitalisation gets the same followups."""
+    return " ".join(query.split()).lower()[:MAX_QUERY_LEN]
 
 
-def search_authored(query: str):
-    return multisearch_authored([query])
+class FollowupSearch:
+    """Searches for authored questions similar to some text, e.g. https://nlp.stampy.ai/api/search?query=what%20is%20agi
 
+    Uses a pooled keep-alive client with strict timeouts, and caches the results by the normalized query.
+    """
 
-def get_followups(query):
-    if not query.strip():
-        return []
+    def __init__(self, url: str = FOLLOWUPS_URL, cache: TTLCache = followups_cache):
+        self.url = url
+        self.cache = cache
+        self.requests = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self._lock = threading.Lock()
 
-    url = "https://nlp.stampy.ai/api/search?query=" + quote(
-        query[:4093]
-    )  # make sure there aren't too many characters
-    response = requests.get(url)
-    if response.status_code == 200:
+    def fetch(self, query: str) -> list[Followup] | None:
+        """Call the search API, returning None if that failed."""
+        start = time.monotonic()
+        try:
+            response = followups_client().get(self.url, params={"query": query})
+        except httpx.TimeoutException as e:
+            with self._lock:
+                self.timeouts += 1
+            logger.warning("Followup search timed out: %s", e)
+            return None
+        except httpx.HTTPError as e:
+            with self._lock:
+                self.errors += 1
+            logger.warning("Followup search failed: %s", e)
+            return None
+        finally:
+            latency = time.monotonic() - start
+            with self._lock:
+                self.requests += 1
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+
+        if response.status_code != 200:
+            with self._lock:
+                self.errors += 1
+            return None
         return [
             Followup(text=entry["title"], pageid=entry["pageid"], score=entry["score"])
             for entry in response.json()
         ]
-    return []
 
+    def search(self, query: str) -> list[Followup]:
+        query = normalize_query(query)
+        if not query:
+            return []
 
-# search with multiple queries, combine results
-def multisearch_authored(queries: list[str]) -> list[Followup]:
+        if (followups := self.cache.get(query)) is not None:
+            return followups
+        followups = self.fetch(query)
+        if followups is None:
+            return []
+        self.cache.set(query, followups)
+        return followups
+
+    def stats(self) -> dict[str, int | float]:
+        cache = self.cache.stats()
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "errors": self.errors,
+                "timeouts": self.timeouts,
+                "avg_latency": self.total_latency / self.requests if self.requests else 0.0,
+                "max_latency": self.max_latency,
+                "cache_hits": cache["hits"],
+                "cache_misses": cache["misses"],
+                "hit_rate": cache["hits"] / (cache["hits"] + cache["misses"]) if cache["hits"] + cache["misses"] else 0.0,
+            }
+
+
+followup_search = FollowupSearch()
+
+
+def search_authored(query: str):
+    return multisearch_authored([query])
+
+
+def local_index() -> FollowupIndex | None:
+    """The in-process followup index, if it's enabled and has been built."""
+    return followup_index.get() if FOLLOWUPS_BACKEND == "local" else None
+
+
+def search_local(index: FollowupIndex, texts: list[str]) -> list[list[Followup]] | None:
+    """Search the local index for followups to each of the texts, returning None if none of them can be searched for.
+
+    This never calls the embeddings API - only texts that already have an embedding in the embeddings cache (e.g.
+    the query, which was embedded for retrieval) are searched for. Any others get no followups.
+    """
+    texts = [text[:MAX_QUERY_LEN] for text in texts]
+    try:
+        embeddings = cached_embeddings(texts)
+    except Exception as e:
+        logger.warning("Could not read embeddings for the followup index: %s", e)
+        return None
+
+    searchable = [(text, vector) for text, vector in zip(texts, embeddings) if vector is not None and text.strip()]
+    if not searchable:
+        return None
+
+    results = index.search([vector for _, vector in searchable], FOLLOWUP_INDEX_THRESHOLD, MAX_FOLLOWUPS)
+    found = dict(zip([text for text, _ in searchable], results))
+    return [found.get(text, []) for text in texts]
+
+
+def get_followups(query: str) -> list[Followup]:
+    return followup_search.search(query)
+
+
+def start_followups(query: str) -> Future | None:
+    """Start searching for followups to `query` in the background.
+
+    Nothing is started when using the local index, as searching it is quick enough to do at the end, by
+    which time the query will have been embedded for retrieval.
+    """
+    if local_index() is not None:
+        return None
+    return executor.submit(get_followups, query)
+
+
+def followups_result(future: Future) -> list[Followup]:
+    try:
+        # The requests themselves time out, this is just in case they're stuck waiting for a worker
+        return future.result(timeout=FOLLOWUPS_TIMEOUT)
+    except TimeoutError:
+        logger.warning("Gave up waiting for followups")
+        return []
+    except Exception as e:
+        logger.warning("Could not fetch followups: %s", e)
+        return []
+
+
+def merge_followups(results: list[list[Followup]], threshold: float = SIMILARITY_THRESHOLD) -> list[Followup]:
+    """Combine the followups from multiple searches into the best `MAX_FOLLOWUPS` unique ones.
+
+    :param float threshold: the minimum score - the local index's scores are on a different scale to the remote ones
+    """
     # sort the followups from lowest to highest score
-    followups = [entry for query in queries for entry in get_followups(query)]
+    followups = [entry for result in results for entry in result]
     followups = sorted(followups, key=lambda entry: entry["score"])
 
     # Remove any duplicates by making a map from the pageids. This should result in highest scored entry being used
     followups = {
         entry["pageid"]: entry
         for entry in followups
-        if entry["score"] > SIMILARITY_THRESHOLD
+        if entry["score"] > threshold
     }
 
     # Get the first `MAX_FOLLOWUPS`
@@ -63,7 +207,7 @@ def multisearch_authored(queries: list[str]) -> list[Followup]:
             " ------------------------------ suggested followups: -----------------------------"
         )
         for followup in followups:
-            if followup["score"] > SIMILARITY_THRESHOLD:
+            if followup["score"] > threshold:
                 logger.debug(f"{followup['score']:.2f} - suggested to user")
             else:
                 logger.debug(f"{followup['score']:.2f} - not suggested")
@@ -74,11 +218,50 @@ def multisearch_authored(queries: list[str]) -> list[Followup]:
     return followups
 
 
-def search_followups(query: str, response: str, callbacks: list[CallbackHandler]):
+# search with multiple queries, combine results
+def multisearch_authored(queries: list[str]) -> list[Followup]:
+    queries = list(dict.fromkeys(queries))
+    if (index := local_index()) is not None and (results := search_local(index, queries)) is not None:
+        return merge_followups(results, FOLLOWUP_INDEX_THRESHOLD)
+
+    # Run all the searches at once, only searching for each distinct query once
+    futures = [executor.submit(get_followups, query) for query in queries]
+    return merge_followups([followups_result(future) for future in futures])
+
+
+def search_followups(
+    query: str,
+    response: str,
+    callbacks: list[CallbackHandler],
+    query_followups: Future | None = None,
+):
+    """Find followups for the query and the response.
+
+    :param Future query_followups: the followups for `query`, if they have already been started via `start_followups`
+    """
     for call in callbacks:
         call.on_followups_start({"query": query, "response": response})
 
-    follows = multisearch_authored([query, response])
+    start = time.perf_counter()
+    backend, threshold = "remote", SIMILARITY_THRESHOLD
+    if (index := local_index()) is not None and (results := search_local(index, [query, response])) is not None:
+        backend, threshold = "local", FOLLOWUP_INDEX_THRESHOLD
+        if query_followups is not None:
+            query_followups.cancel()
+    else:
+        if query_followups is None:
+            query_followups = executor.submit(get_followups, query)
+
+        # The query lookup should be done or almost done by now, so search with the response in this thread
+        try:
+            response_followups = get_followups(response)
+        except Exception as e:
+            logger.warning("Could not fetch followups: %s", e)
+            response_followups = []
+        results = [followups_result(query_followups), response_followups]
+
+    follows = merge_followups(results, threshold)
+    FOLLOWUPS_SECONDS.observe(time.perf_counter() - start, backend=backend)
     for call in callbacks:
         call.on_followups_end(follows)
 
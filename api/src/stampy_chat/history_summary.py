@@ -0,0 +1,161 @@
+"""Rolling summaries of long conversations.
+
+Rather than dropping the oldest turns once a conversation gets too long, they are folded into a
+summary, which is sent in their place. The summary is kept per session, and is updated in the
+background after each answer, with only the messages that have become old since the last update
+being summarized (along with the previous summary). The prompt is then the summary plus the most
+recent `HISTORY_RECENT_MESSAGES` messages, so it stays about the same size however long the
+conversation gets.
+
+Clients send the whole history with each request, and can delete messages from it, so each summary
+records a fingerprint of the messages it covers, and is only used if the history still starts with them.
+"""
+import datetime
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple, cast
+from xml.sax.saxutils import escape
+
+from stampy_chat import logging
+from stampy_chat.cache import TTLCache
+from stampy_chat.citations import Message
+from stampy_chat.env import (
+    HISTORY_RECENT_MESSAGES,
+    HISTORY_SUMMARY_CACHE_BYTES,
+    HISTORY_SUMMARY_MODEL,
+    HISTORY_SUMMARY_TTL,
+    HISTORY_SUMMARY_WORKERS,
+)
+from stampy_chat.llms import query_llm
+from stampy_chat.prompts import HISTORY_SUMMARY_FORMAT, format_message, format_prompts
+from stampy_chat.settings import Settings, make_settings
+
+logger = logging.getLogger(__name__)
+
+summaries = TTLCache("history_summaries", max_bytes=HISTORY_SUMMARY_CACHE_BYTES, ttl=HISTORY_SUMMARY_TTL)
+summary_executor = ThreadPoolExecutor(max_workers=HISTORY_SUMMARY_WORKERS, thread_name_prefix="history-summary")
+
+_updating: set[str] = set()
+_updating_lock = threading.Lock()
+
+
+class HistorySummary(NamedTuple):
+    summary: str
+    # How many messages of the conversation are summarized
+    covered: int
+    # The fingerprint of those messages
+    fingerprint: str
+
+
+def conversation(history: list[Message]) -> list[Message]:
+    """The messages that are actually part of the conversation, i.e. without deleted ones or errors."""
+    return [m for m in history if m.get("role") in ("user", "assistant")]
+
+
+def fingerprint(messages: list[Message]) -> str:
+    """Identify the messages by their roles and the user's questions.
+
+    Answers are left out, as the client might not send them back exactly as they were generated.
+    """
+    digest = hashlib.sha256()
+    for message in messages:
+        content = message["content"].strip() if message["role"] == "user" else ""
+        digest.update(f"{message['role']}\x00{content}\x00".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def current_summary(session_id: str | None, messages: list[Message]) -> HistorySummary | None:
+    """Return the session's summary, if the conversation still starts with the messages it covers."""
+    if not session_id:
+        return None
+    state = summaries.get(session_id)
+    if state is None or state.covered > len(messages) or fingerprint(messages[:state.covered]) != state.fingerprint:
+        return None
+    return state
+
+
+def apply_summary(session_id: str | None, history: list[Message]) -> tuple[list[Message], str | None]:
+    """Replace the start of the history with its summary, if there is one.
+
+    :returns: the messages that aren't summarized, and the summary of the ones before them
+    """
+    messages = conversation(history)
+    state = current_summary(session_id, messages)
+    if state is None:
+        return history, None
+    return messages[state.covered:], state.summary
+
+
+def summary_prompt(previous: str | None, messages: list[Message], settings: Settings) -> list[Message]:
+    vals = dict(
+        modelname=settings.model_given_name,
+        date=datetime.datetime.now().strftime("%B %d, %Y"),
+        mode="",
+        message_id=0,
+    )
+    parts = []
+    if previous:
+        parts.append(HISTORY_SUMMARY_FORMAT.format(summary=previous))
+    for index, message in enumerate(messages):
+        if message["role"] == "user":
+            parts.append(format_message(settings.message_format, message_id=index, message=escape(message["content"])))
+        else:
+            parts.append(message["content"])
+    return [
+        Message(role="system", content=format_prompts(settings.history_summary_prompt, vals)),
+        Message(role="user", content="\n\n".join(parts)),
+    ]
+
+
+def update_summary(session_id: str, history: list[Message], settings: Settings) -> HistorySummary | None:
+    """Fold any messages older than the most recent `HISTORY_RECENT_MESSAGES` into the session's summary.
+
+    :param list[Message] history: the whole conversation, including the latest answer
+    :param Settings settings: the settings of the conversation, for the summary prompt and its length
+    """
+    messages = conversation(history)
+    # The recent messages have to start with a question
+    end = max(len(messages) - HISTORY_RECENT_MESSAGES, 0)
+    while end < len(messages) and messages[end]["role"] != "user":
+        end += 1
+
+    state = current_summary(session_id, messages)
+    start = state.covered if state else 0
+    if end - start < 2:
+        return state
+
+    summary = cast(
+        str,
+        query_llm(
+            summary_prompt(state and state.summary, messages[start:end], settings),
+            make_settings(model=HISTORY_SUMMARY_MODEL),
+            stream=False,
+            max_tokens=settings.maxHistorySummaryTokens,
+            thinking_budget=0,
+        ),
+    )
+    state = HistorySummary(summary.strip(), end, fingerprint(messages[:end]))
+    summaries.set(session_id, state)
+    return state
+
+
+def summarize_later(session_id: str | None, history: list[Message], settings: Settings):
+    """Update the session's summary in the background, unless an update is already running."""
+    if not session_id or not HISTORY_SUMMARY_MODEL or len(conversation(history)) <= HISTORY_RECENT_MESSAGES:
+        return
+    with _updating_lock:
+        if session_id in _updating:
+            return
+        _updating.add(session_id)
+
+    def run():
+        try:
+            update_summary(session_id, history, settings)
+        except Exception as e:
+            logger.error("Could not summarize the history of %s: %s", session_id, e)
+        finally:
+            with _updating_lock:
+                _updating.discard(session_id)
+
+    summary_executor.submit(run)
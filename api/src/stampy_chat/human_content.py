@@ -0,0 +1,236 @@
+"""A caching proxy for the human authored answers on aisafety.info, served on /human/<id>.
+
+Followup links are clicked over and over, while the answers behind them rarely change, so pages
+are cached (already rewritten) and served like an HTTP cache would:
+
+* for `HUMAN_CACHE_TTL` seconds a page is fresh, and served as is
+* for `HUMAN_STALE_TTL` seconds after that it's served stale, while it's revalidated in the background
+* after that, it's revalidated before being served, with a conditional request (`If-None-Match` /
+  `If-Modified-Since`), so unchanged pages only cost a 304. If that fails, or returns an error
+  status, the old page is served rather than the error. Pages are forgotten after `HUMAN_CACHE_KEEP` seconds.
+
+All requests go through a shared keep-alive client.
+"""
+import hashlib
+import json
+import re
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, NamedTuple
+
+import httpx
+
+from stampy_chat import logging
+from stampy_chat.cache import TTLCache
+from stampy_chat.clients import human_content_client
+from stampy_chat.env import (
+    HUMAN_CACHE_BYTES,
+    HUMAN_CACHE_KEEP,
+    HUMAN_CACHE_TTL,
+    HUMAN_CONTENT_URL,
+    HUMAN_STALE_TTL,
+    HUMAN_WORKERS,
+)
+
+logger = logging.getLogger(__name__)
+
+# run a regex to replace all relative links with absolute links. Just doing
+# a regex for now since we really don't need to parse everything out then
+# re-serialize it for something this simple.
+# <a href=\"/?state=6207&question=What%20is%20%22superintelligence%22%3F\">
+#                               ⬇️
+# <a href=\"https://stampy.ai/?state=6207&question=What%20is%20%22superintelligence%22%3F\">
+RELATIVE_LINK = re.compile(r'<a href=\\"/\?state=(\d+.*)\\">')
+ABSOLUTE_LINK = r'<a href=\"https://aisafety.info/?state=\1\\">'
+
+executor = ThreadPoolExecutor(max_workers=HUMAN_WORKERS, thread_name_prefix="human-content")
+
+human_cache = TTLCache("human", max_bytes=HUMAN_CACHE_BYTES, ttl=HUMAN_CACHE_KEEP)
+
+
+class Page(NamedTuple):
+    body: str
+    status: int
+    title: str | None = None
+    etag: str | None = None
+    last_modified: str | None = None
+    fetched: float = 0.0
+
+    @property
+    def digest(self) -> str:
+        """A validator for the rewritten body, for clients' own conditional requests."""
+        return hashlib.blake2b(self.body.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def rewrite_links(text: str) -> str:
+    return RELATIVE_LINK.sub(ABSOLUTE_LINK, text)
+
+
+def page_title(text: str) -> str | None:
+    try:
+        return json.loads(text)["data"]["title"]
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+class HumanContentProxy:
+    """Fetches and caches aisafety.info pages.
+
+    :param str url: the page URL template, with an `{id}` placeholder
+    :param TTLCache cache: where to keep pages, for up to its TTL
+    :param float ttl: how many seconds pages are fresh for
+    :param float stale_ttl: how many seconds after that pages are served while being revalidated
+    """
+
+    def __init__(
+        self,
+        url: str = HUMAN_CONTENT_URL,
+        cache: TTLCache = human_cache,
+        ttl: float = HUMAN_CACHE_TTL,
+        stale_ttl: float = HUMAN_STALE_TTL,
+    ):
+        self.url = url
+        self.cache = cache
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.fresh = 0
+        self.stale = 0
+        self.fetches = 0
+        self.not_modified = 0
+        self.errors = 0
+        self._refreshing: set[str] = set()
+        self._lock = threading.Lock()
+
+    def fetch(self, id: str, cached: Page | None = None) -> Page:
+        """Fetch the page, only downloading it again if it changed since `cached` was fetched.
+
+        :raises httpx.HTTPError: if the request failed
+        """
+        headers = {}
+        if cached and cached.etag:
+            headers["If-None-Match"] = cached.etag
+        if cached and cached.last_modified:
+            headers["If-Modified-Since"] = cached.last_modified
+
+        response = human_content_client().get(self.url.format(id=urllib.parse.quote(id, safe="")), headers=headers)
+        with self._lock:
+            self.fetches += 1
+            if response.status_code == 304:
+                self.not_modified += 1
+        if response.status_code == 304 and cached:
+            return cached._replace(fetched=time.monotonic())
+
+        text = response.text
+        return Page(
+            body=rewrite_links(text),
+            status=response.status_code,
+            title=page_title(text) if response.status_code == 200 else None,
+            etag=response.headers.get("ETag"),
+            last_modified=response.headers.get("Last-Modified"),
+            fetched=time.monotonic(),
+        )
+
+    def update(self, id: str, cached: Page | None = None) -> Page:
+        """Fetch the page, caching it if it was found."""
+        page = self.fetch(id, cached)
+        if page.status == 200:
+            self.cache.set(id, page)
+        return page
+
+    def get(self, id: str) -> Page | None:
+        """Return the page, from the cache if possible, or None if it couldn't be fetched at all."""
+        cached = self.cache.get(id)
+        if cached is not None:
+            age = time.monotonic() - cached.fetched
+            if age < self.ttl:
+                with self._lock:
+                    self.fresh += 1
+                return cached
+            if age < self.ttl + self.stale_ttl:
+                with self._lock:
+                    self.stale += 1
+                self.refresh_later(id, cached)
+                return cached
+
+        try:
+            page = self.update(id, cached)
+        except httpx.HTTPError as e:
+            with self._lock:
+                self.errors += 1
+            logger.warning("Could not fetch %s: %s", id, e)
+            # An old page is better than nothing
+            return cached
+
+        if cached is not None and not 200 <= page.status < 300:
+            with self._lock:
+                self.errors += 1
+            logger.warning("Could not revalidate %s, got a %s", id, page.status)
+            return cached
+        return page
+
+    def refresh_later(self, id: str, cached: Page | None = None) -> bool:
+        """Fetch the page in the background, unless that's already happening.
+
+        :returns: whether a fetch was started
+        """
+        with self._lock:
+            if id in self._refreshing:
+                return False
+            self._refreshing.add(id)
+
+        def refresh():
+            try:
+                self.update(id, cached)
+            except httpx.HTTPError as e:
+                with self._lock:
+                    self.errors += 1
+                logger.warning("Could not refresh %s: %s", id, e)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(id)
+
+        try:
+            executor.submit(refresh)
+        except Exception:
+            with self._lock:
+                self._refreshing.discard(id)
+            raise
+        return True
+
+    def prefetch(self, ids: Iterable[str]) -> list[str]:
+        """Start fetching any of the pages that aren't fresh in the cache.
+
+        :returns: the ids of the pages being fetched
+        """
+        started = []
+        for id in dict.fromkeys(ids):
+            cached = self.cache.get(id)
+            if cached is not None and time.monotonic() - cached.fetched < self.ttl:
+                continue
+            if self.refresh_later(id, cached):
+                started.append(id)
+        return started
+
+    def cache_control(self, page: Page) -> str:
+        if page.status != 200:
+            return "no-cache"
+        max_age = max(0, int(self.ttl - (time.monotonic() - page.fetched)))
+        return f"public, max-age={max_age}, stale-while-revalidate={int(self.stale_ttl)}"
+
+    def stats(self) -> dict[str, int | float]:
+        cache = self.cache.stats()
+        with self._lock:
+            return {
+                "fresh": self.fresh,
+                "stale": self.stale,
+                "fetches": self.fetches,
+                "not_modified": self.not_modified,
+                "errors": self.errors,
+                "refreshing": len(self._refreshing),
+                "cached": cache["entries"],
+            }
+
+
+human_content = HumanContentProxy()
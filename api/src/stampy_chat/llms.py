@@ -1,16 +1,51 @@
-from typing import TypedDict, Literal, Generator, Sequence
+import inspect
+import time
+from functools import partial
+from typing import AsyncGenerator, TypedDict, Literal, Generator, NotRequired, Sequence
 
-import anthropic
-import openai
 from google import genai
 from stampy_chat.settings import ANTHROPIC, OPENAI, GOOGLE, OPENROUTER, MODELS, Settings
-from stampy_chat.env import OPENAI_API_KEY, ANTHROPIC_API_KEY, GOOGLE_API_KEY, OPENROUTER_API_KEY
+from stampy_chat.clients import (
+    anthropic_client,
+    async_anthropic_client,
+    async_google_client,
+    async_openai_client,
+    async_openrouter_client,
+    google_client,
+    openai_client,
+    openrouter_client,
+)
 from stampy_chat.citations import Message
+from stampy_chat.env import ANTHROPIC_PROMPT_CACHING
+from stampy_chat.metrics import LLM_INTER_TOKEN_SECONDS, LLM_TOKENS_PER_SECOND, LLM_TTFT_SECONDS, Histogram
+from stampy_chat.routing import (
+    Latencies,
+    ProviderHealth,
+    afirst_success,
+    ahedged,
+    first_success,
+    hedge_delay,
+    hedge_latencies,
+    hedged,
+    provider_health,
+    provider_of,
+    route,
+)
+
+CACHE_CONTROL = {"type": "ephemeral"}
+
+
+class Usage(TypedDict):
+    input_tokens: int
+    output_tokens: int
+    cache_creation_input_tokens: int
+    cache_read_input_tokens: int
 
 
 class LLMChunk(TypedDict):
-    type: Literal["thinking", "response"]
+    type: Literal["thinking", "response", "usage"]
     text: str
+    usage: NotRequired[Usage]
 
 
 def split_system(history: Sequence[Message]) -> tuple[str, list[Message]]:
@@ -19,6 +54,73 @@ def split_system(history: Sequence[Message]) -> tuple[str, list[Message]]:
     return system, history
 
 
+def text_block(text: str, cache: bool = False) -> dict:
+    block = {"type": "text", "text": text}
+    if cache:
+        block["cache_control"] = CACHE_CONTROL
+    return block
+
+
+def add_cache_breakpoints(history: Sequence[Message]) -> tuple[list[dict], list[dict]]:
+    """Split out the system prompt and mark the stable prefix of the conversation as cacheable.
+
+    The system messages (i.e. the core reference documents and the history prompt) are the same
+    for every turn of every conversation, so they get the first breakpoint. The earlier turns of
+    the conversation are the same between consecutive turns, so the last message before the
+    current query gets the second one. The current query is never cached, as it contains the
+    retrieved blocks, which change every time.
+
+    :returns: a tuple of the system blocks and the messages, in the format expected by the Anthropic API
+    """
+    system = [text_block(x["content"]) for x in history if x["role"] == "system" and x["content"]]
+    messages = [
+        {"role": x["role"], "content": [text_block(x["content"])]}
+        for x in history if x["role"] != "system"
+    ]
+
+    if system:
+        system[-1]["cache_control"] = CACHE_CONTROL
+    if len(messages) > 1:
+        messages[-2]["content"][-1]["cache_control"] = CACHE_CONTROL
+    return system, messages
+
+
+def close_response(response):
+    """Close the provider stream, which drops the connection and so stops the generation (and billing)."""
+    if close := getattr(response, "close", None):
+        close()
+
+
+async def aclose_response(response):
+    close = getattr(response, "aclose", None) or getattr(response, "close", None)
+    if close and inspect.isawaitable(result := close()):
+        await result
+
+
+def anthropic_usage(usage) -> Usage:
+    return Usage(
+        input_tokens=getattr(usage, "input_tokens", None) or 0,
+        output_tokens=getattr(usage, "output_tokens", None) or 0,
+        cache_creation_input_tokens=getattr(usage, "cache_creation_input_tokens", None) or 0,
+        cache_read_input_tokens=getattr(usage, "cache_read_input_tokens", None) or 0,
+    )
+
+
+def anthropic_params(history: Sequence[Message], model: str, max_tokens: int, thinking_budget: int = 0) -> dict:
+    params = {"model": model, "max_tokens": max_tokens}
+    if thinking_budget > 0:
+        params["thinking"] = {"type": "enabled", "budget_tokens": thinking_budget}
+
+    if ANTHROPIC_PROMPT_CACHING:
+        system, messages = add_cache_breakpoints(history)
+    else:
+        system, messages = split_system(history)
+    params["messages"] = messages
+    if system:
+        params["system"] = system
+    return params
+
+
 def call_anthropic(
     history: Sequence[Message],
     model: str,
@@ -26,26 +128,10 @@ def call_anthropic(
     thinking_budget: int = 0,
     stream: bool = True,
 ) -> Generator[LLMChunk, None, None]:
-    client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
-
-    params = {}
-    if thinking_budget > 0:
-        params["thinking"] = {"type": "enabled", "budget_tokens": thinking_budget}
-
-    system, history = split_system(history)
-
-    try:
-        response = client.messages.create(
-            model=model,
-            messages=history,
-            system=system,
-            max_tokens=max_tokens,
-            stream=stream,
-            **params,
-        )
-    except (anthropic.RateLimitError, anthropic.InternalServerError) as e:
-        print("WARNING: falling back to google due to anthropic api error:", e)
-        return call_google(history, model, max_tokens, thinking_budget, stream)
+    client = anthropic_client()
+    response = client.messages.create(
+        stream=stream, **anthropic_params(history, model, max_tokens, thinking_budget)
+    )
 
     if stream:
         return anthropic_stream(response)
@@ -53,13 +139,39 @@ def call_anthropic(
         return response.content[0].text
 
 
+def anthropic_chunk(event, usage: dict) -> LLMChunk | None:
+    """Convert a stream event into a chunk, collecting the token counts into `usage` along the way."""
+    if event.type == "message_start":
+        usage.update(anthropic_usage(event.message.usage))
+    elif event.type == "message_delta" and usage and event.usage:
+        usage["output_tokens"] = event.usage.output_tokens or 0
+    elif event.type == "content_block_delta":
+        if event.delta.type == "thinking_delta":
+            return LLMChunk(type="thinking", text=event.delta.thinking)
+        elif event.delta.type == "text_delta":
+            return LLMChunk(type="response", text=event.delta.text)
+    return None
+
+
 def anthropic_stream(response):
-    for event in response:
-        if event.type == "content_block_delta":
-            if event.delta.type == "thinking_delta":
-                yield LLMChunk(type="thinking", text=event.delta.thinking)
-            elif event.delta.type == "text_delta":
-                yield LLMChunk(type="response", text=event.delta.text)
+    usage = {}
+    try:
+        for event in response:
+            if chunk := anthropic_chunk(event, usage):
+                yield chunk
+    finally:
+        close_response(response)
+
+    if usage:
+        yield LLMChunk(type="usage", text="", usage=usage)
+
+
+def openai_params(history: Sequence[Message], model: str, max_tokens: int, thinking_budget: int = 0) -> dict:
+    system, history = split_system(history)
+    params = {"model": model, "instructions": system, "input": history, "max_output_tokens": max_tokens}
+    if thinking_budget > 0:
+        params["reasoning"] = {"effort": "medium"}
+    return params
 
 
 def call_openai(
@@ -69,40 +181,30 @@ def call_openai(
     thinking_budget: int = 0,
     stream: bool = False,
 ) -> Generator[LLMChunk, None, None]:
-    client = openai.OpenAI(api_key=OPENAI_API_KEY)
-    system, history = split_system(history)
-    params = {}
-    if thinking_budget > 0:
-        params["reasoning"] = {"effort": "medium"}
-
-    response = client.responses.create(
-        model=model,
-        instructions=system,
-        input=history,
-        max_output_tokens=max_tokens,
-        stream=True,
-        **params,
-    )
+    client = openai_client()
+    response = client.responses.create(stream=stream, **openai_params(history, model, max_tokens, thinking_budget))
     if stream:
         return openai_stream(response)
     else:
-        return response.choices[0].message.content
+        return response.output_text
+
+
+def openai_chunk(event) -> LLMChunk | None:
+    if event.type == "response.output_text.delta":
+        return LLMChunk(type="response", text=event.delta)
+    return None
 
 
 def openai_stream(response):
-    for event in response:
-        if event.type == "response.output_text.delta":
-            yield LLMChunk(type="response", text=event.delta)
+    try:
+        for event in response:
+            if chunk := openai_chunk(event):
+                yield chunk
+    finally:
+        close_response(response)
 
 
-def call_google(
-    history: Sequence[Message],
-    model: str,
-    max_tokens: int,
-    thinking_budget: int = 0,
-    stream: bool = False,
-) -> Generator[LLMChunk, None, None]:
-    client = genai.Client(api_key=GOOGLE_API_KEY)
+def google_params(history: Sequence[Message], model: str, max_tokens: int, thinking_budget: int = 0) -> dict:
     system, history = split_system(history)
 
     # Convert to Gemini's Content format
@@ -122,52 +224,59 @@ def call_google(
     if system:
         config_params["system_instruction"] = system
 
-    config = genai.types.GenerateContentConfig(**config_params)
+    return {"model": model, "contents": contents, "config": genai.types.GenerateContentConfig(**config_params)}
+
+
+def call_google(
+    history: Sequence[Message],
+    model: str,
+    max_tokens: int,
+    thinking_budget: int = 0,
+    stream: bool = False,
+) -> Generator[LLMChunk, None, None]:
+    client = google_client()
+    params = google_params(history, model, max_tokens, thinking_budget)
 
     # Use streaming API
     if stream:
-        response = client.models.generate_content_stream(
-            model=model, contents=contents, config=config
-        )
+        response = client.models.generate_content_stream(**params)
 
         def do_stream():
-            for chunk in response:
-                if hasattr(chunk, "text") and chunk.text:
-                    yield LLMChunk(type="response", text=chunk.text)
+            try:
+                for event in response:
+                    if chunk := google_chunk(event):
+                        yield chunk
+            finally:
+                close_response(response)
 
         return do_stream()
     else:
-        response = client.models.generate_content(
-            model=model, contents=contents, config=config
-        )
+        response = client.models.generate_content(**params)
 
         return response.text
 
 
-def call_openrouter(
-    history: Sequence[Message],
-    model: str,
-    max_tokens: int,
-    thinking_budget: int = 0,
-    stream: bool = True,
-) -> Generator[LLMChunk, None, None]:
+def google_chunk(chunk) -> LLMChunk | None:
+    if hasattr(chunk, "text") and chunk.text:
+        return LLMChunk(type="response", text=chunk.text)
+    return None
+
+
+def openrouter_params(
+    history: Sequence[Message], model: str, max_tokens: int, thinking_budget: int = 0, stream: bool = True
+) -> dict:
     # Remove "openrouter/" prefix to get the actual model name
     if model.startswith("openrouter/"):
         model = model[len("openrouter/"):]
-    
-    client = openai.OpenAI(
-        base_url="https://openrouter.ai/api/v1",
-        api_key=OPENROUTER_API_KEY,
-    )
-    
+
     system, history = split_system(history)
-    
+
     # Build messages
     messages = []
     if system:
         messages.append({"role": "system", "content": system})
     messages.extend(history)
-    
+
     # Build parameters
     params = {
         "model": model,
@@ -175,44 +284,186 @@ def call_openrouter(
         "max_tokens": max_tokens,
         "stream": stream,
     }
-    
-    # Add reasoning/thinking support for compatible models  
-    extra_body = {}
+
+    # Add reasoning/thinking support for compatible models
     if thinking_budget > 0:
         # Use exact token count for more precise control (minimum 1024 per OpenRouter docs)
-        extra_body["reasoning"] = {"max_tokens": thinking_budget}
-        
-    # Optional headers for attribution
-    extra_headers = {}
-    
+        params["extra_body"] = {"reasoning": {"max_tokens": thinking_budget}}
+    return params
+
+
+def call_openrouter(
+    history: Sequence[Message],
+    model: str,
+    max_tokens: int,
+    thinking_budget: int = 0,
+    stream: bool = True,
+) -> Generator[LLMChunk, None, None]:
+    client = openrouter_client()
     try:
-        if extra_headers:
-            params["extra_headers"] = extra_headers
-        if extra_body:
-            params["extra_body"] = extra_body
-        
-        response = client.chat.completions.create(**params)
-        
+        response = client.chat.completions.create(
+            **openrouter_params(history, model, max_tokens, thinking_budget, stream)
+        )
+
         if stream:
             return openrouter_stream(response)
         else:
             return response.choices[0].message.content
     except Exception as e:
         print(f"WARNING: OpenRouter API error: {e}")
-        # Could implement fallback to other providers like Anthropic does
+        # query_llm will try the fallback models, if there are any
         raise
 
 
+def openrouter_chunks(chunk) -> list[LLMChunk]:
+    chunks = []
+    if chunk.choices and chunk.choices[0].delta:
+        delta = chunk.choices[0].delta
+        # Handle reasoning tokens if present
+        if hasattr(delta, 'reasoning') and delta.reasoning:
+            chunks.append(LLMChunk(type="thinking", text=delta.reasoning))
+        # Handle regular content
+        if delta.content:
+            chunks.append(LLMChunk(type="response", text=delta.content))
+    return chunks
+
+
 def openrouter_stream(response):
-    for chunk in response:
-        if chunk.choices and chunk.choices[0].delta:
-            delta = chunk.choices[0].delta
-            # Handle reasoning tokens if present
-            if hasattr(delta, 'reasoning') and delta.reasoning:
-                yield LLMChunk(type="thinking", text=delta.reasoning)
-            # Handle regular content
-            if delta.content:
-                yield LLMChunk(type="response", text=delta.content)
+    try:
+        for chunk in response:
+            yield from openrouter_chunks(chunk)
+    finally:
+        close_response(response)
+
+
+def model_thinking_budget(model: str, thinking_budget: int) -> int:
+    model_info = MODELS.get(model)
+    if model_info and (model_info.can_think == "always" or (model_info.can_think and thinking_budget > 0)):
+        return max(model_info.min_think, thinking_budget)
+    return 0
+
+
+def resolve_thinking_budget(settings: Settings, thinking_budget: int | None = None) -> int:
+    thinking_budget = thinking_budget if thinking_budget is not None else settings.thinking_budget
+    return model_thinking_budget(settings.model, thinking_budget)
+
+
+class StreamTimer:
+    """Times the chunks of a stream from `model`, for the metrics."""
+
+    def __init__(self, model: str, first_chunk: float):
+        self.labels = {"model": model, "provider": provider_of(model)}
+        self.first = self.last = time.monotonic()
+        self.chars = 0
+        self.output_tokens = None
+        LLM_TTFT_SECONDS.observe(first_chunk, **self.labels)
+
+    def chunk(self, chunk: LLMChunk | None, first: bool = False):
+        if chunk is None:
+            return
+        if chunk["type"] == "usage":
+            # Sent once the stream is done, so not counted as a token
+            self.output_tokens = chunk["usage"].get("output_tokens")
+            return
+        if not first:
+            now = time.monotonic()
+            LLM_INTER_TOKEN_SECONDS.observe(now - self.last, **self.labels)
+            self.last = now
+        self.chars += len(chunk["text"])
+
+    def done(self):
+        if self.last > self.first:
+            # Not all providers report usage, in which case it's roughly 4 characters per token
+            tokens = self.output_tokens or self.chars // 4
+            LLM_TOKENS_PER_SECOND.observe(tokens / (self.last - self.first), **self.labels)
+
+
+PROVIDERS = {ANTHROPIC: call_anthropic, OPENAI: call_openai, GOOGLE: call_google, OPENROUTER: call_openrouter}
+
+
+def provider_call(model: str, providers: dict):
+    """Return the function to call `model` with, and the model id to pass it."""
+    provider, _, model_id = model.partition("/")
+    if provider not in providers:
+        raise ValueError(f"Unknown provider: {provider}")
+    return providers[provider], model_id
+
+
+def call_model(
+    model: str, history: Sequence[Message], max_tokens: int, thinking_budget: int, latencies: Latencies | None = None
+) -> str:
+    """Get a complete response from `model`, recording how its provider is doing."""
+    func, model_id = provider_call(model, PROVIDERS)
+    health = provider_health(provider_of(model))
+    health.start()
+    start = time.monotonic()
+    try:
+        text = func(history, model_id, max_tokens, model_thinking_budget(model, thinking_budget), stream=False)
+    except Exception as e:
+        health.error(e)
+        raise
+
+    elapsed = time.monotonic() - start
+    health.completed(elapsed)
+    health.success()
+    if latencies is not None:
+        latencies.add(elapsed)
+    return text
+
+
+def start_stream(
+    model: str, history: Sequence[Message], max_tokens: int, thinking_budget: int
+) -> Generator[LLMChunk, None, None]:
+    """Start streaming from `model`, waiting for the first chunk, so that failures can still be retried elsewhere."""
+    func, model_id = provider_call(model, PROVIDERS)
+    health = provider_health(provider_of(model))
+    health.start()
+    start = time.monotonic()
+    chunks = None
+    try:
+        chunks = func(history, model_id, max_tokens, model_thinking_budget(model, thinking_budget), stream=True)
+        first = next(chunks, None)
+    except Exception as e:
+        health.error(e)
+        raise
+    except BaseException:
+        if chunks is not None:
+            chunks.close()
+        health.release()
+        raise
+
+    ttft = time.monotonic() - start
+    health.first_token(ttft)
+    return follow_stream(health, StreamTimer(model, ttft), first, chunks)
+
+
+def follow_stream(
+    health: ProviderHealth, timer: StreamTimer, first: LLMChunk | None, chunks: Generator[LLMChunk, None, None]
+):
+    try:
+        timer.chunk(first, first=True)
+        if first is not None:
+            yield first
+        for chunk in chunks:
+            timer.chunk(chunk)
+            yield chunk
+    except Exception as e:
+        health.error(e)
+        raise
+    except BaseException:
+        health.release()
+        raise
+    else:
+        health.success()
+        timer.done()
+    finally:
+        chunks.close()
+
+
+def routed_stream(
+    models: Sequence[str], history: Sequence[Message], max_tokens: int, thinking_budget: int
+) -> Generator[LLMChunk, None, None]:
+    yield from first_success(models, lambda model: start_stream(model, history, max_tokens, thinking_budget))
 
 
 def query_llm(
@@ -221,30 +472,262 @@ def query_llm(
     stream: bool = True,
     max_tokens: int | None = None,
     thinking_budget: int | None = None,
-) -> Generator[LLMChunk, None, None]:
-    provider = settings.model_provider
-    if provider == ANTHROPIC:
-        func = call_anthropic
-    elif provider == OPENAI:
-        func = call_openai
-    elif provider == GOOGLE:
-        func = call_google
-    elif provider == OPENROUTER:
-        func = call_openrouter
+    hedge: bool = False,
+    timer: Histogram | None = None,
+) -> Generator[LLMChunk, None, None] | str:
+    """Call the settings' model, falling back to its equivalents (see `routing`) if its provider is failing.
+
+    Streams are only retried elsewhere if they fail before the first chunk arrives.
+
+    :param bool hedge: whether to also ask the next model if this (non streaming) call is slower than usual
+    :param Histogram timer: where to record how long a (non streaming) call took, by the model that answered it
+    """
+    provider_call(settings.model, PROVIDERS)
+    models = route(settings.model)
+    max_tokens = max_tokens if max_tokens is not None else settings.max_response_tokens
+    thinking_budget = thinking_budget if thinking_budget is not None else settings.thinking_budget
+
+    if stream:
+        return routed_stream(models, history, max_tokens, thinking_budget)
+
+    start = time.monotonic()
+
+    def answer(model: str, latencies: Latencies | None = None) -> tuple[str, str]:
+        return model, call_model(model, history, max_tokens, thinking_budget, latencies)
+
+    if hedge and len(models) > 1:
+        model, text = hedged(
+            [partial(answer, model, hedge_latencies(model)) for model in models], hedge_delay(models[0])
+        )
     else:
-        raise ValueError(f"Unknown provider: {provider}")
+        model, text = first_success(models, answer)
+    if timer is not None:
+        timer.observe(time.monotonic() - start, model=model, provider=provider_of(model))
+    return text
 
-    model_info = MODELS[settings.model]
-    thinking_budget = thinking_budget if thinking_budget is not None else settings.thinking_budget
-    if model_info.can_think == "always" or (model_info.can_think and thinking_budget > 0):
-        thinking_budget = max(model_info.min_think, thinking_budget)
+
+### Async versions, used by the ASGI app ###
+
+
+async def acall_anthropic(
+    history: Sequence[Message],
+    model: str,
+    max_tokens: int,
+    thinking_budget: int = 0,
+    stream: bool = True,
+) -> AsyncGenerator[LLMChunk, None] | str:
+    client = async_anthropic_client()
+    response = await client.messages.create(
+        stream=stream, **anthropic_params(history, model, max_tokens, thinking_budget)
+    )
+
+    if stream:
+        return anthropic_astream(response)
     else:
-        thinking_budget = 0
-
-    return func(
-        history,
-        settings.model_id,
-        max_tokens if max_tokens is not None else settings.max_response_tokens,
-        thinking_budget,
-        stream=stream,
+        return response.content[0].text
+
+
+async def anthropic_astream(response):
+    usage = {}
+    try:
+        async for event in response:
+            if chunk := anthropic_chunk(event, usage):
+                yield chunk
+    finally:
+        await aclose_response(response)
+
+    if usage:
+        yield LLMChunk(type="usage", text="", usage=usage)
+
+
+async def acall_openai(
+    history: Sequence[Message],
+    model: str,
+    max_tokens: int,
+    thinking_budget: int = 0,
+    stream: bool = False,
+) -> AsyncGenerator[LLMChunk, None] | str:
+    client = async_openai_client()
+    params = openai_params(history, model, max_tokens, thinking_budget)
+    if not stream:
+        return (await client.responses.create(**params)).output_text
+
+    async def do_stream():
+        response = await client.responses.create(stream=True, **params)
+        try:
+            async for event in response:
+                if chunk := openai_chunk(event):
+                    yield chunk
+        finally:
+            await aclose_response(response)
+
+    return do_stream()
+
+
+async def acall_google(
+    history: Sequence[Message],
+    model: str,
+    max_tokens: int,
+    thinking_budget: int = 0,
+    stream: bool = False,
+) -> AsyncGenerator[LLMChunk, None] | str:
+    client = async_google_client()
+    params = google_params(history, model, max_tokens, thinking_budget)
+    if not stream:
+        return (await client.models.generate_content(**params)).text
+
+    async def do_stream():
+        response = await client.models.generate_content_stream(**params)
+        try:
+            async for event in response:
+                if chunk := google_chunk(event):
+                    yield chunk
+        finally:
+            await aclose_response(response)
+
+    return do_stream()
+
+
+async def acall_openrouter(
+    history: Sequence[Message],
+    model: str,
+    max_tokens: int,
+    thinking_budget: int = 0,
+    stream: bool = True,
+) -> AsyncGenerator[LLMChunk, None] | str:
+    client = async_openrouter_client()
+    response = await client.chat.completions.create(
+        **openrouter_params(history, model, max_tokens, thinking_budget, stream)
     )
+    if not stream:
+        return response.choices[0].message.content
+
+    async def do_stream():
+        try:
+            async for chunk in response:
+                for llm_chunk in openrouter_chunks(chunk):
+                    yield llm_chunk
+        finally:
+            await aclose_response(response)
+
+    return do_stream()
+
+
+ASYNC_PROVIDERS = {ANTHROPIC: acall_anthropic, OPENAI: acall_openai, GOOGLE: acall_google, OPENROUTER: acall_openrouter}
+
+
+async def acall_model(
+    model: str, history: Sequence[Message], max_tokens: int, thinking_budget: int, latencies: Latencies | None = None
+) -> str:
+    func, model_id = provider_call(model, ASYNC_PROVIDERS)
+    health = provider_health(provider_of(model))
+    health.start()
+    start = time.monotonic()
+    try:
+        text = await func(history, model_id, max_tokens, model_thinking_budget(model, thinking_budget), stream=False)
+    except Exception as e:
+        health.error(e)
+        raise
+    except BaseException:
+        health.release()
+        raise
+
+    elapsed = time.monotonic() - start
+    health.completed(elapsed)
+    health.success()
+    if latencies is not None:
+        latencies.add(elapsed)
+    return text
+
+
+async def astart_stream(
+    model: str, history: Sequence[Message], max_tokens: int, thinking_budget: int
+) -> AsyncGenerator[LLMChunk, None]:
+    func, model_id = provider_call(model, ASYNC_PROVIDERS)
+    health = provider_health(provider_of(model))
+    health.start()
+    start = time.monotonic()
+    chunks = None
+    try:
+        chunks = await func(history, model_id, max_tokens, model_thinking_budget(model, thinking_budget), stream=True)
+        first = await anext(chunks, None)
+    except Exception as e:
+        health.error(e)
+        raise
+    except BaseException:
+        if chunks is not None:
+            await chunks.aclose()
+        health.release()
+        raise
+
+    ttft = time.monotonic() - start
+    health.first_token(ttft)
+    return afollow_stream(health, StreamTimer(model, ttft), first, chunks)
+
+
+async def afollow_stream(
+    health: ProviderHealth, timer: StreamTimer, first: LLMChunk | None, chunks: AsyncGenerator[LLMChunk, None]
+):
+    try:
+        timer.chunk(first, first=True)
+        if first is not None:
+            yield first
+        async for chunk in chunks:
+            timer.chunk(chunk)
+            yield chunk
+    except Exception as e:
+        health.error(e)
+        raise
+    except BaseException:
+        health.release()
+        raise
+    else:
+        health.success()
+        timer.done()
+    finally:
+        await chunks.aclose()
+
+
+async def routed_astream(
+    models: Sequence[str], history: Sequence[Message], max_tokens: int, thinking_budget: int
+) -> AsyncGenerator[LLMChunk, None]:
+    chunks = await afirst_success(models, lambda model: astart_stream(model, history, max_tokens, thinking_budget))
+    try:
+        async for chunk in chunks:
+            yield chunk
+    finally:
+        await chunks.aclose()
+
+
+async def aquery_llm(
+    history: Sequence[Message],
+    settings: Settings,
+    stream: bool = True,
+    max_tokens: int | None = None,
+    thinking_budget: int | None = None,
+    hedge: bool = False,
+    timer: Histogram | None = None,
+) -> AsyncGenerator[LLMChunk, None] | str:
+    """The async version of `query_llm` - await it to get either the text, or an async iterator of chunks."""
+    provider_call(settings.model, ASYNC_PROVIDERS)
+    models = route(settings.model)
+    max_tokens = max_tokens if max_tokens is not None else settings.max_response_tokens
+    thinking_budget = thinking_budget if thinking_budget is not None else settings.thinking_budget
+
+    if stream:
+        return routed_astream(models, history, max_tokens, thinking_budget)
+
+    start = time.monotonic()
+
+    async def answer(model: str, latencies: Latencies | None = None) -> tuple[str, str]:
+        return model, await acall_model(model, history, max_tokens, thinking_budget, latencies)
+
+    if hedge and len(models) > 1:
+        model, text = await ahedged(
+            [partial(answer, model, hedge_latencies(model)) for model in models], hedge_delay(models[0])
+        )
+    else:
+        model, text = await afirst_success(models, answer)
+    if timer is not None:
+        timer.observe(time.monotonic() - start, model=model, provider=provider_of(model))
+    return text
@@ -1,28 +1,142 @@
+import atexit
 import json
+import os
+import sys
+import threading
+import time
 from logging import *
-from typing import List
+from logging.handlers import QueueHandler, QueueListener
+from queue import Full, Queue
+from typing import List, TYPE_CHECKING
 
+import requests
 from discord_webhook import DiscordWebhook
 
-from stampy_chat.citations import Message
-from stampy_chat.db.models import Interaction
-from stampy_chat.db.session import ItemAdder
-from stampy_chat.env import DISCORD_LOG_LEVEL, DISCORD_LOGGING_URL, LOG_LEVEL
+from stampy_chat.db.models import Interaction, PromptBlob
+from stampy_chat.db.session import item_adder
+from stampy_chat.env import (
+    DISCORD_BATCH_WINDOW,
+    DISCORD_LOG_LEVEL,
+    DISCORD_LOGGING_URL,
+    DISCORD_MAX_BATCHES,
+    DISCORD_MAX_PENDING,
+    DISCORD_SEND_INTERVAL,
+    LOG_LEVEL,
+    LOG_QUEUE_SIZE,
+)
+from stampy_chat.metrics import Gauge
+from stampy_chat.prompt_store import known_blobs, segment_prompt
+
+if TYPE_CHECKING:
+    # citations uses this module for its logger
+    from stampy_chat.citations import Message
 
 MAX_MESSAGE_LEN = 2000 - 8
 
 
-class DiscordHandler(StreamHandler):
+class DiscordHandler(Handler):
+    """Sends log messages to a Discord webhook.
+
+    Messages are collected for `window` seconds, then sent in as few webhook calls as possible,
+    no more often than every `DISCORD_SEND_INTERVAL` seconds. Repeated messages are merged, and
+    during floods anything past `max_pending` messages (or `DISCORD_MAX_BATCHES` calls) is
+    dropped, with a note saying how many were lost.
+    """
+
+    def __init__(self, window=DISCORD_BATCH_WINDOW, max_pending=DISCORD_MAX_PENDING):
+        super().__init__()
+        self.window = window
+        self.max_pending = max_pending
+        self.pending: list[str] = []
+        self.dropped = 0
+        self.last_sent = 0.0
+        self._thread = None
+        self._pid = None
+
     def emit(self, record):
         # Ignore messages that come from non chat modules
         if record.name.startswith("stampy_chat"):
             return
 
+        # Ignore messages that don't come from a ChatLogger
+        if not getattr(record, "chat_logger", False):
+            return
+
         # Ignore messages that have lower levels
         if record.levelno < getLevelName(DISCORD_LOG_LEVEL):
             return
 
-        self.to_discord(self.format(record))
+        self.add(self.format(record))
+
+    def add(self, message: str):
+        if not DISCORD_LOGGING_URL:
+            return
+        self._ensure_thread()
+        with self.lock:
+            if len(self.pending) >= self.max_pending:
+                self.dropped += 1
+            else:
+                self.pending.append(message)
+
+    def _ensure_thread(self):
+        # Threads don't survive a fork, so each (gunicorn worker) process needs its own
+        if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+            with self.lock:
+                if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+                    self._pid = os.getpid()
+                    self._thread = threading.Thread(target=self._run, name="discord-logger", daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.window)
+            self.flush()
+
+    @staticmethod
+    def batches(messages: list[str], dropped: int = 0) -> list[str]:
+        """Pack the messages into as few Discord messages as possible, merging duplicates."""
+        counts: dict[str, int] = {}
+        for message in messages:
+            counts[message] = counts.get(message, 0) + 1
+        lines = [m if n == 1 else f"{m}\n(repeated {n} times)" for m, n in counts.items()]
+
+        batches, current = [], ""
+        for line in lines:
+            # Lines that are too long on their own get split up
+            while len(line) > MAX_MESSAGE_LEN:
+                if current:
+                    batches.append(current)
+                    current = ""
+                batches.append(line[:MAX_MESSAGE_LEN])
+                line = line[MAX_MESSAGE_LEN:]
+            if current and len(current) + 1 + len(line) > MAX_MESSAGE_LEN:
+                batches.append(current)
+                current = ""
+            current = f"{current}\n{line}" if current else line
+        if current:
+            batches.append(current)
+
+        if len(batches) > DISCORD_MAX_BATCHES:
+            dropped += sum(b.count("\n") + 1 for b in batches[DISCORD_MAX_BATCHES - 1:])
+            batches = batches[:DISCORD_MAX_BATCHES - 1]
+        if dropped:
+            batches.append(f"... and {dropped} more log lines were dropped")
+        return batches
+
+    def flush(self):
+        with self.lock:
+            messages, self.pending = self.pending, []
+            dropped, self.dropped = self.dropped, 0
+        for batch in self.batches(messages, dropped):
+            # Stay within Discord's rate limits
+            delay = self.last_sent + DISCORD_SEND_INTERVAL - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.to_discord(batch)
+
+    def close(self):
+        self.flush()
+        super().close()
 
     def to_discord(self, message):
         if not DISCORD_LOGGING_URL:
@@ -30,18 +144,78 @@ class DiscordHandler(StreamHandler):
 
         while len(message) > MAX_MESSAGE_LEN:
             m_section, message = message[:MAX_MESSAGE_LEN], message[MAX_MESSAGE_LEN:]
-            m_section = "```\n" + m_section + "\n```"
-            DiscordWebhook(url=DISCORD_LOGGING_URL, content=m_section).execute()
-        DiscordWebhook(
-            url=DISCORD_LOGGING_URL, content="```\n" + message + "\n```"
-        ).execute()
+            self.send("```\n" + m_section + "\n```")
+        self.send("```\n" + message + "\n```")
+
+    def send(self, content: str):
+        """Call the webhook, retrying once if Discord says it's being called too often."""
+        try:
+            response = DiscordWebhook(url=DISCORD_LOGGING_URL, content=content).execute()
+            if getattr(response, "status_code", None) == 429:
+                time.sleep(float(response.json().get("retry_after", DISCORD_SEND_INTERVAL)))
+                DiscordWebhook(url=DISCORD_LOGGING_URL, content=content).execute()
+        except (requests.RequestException, ValueError) as e:
+            # Logging this would just end up back here
+            print(f"Could not send logs to Discord: {e}", file=sys.stderr)
+        finally:
+            self.last_sent = time.monotonic()
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """Puts records on a queue for a `QueueListener` thread to handle, dropping them if the queue is full.
+
+    The listener is started on first use in each process, as threads don't survive forks.
+    """
+
+    def __init__(self, queue: Queue, *handlers: Handler):
+        super().__init__(queue)
+        self.targets = handlers
+        self.dropped = 0
+        self.listener = None
+        self._pid = None
+
+    def _ensure_listener(self):
+        if self.listener is None or self._pid != os.getpid() or not self.listener._thread:
+            with self.lock:
+                if self.listener is None or self._pid != os.getpid() or not self.listener._thread:
+                    self._pid = os.getpid()
+                    self.listener = QueueListener(self.queue, *self.targets, respect_handler_level=True)
+                    self.listener.start()
+
+    def enqueue(self, record):
+        self._ensure_listener()
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+    def stop(self):
+        """Handle everything that's already been queued, and stop the listener."""
+        if self.listener is not None and self._pid == os.getpid() and self.listener._thread:
+            try:
+                self.listener.stop()
+            except Full:
+                pass
+
+    def stats(self) -> dict[str, int]:
+        return {"queued": self.queue.qsize(), "dropped": self.dropped}
+
+
+def mark_chat_record(record):
+    """Tag records logged by `ChatLogger`s, as only those are sent to Discord."""
+    record.chat_logger = True
+    return True
+
+
+# Blobs only count as known once they're actually in the database
+item_adder.on_written.append(known_blobs.written)
 
 
 class ChatLogger(Logger):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.addHandler(DiscordHandler())
-        self.item_adder = ItemAdder()
+        self.addFilter(mark_chat_record)
+        self.item_adder = item_adder
 
     def is_debug(self):
         return self.isEnabledFor(DEBUG)
@@ -51,22 +225,27 @@ class ChatLogger(Logger):
         session_id: str,
         query: str,
         response: str,
-        history: List[Message],
-        prompt: str,
+        history: List["Message"],
+        prompt: List["Message"],
         blocks: List[dict],
+        cancelled: bool = False,
     ):
+        segments, blobs = segment_prompt(prompt or [])
         self.item_adder.add(
+            *(PromptBlob(hash=h, content=blobs[h]) for h in known_blobs.new(blobs)),
             Interaction(
                 session_id=session_id,
                 interaction_no=len([i for i in history if i.get("role") in ["user"]]),
                 query=query,
-                prompt=prompt,
+                prompt_segments=segments,
                 response=response,
-                chunks=",".join(b.get("id") for b in blocks),
+                chunks=",".join(b.get("id") for b in blocks or []),
+                cancelled=cancelled,
             )
         )
         self.info("query: %s", query)
-        self.info("response: %s", response)
+        self.info("response%s: %s chars", " (cancelled)" if cancelled else "", len(response or ""))
+        self.debug("response: %s", response)
 
     def moderation_issue(self, query, prompt_string, mod_res):
         # this is a biiig ask of a discord webhook - put most important
@@ -83,5 +262,24 @@ class ChatLogger(Logger):
             self.warn(message)
 
 
+discord_handler = DiscordHandler()
+# Everything is logged via this queue, so that writing logs never blocks the thread doing the logging
+queue_handler = NonBlockingQueueHandler(Queue(maxsize=LOG_QUEUE_SIZE), StreamHandler(), discord_handler)
+
+
+Gauge("stampy_chat_log_queue_depth", "How many log records are waiting to be handled", function=queue_handler.queue.qsize)
+Gauge(
+    "stampy_chat_discord_pending",
+    "How many log messages are waiting to be sent to Discord",
+    function=lambda: len(discord_handler.pending),
+)
+
+
+def log_stats() -> dict[str, int]:
+    return {**queue_handler.stats(), "discord_pending": len(discord_handler.pending), "discord_dropped": discord_handler.dropped}
+
+
 setLoggerClass(ChatLogger)
-basicConfig(level=getLevelName(LOG_LEVEL))
+basicConfig(level=getLevelName(LOG_LEVEL), handlers=[queue_handler])
+# Runs before `logging.shutdown`, which then flushes the Discord handler
+atexit.register(queue_handler.stop)
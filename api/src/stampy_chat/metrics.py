@@ -0,0 +1,228 @@
+"""Prometheus style metrics of the chat pipeline, served on /metrics by the API and the MCP server.
+
+The metrics are kept in-process, per worker, like the stats on /admin/workers. They're meant to be
+left on in production: histograms have fixed buckets, so an observation is a bisect and a couple
+of additions under a lock, and labels are limited to things with few values (models, providers,
+backends). Gauges that just mirror some existing state (queue depths etc.) are read when the
+metrics are scraped, rather than being kept up to date.
+
+The text format is https://prometheus.io/docs/instrumenting/exposition_formats/
+"""
+import bisect
+import hmac
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator, Sequence
+
+from stampy_chat.env import METRICS_TOKEN
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+INTER_TOKEN_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+TOKEN_RATE_BUCKETS = (5, 10, 20, 40, 60, 80, 100, 150, 200, 300, 500)
+
+REGISTRY: dict[str, "Metric"] = {}
+
+
+def escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """A metric, with one value per combination of label values.
+
+    :param str name: the metric name, e.g. `stampy_chat_hyde_seconds`
+    :param str help: what is being measured
+    :param labels: the names of the labels every observation must provide
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        REGISTRY[name] = self
+
+    def _key(self, labels: dict) -> tuple[str, ...]:
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} expects the labels {self.labels}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}", *self.samples()]
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield f"{self.name}{format_labels(self.labels, key)} {format_value(value)}"
+
+
+class Gauge(Metric):
+    """A value that goes up and down. If `function` is given, it's called to get the value when scraped."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), function: Callable[[], float] | None = None):
+        super().__init__(name, help, labels)
+        self.function = function
+        self._values: dict[tuple, float] = {}
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track(self, **labels):
+        """Count the body as in progress while it runs."""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    def samples(self) -> Iterator[str]:
+        if self.function is not None:
+            try:
+                yield f"{self.name} {format_value(self.function())}"
+            except Exception:
+                # Better to skip a value than to fail the whole scrape
+                pass
+            return
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield f"{self.name}{format_labels(self.labels, key)} {format_value(value)}"
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        # Per label values: the (non cumulative) count of each bucket plus +Inf, the sum, and the count
+        self._values: dict[tuple, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = ([0] * (len(self.buckets) + 1), [0.0, 0])
+            counts, totals = self._values[key]
+            counts[index] += 1
+            totals[0] += value
+            totals[1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe how many seconds the body took to run."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = [(key, list(counts), list(totals)) for key, (counts, totals) in self._values.items()]
+        for key, counts, (total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = f'le="{format_value(bound)}"'
+                yield f"{self.name}_bucket{format_labels(self.labels, key, le)} {cumulative}"
+            yield f"{self.name}_sum{format_labels(self.labels, key)} {format_value(total)}"
+            yield f"{self.name}_count{format_labels(self.labels, key)} {int(count)}"
+
+
+def render() -> str:
+    """All the registered metrics, in the Prometheus text format."""
+    return "\n".join(metric.render() for metric in list(REGISTRY.values())) + "\n"
+
+
+def authorized(header: str | None, token: str | None = METRICS_TOKEN) -> bool:
+    """Whether a request with this `Authorization` header may scrape the metrics."""
+    return not token or hmac.compare_digest(header or "", f"Bearer {token}")
+
+
+### The chat pipeline ###
+
+HYDE_SECONDS = Histogram(
+    "stampy_chat_hyde_seconds", "How long generating hypothetical documents took", ("model", "provider")
+)
+EMBEDDING_SECONDS = Histogram(
+    "stampy_chat_embedding_seconds", "How long embedding API calls took", ("model", "provider")
+)
+VECTOR_SEARCH_SECONDS = Histogram(
+    "stampy_chat_vector_search_seconds", "How long vector index queries took", ("backend",)
+)
+PROMPT_BUILD_SECONDS = Histogram("stampy_chat_prompt_build_seconds", "How long building the LLM prompt took")
+LLM_TTFT_SECONDS = Histogram(
+    "stampy_chat_llm_time_to_first_token_seconds",
+    "How long LLM streams took to produce their first chunk",
+    ("model", "provider"),
+)
+LLM_INTER_TOKEN_SECONDS = Histogram(
+    "stampy_chat_llm_inter_token_seconds",
+    "The time between consecutive chunks of LLM streams",
+    ("model", "provider"),
+    buckets=INTER_TOKEN_BUCKETS,
+)
+LLM_TOKENS_PER_SECOND = Histogram(
+    "stampy_chat_llm_tokens_per_second",
+    "The output rate of LLM streams, after the first chunk",
+    ("model", "provider"),
+    buckets=TOKEN_RATE_BUCKETS,
+)
+FOLLOWUPS_SECONDS = Histogram(
+    "stampy_chat_followups_seconds", "How long finding followups at the end of an answer took", ("backend",)
+)
+DB_WRITE_LAG_SECONDS = Histogram(
+    "stampy_chat_db_write_lag_seconds", "How long items waited in the queue before being written to the database"
+)
+STREAMS_IN_FLIGHT = Gauge("stampy_chat_streams_in_flight", "How many chat answers are being streamed", ("server",))
@@ -0,0 +1,135 @@
+"""Content addressed storage of prompt sets.
+
+Prompt sets are large (the default system prompt alone is ~150 KB), so rather than sending them
+with every chat request, clients can upload them once via `POST /prompts` and then only send the
+returned `promptsHash` in their settings. The registry is per process and bounded, both in the
+number of prompt sets and in their total size, so a hash can always turn out to be unknown (e.g.
+it was evicted, or the request hit a different worker). In that case the request is rejected with
+`UnknownPrompts` (a 409), and clients must upload the prompts again and retry - a hash is only a
+way to avoid resending the prompts, never the only copy of them.
+"""
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+from frozendict import deepfreeze, frozendict
+
+from stampy_chat.env import PROMPT_REGISTRY_BYTES, PROMPT_REGISTRY_SIZE, PROMPTS_MAX_BYTES
+from stampy_chat.settings import DEFAULT_PROMPTS
+
+
+class UnknownPrompts(KeyError):
+    """Raised when a prompt set is requested by a hash that isn't in the registry."""
+
+    def __init__(self, prompts_hash: str):
+        self.prompts_hash = prompts_hash
+        super().__init__(prompts_hash)
+
+
+class PromptsTooLarge(ValueError):
+    """Raised when a prompt set is too big to be registered."""
+
+    def __init__(self, size: int, max_bytes: int):
+        self.size = size
+        self.max_bytes = max_bytes
+        super().__init__(f"the prompts are {size} bytes, but can be at most {max_bytes}")
+
+
+def serialize_prompts(prompts: dict) -> bytes:
+    return json.dumps(prompts, sort_keys=True, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def hash_prompts(prompts: dict) -> str:
+    """Return the content hash of the provided prompts. Key order doesn't matter."""
+    return hashlib.sha256(serialize_prompts(prompts)).hexdigest()
+
+
+class PromptRegistry:
+    """A thread safe LRU store of frozen prompt sets, keyed by their content hash.
+
+    :param int max_size: how many prompt sets to keep
+    :param int max_bytes: how big (as JSON) all the prompt sets can be in total
+    :param int max_entry_bytes: how big a single prompt set can be
+    """
+
+    def __init__(
+        self,
+        max_size: int = PROMPT_REGISTRY_SIZE,
+        max_bytes: int = PROMPT_REGISTRY_BYTES,
+        max_entry_bytes: int = PROMPTS_MAX_BYTES,
+    ):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = min(max_entry_bytes, max_bytes)
+        self.bytes = 0
+        self._prompts: OrderedDict[str, tuple[frozendict, int]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def register(self, prompts: dict) -> str:
+        """Store the prompts, returning their hash. Registering the same prompts again is a no-op.
+
+        :raises PromptsTooLarge: if the prompts are bigger than `max_entry_bytes`
+        """
+        serialized = serialize_prompts(prompts)
+        if len(serialized) > self.max_entry_bytes:
+            raise PromptsTooLarge(len(serialized), self.max_entry_bytes)
+
+        prompts_hash = hashlib.sha256(serialized).hexdigest()
+        with self._lock:
+            if prompts_hash in self._prompts:
+                self._prompts.move_to_end(prompts_hash)
+                return prompts_hash
+
+        frozen = deepfreeze(prompts)
+        with self._lock:
+            if prompts_hash not in self._prompts:
+                self._prompts[prompts_hash] = (frozen, len(serialized))
+                self.bytes += len(serialized)
+            self._prompts.move_to_end(prompts_hash)
+            while len(self._prompts) > self.max_size or self.bytes > self.max_bytes:
+                _, (_, size) = self._prompts.popitem(last=False)
+                self.bytes -= size
+        return prompts_hash
+
+    def get(self, prompts_hash: str) -> frozendict:
+        """Get the frozen prompts for the given hash, raising `UnknownPrompts` if they aren't known."""
+        with self._lock:
+            try:
+                self._prompts.move_to_end(prompts_hash)
+                return self._prompts[prompts_hash][0]
+            except KeyError:
+                raise UnknownPrompts(prompts_hash) from None
+
+    def __contains__(self, prompts_hash: str) -> bool:
+        with self._lock:
+            return prompts_hash in self._prompts
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._prompts)
+
+
+registry = PromptRegistry()
+DEFAULT_PROMPTS_HASH = registry.register(DEFAULT_PROMPTS)
+
+
+def resolve_prompts(settings: dict) -> dict:
+    """Replace any `promptsHash` in the provided settings with the actual prompts it refers to.
+
+    Settings that contain the full `prompts` are returned as is, so older clients keep on working.
+    The default prompts are always available, even if they have been evicted.
+    """
+    prompts_hash = settings.get("promptsHash")
+    if prompts_hash is None or "prompts" in settings:
+        return {k: v for k, v in settings.items() if k != "promptsHash"}
+
+    try:
+        prompts = registry.get(prompts_hash)
+    except UnknownPrompts:
+        if prompts_hash != DEFAULT_PROMPTS_HASH:
+            raise
+        registry.register(DEFAULT_PROMPTS)
+        prompts = registry.get(prompts_hash)
+
+    return {**{k: v for k, v in settings.items() if k != "promptsHash"}, "prompts": prompts}
@@ -0,0 +1,149 @@
+"""Content addressed storage of the prompts sent to the LLM.
+
+Most of every prompt is the same from one interaction to the next - the reference documents in the
+system prompt, the pre and post message instructions, earlier turns of the conversation, often
+even the retrieved blocks. Rather than storing the whole thing for each interaction, prompts are
+split into chunks, and any chunk big enough to be worth it is stored once in the `prompt_blobs`
+table, keyed by its hash. Interactions only store the list of chunks, with the big ones replaced by
+`{"blob": <hash>}` references.
+
+Chunk boundaries are picked by looking at the paragraphs themselves, rather than at fixed offsets,
+so the same text gets split the same way even when it's surrounded by different text (e.g. the
+static prompts around a different query).
+"""
+import hashlib
+import threading
+import zlib
+from collections import OrderedDict
+from typing import Iterable, Mapping, Sequence
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from stampy_chat.db.models import Interaction, PromptBlob
+
+PARAGRAPH = "\n\n"
+# Chunks smaller than this are stored inline
+BLOB_MIN_CHARS = 1024
+# Chunks end on a paragraph that hashes to 0 mod this, once they're at least BLOB_MIN_CHARS long...
+BOUNDARY_MODULUS = 4
+# ...or when they get this long
+CHUNK_MAX_CHARS = 64 * 1024
+# How many blob hashes to remember as already stored
+KNOWN_BLOBS = 10_000
+
+Segment = str | dict[str, str]
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def split_content(text: str) -> list[str]:
+    """Split the text into chunks on paragraph boundaries, such that `PARAGRAPH.join(chunks) == text`."""
+    chunks, current, size = [], [], 0
+    for paragraph in text.split(PARAGRAPH):
+        current.append(paragraph)
+        size += len(paragraph) + len(PARAGRAPH)
+        boundary = zlib.crc32(paragraph.encode("utf-8")) % BOUNDARY_MODULUS == 0
+        if (size >= BLOB_MIN_CHARS and boundary) or size >= CHUNK_MAX_CHARS:
+            chunks.append(PARAGRAPH.join(current))
+            current, size = [], 0
+    if current:
+        chunks.append(PARAGRAPH.join(current))
+    return chunks
+
+
+def segment_prompt(messages: Iterable[Mapping]) -> tuple[list[dict], dict[str, str]]:
+    """Split the messages into segments, replacing big chunks with blob references.
+
+    :returns: the segmented messages, and the contents of all referenced blobs by their hash
+    """
+    segmented, blobs = [], {}
+    for message in messages:
+        segments: list[Segment] = []
+        for chunk in split_content(message.get("content") or ""):
+            if len(chunk) >= BLOB_MIN_CHARS:
+                blob_hash = content_hash(chunk)
+                blobs[blob_hash] = chunk
+                segments.append({"blob": blob_hash})
+            else:
+                segments.append(chunk)
+        segmented.append({"role": message.get("role"), "content": segments})
+    return segmented, blobs
+
+
+def reconstruct_prompt(segmented: Sequence[Mapping], blobs: Mapping[str, str]) -> list[dict]:
+    """The inverse of `segment_prompt`.
+
+    :raises KeyError: if a referenced blob isn't in `blobs`
+    """
+    return [
+        {
+            "role": message["role"],
+            "content": PARAGRAPH.join(
+                blobs[segment["blob"]] if isinstance(segment, dict) else segment for segment in message["content"]
+            ),
+        }
+        for message in segmented
+    ]
+
+
+def blob_hashes(segmented: Sequence[Mapping]) -> set[str]:
+    return {
+        segment["blob"] for message in segmented for segment in message["content"] if isinstance(segment, dict)
+    }
+
+
+def load_prompt(session: Session, interaction: Interaction) -> list[dict] | str | None:
+    """Return the full prompt of the interaction.
+
+    Interactions from before prompts were segmented only have the old formatted prompt string, which is
+    returned as is.
+    """
+    if interaction.prompt_segments is None:
+        return interaction.prompt
+
+    hashes = blob_hashes(interaction.prompt_segments)
+    blobs = dict(session.execute(select(PromptBlob.hash, PromptBlob.content).where(PromptBlob.hash.in_(hashes))).all())
+    return reconstruct_prompt(interaction.prompt_segments, blobs)
+
+
+class KnownBlobs:
+    """The hashes of recently stored blobs, so that the static ones aren't sent to the database every time.
+
+    Hashes are only remembered once the database writer has actually stored their blobs - a blob that was
+    dropped or failed to be written will be sent again with the next interaction that refers to it.
+    """
+
+    def __init__(self, size: int = KNOWN_BLOBS):
+        self.size = size
+        self._hashes: OrderedDict[str, None] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def new(self, hashes: Iterable[str]) -> list[str]:
+        """Return which of the hashes aren't known to be stored."""
+        unseen = []
+        with self._lock:
+            for blob_hash in hashes:
+                if blob_hash in self._hashes:
+                    self._hashes.move_to_end(blob_hash)
+                else:
+                    unseen.append(blob_hash)
+        return unseen
+
+    def add(self, hashes: Iterable[str]):
+        """Remember the hashes as stored."""
+        with self._lock:
+            for blob_hash in hashes:
+                self._hashes[blob_hash] = None
+                self._hashes.move_to_end(blob_hash)
+            while len(self._hashes) > self.size:
+                self._hashes.popitem(last=False)
+
+    def written(self, items: Iterable):
+        """Remember the blobs among the items the database writer has just committed."""
+        self.add(item.hash for item in items if isinstance(item, PromptBlob))
+
+
+known_blobs = KnownBlobs()
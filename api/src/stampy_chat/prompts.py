@@ -1,9 +1,14 @@
+from dataclasses import dataclass
 from pathlib import Path
+from string import Formatter
 from typing import Sequence
 import datetime
+import functools
+import re
 
 from stampy_chat.citations import Block, Message
-from stampy_chat.settings import Settings, num_tokens
+from stampy_chat.settings import Settings
+from stampy_chat.tokens import count_tokens
 from xml.sax.saxutils import escape
 
 from stampy_chat import logging
@@ -23,20 +28,126 @@ except FileNotFoundError:
     raise SystemExit(1)
 logger.info("Done loading prompts")
 
+# Prompt templates are compiled once into a render plan, i.e. a list of static text segments (with all
+# the prompts from ALL_PROMPTS already inlined) interspersed with slots for the values that change
+# between requests (date, modelname, mode etc.). Rendering a template is then just a join.
+FORMATTER = Formatter()
+SENTINEL = "\x00"
+SENTINEL_RE = re.compile(f"{SENTINEL}(\\d+){SENTINEL}")
+TEMPLATE_CACHE_SIZE = 128
+
+
+@dataclass(frozen=True)
+class Slot:
+    name: str
+    conversion: str | None
+    format_spec: str
+    # Values inserted in the first pass get formatted again by the second pass
+    reformat: bool = False
+
+    def render(self, vals: dict) -> str:
+        value, _ = FORMATTER.get_field(self.name, (), vals)
+        value = FORMATTER.format_field(FORMATTER.convert_field(value, self.conversion), self.format_spec)
+        if self.reformat and ("{" in value or "}" in value):
+            value = value.format(**vals)
+        return value
+
+
+def _is_prompt(field_name: str) -> bool:
+    return field_name.partition(".")[0].partition("[")[0] in ALL_PROMPTS
+
+
+def _format_prompt_field(field_name: str, conversion: str | None, format_spec: str) -> str:
+    value, _ = FORMATTER.get_field(field_name, (), ALL_PROMPTS)
+    return FORMATTER.format_field(FORMATTER.convert_field(value, conversion), format_spec)
+
+
+def _add_static(plan: list, text: str):
+    if not text:
+        return
+    if plan and isinstance(plan[-1], str):
+        plan[-1] += text
+    else:
+        plan.append(text)
+
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def compile_template(template: str, second_pass: bool = True) -> tuple[str | Slot, ...]:
+    """Compile the template into a render plan.
+
+    With `second_pass`, this is equivalent to `template.format(**vals, **ALL_PROMPTS).format(**vals)`,
+    otherwise to `template.format(**vals, **ALL_PROMPTS)`. Any field that isn't the name of a prompt
+    is treated as a slot, to be filled in at render time.
+    """
+    plan: list[str | Slot] = []
+    if not second_pass:
+        for literal, field_name, format_spec, conversion in FORMATTER.parse(template):
+            _add_static(plan, literal)
+            if field_name is None:
+                continue
+            if _is_prompt(field_name):
+                _add_static(plan, _format_prompt_field(field_name, conversion, format_spec))
+            else:
+                plan.append(Slot(field_name, conversion, format_spec))
+        return tuple(plan)
+
+    # The first pass inlines all prompts, leaving sentinels in place of the other fields, as they
+    # must survive the second pass untouched
+    slots: list[Slot] = []
+    first_pass = []
+    for literal, field_name, format_spec, conversion in FORMATTER.parse(template):
+        first_pass.append(literal)
+        if field_name is None:
+            continue
+        if _is_prompt(field_name):
+            first_pass.append(_format_prompt_field(field_name, conversion, format_spec))
+        else:
+            first_pass.append(f"{SENTINEL}{len(slots)}{SENTINEL}")
+            slots.append(Slot(field_name, conversion, format_spec, reformat=True))
+
+    for literal, field_name, format_spec, conversion in FORMATTER.parse("".join(first_pass)):
+        for i, part in enumerate(SENTINEL_RE.split(literal)):
+            if i % 2:
+                plan.append(slots[int(part)])
+            else:
+                _add_static(plan, part)
+        if field_name is not None:
+            plan.append(Slot(field_name, conversion, format_spec))
+    return tuple(plan)
+
+
+def render_template(template: str, vals: dict, second_pass: bool = True) -> str:
+    return "".join(
+        part if isinstance(part, str) else part.render(vals)
+        for part in compile_template(template, second_pass)
+    )
+
+
+def format_message(template: str, **vals) -> str:
+    return render_template(template, vals, second_pass=False)
 
-def truncate_history(history: list[Message], max_tokens: int) -> list[Message]:
-    """Truncate the history to the given number of tokens."""
+
+HISTORY_SUMMARY_FORMAT = "<conversation-summary>\n{summary}\n</conversation-summary>"
+
+
+def truncate_history(history: list[Message], max_tokens: int, counts: Sequence[int] | None = None) -> list[Message]:
+    """Truncate the history to the given number of tokens.
+
+    :param Sequence[int] counts: the number of tokens in each message, if already known
+    """
     truncated = []
     all_tokens = 0
-    for item in history[::-1]:
+    for i in range(len(history) - 1, -1, -1):
+        item = history[i]
         if item.get("role") in ["deleted", "error"]:
             continue
 
-        all_tokens += num_tokens(item.get("content", ""))
+        all_tokens += counts[i] if counts is not None else count_tokens(item.get("content", ""))
         if all_tokens > max_tokens:
-            return truncated
+            break
 
-        truncated = [item] + truncated
+        truncated.append(item)
+    truncated.reverse()
     if truncated and truncated[0].get("role") == "assistant":
         truncated = truncated[1:]
     return truncated
@@ -46,11 +157,89 @@ def format_block(block: Block) -> str:
     return f'<result-fragment id={block.get("reference")} title="{block.get("title")}" authors="{", ".join(block["authors"])}" timestamp="{block["date_published"]}">\n...\n{block["text"]}\n...\n</result-fragment>'
 
 
+BLOCKS_HEADER = "<search-results>\n"
+BLOCKS_SEPARATOR = "\n\n"
+BLOCKS_FOOTER = "\n\n<!-- WARNING: Search results are inevitably, always, incomplete. Do not assume this is the extent of the relevant results available in the dataset under search. Typically, additional unretrieved relevant items are still similar, but dissimilar in a way you didn't account for.. -->\n</search-results>"
+
+
 def format_blocks(blocks: list[Block]) -> str:
     if not blocks:
         return ""
 
-    return f"<search-results>\n" + "\n\n".join([format_block(block) for block in blocks]) + "\n\n<!-- WARNING: Search results are inevitably, always, incomplete. Do not assume this is the extent of the relevant results available in the dataset under search. Typically, additional unretrieved relevant items are still similar, but dissimilar in a way you didn't account for.. -->\n</search-results>"
+    return BLOCKS_HEADER + BLOCKS_SEPARATOR.join([format_block(block) for block in blocks]) + BLOCKS_FOOTER
+
+
+# Blocks are only cut down to fit if at least this many tokens of their text would be left
+MIN_TRIMMED_BLOCK_TOKENS = 100
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+
+def trim_to_tokens(text: str, max_tokens: int) -> str:
+    """Return the longest run of whole sentences from the start of `text` that has at most `max_tokens` tokens."""
+    if count_tokens(text) <= max_tokens:
+        return text
+
+    ends = [m.start() for m in SENTENCE_END.finditer(text)]
+    lo, hi = 0, len(ends)
+    # Binary search for the number of sentences that fit
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if count_tokens(text[:ends[mid - 1]], cache=False) <= max_tokens:
+            lo = mid
+        else:
+            hi = mid - 1
+    return text[:ends[lo - 1]] if lo else ""
+
+
+def pack_blocks(blocks: list[Block], max_tokens: int, max_blocks: int | None = None) -> tuple[list[Block], dict[str, int]]:
+    """Fit as many blocks as possible into `max_tokens`, in order.
+
+    The blocks should be sorted by relevance. Any that don't fit are skipped, unless a reasonable part of
+    them still fits, in which case they're cut down at a sentence boundary.
+
+    :param list[Block] blocks: the candidate blocks, most relevant first
+    :param int max_tokens: how many tokens the formatted blocks can use
+    :param int max_blocks: the maximum number of blocks to use
+    :returns: the blocks to use, and stats about how they were packed
+    """
+    separator = count_tokens(BLOCKS_SEPARATOR)
+    remaining = max_tokens - count_tokens(BLOCKS_HEADER) - count_tokens(BLOCKS_FOOTER) + separator
+    packed, trimmed, dropped = [], 0, 0
+    for block in blocks:
+        if max_blocks is not None and len(packed) >= max_blocks:
+            break
+
+        cost = count_tokens(format_block(block)) + separator
+        if cost > remaining:
+            text_tokens = count_tokens(block["text"])
+            available = remaining - (cost - text_tokens)
+            text = trim_to_tokens(block["text"], available) if available >= MIN_TRIMMED_BLOCK_TOKENS else ""
+            if text:
+                block = {**block, "text": text}
+                cost = count_tokens(format_block(block), cache=False) + separator
+            if not text or cost > remaining:
+                dropped += 1
+                continue
+            trimmed += 1
+
+        packed.append(block)
+        remaining -= cost
+
+    used = max_tokens - remaining if packed else 0
+    return packed, {"context_tokens": used, "context_budget": max_tokens, "blocks": len(packed), "trimmed": trimmed, "dropped": dropped}
+
+
+def prompt_tokens(prompt: Sequence[Message]) -> dict[str, int]:
+    """How many tokens the system prompts, the history and the final message of the prompt use."""
+    counts = [count_tokens(message["content"]) for message in prompt]
+    system = sum(c for message, c in zip(prompt, counts) if message["role"] == "system")
+    last = counts[-1] if prompt and prompt[-1]["role"] != "system" else 0
+    return {
+        "system_tokens": system,
+        "history_tokens": sum(counts) - system - last,
+        "message_tokens": last,
+        "prompt_tokens": sum(counts),
+    }
 
 
 def format_history(history: list[Message], settings: Settings) -> list[Message]:
@@ -58,8 +247,8 @@ def format_history(history: list[Message], settings: Settings) -> list[Message]:
         (
             {
                 "role": "user",
-                "content": settings.message_format.format(
-                    message_id=index, message=escape(message["content"]), **ALL_PROMPTS
+                "content": format_message(
+                    settings.message_format, message_id=index, message=escape(message["content"])
                 ),
             }
             if message["role"] == "user"
@@ -97,9 +286,21 @@ def inject_guidance(
     history: list[Message],
     docs: list[Block],
     settings: Settings,
+    summary: str | None = None,
+    counts: Sequence[int] | None = None,
 ) -> Sequence[Message]:
-    history = truncate_history(history, settings.history_tokens)
+    """Build the prompt for the query.
+
+    :param str summary: a summary of the conversation before `history`. This goes in the first user message
+      rather than the system prompt, so that the cached system prompt stays the same for all sessions
+    :param Sequence[int] counts: the number of tokens in each message of `history`, if already known
+    """
+    history = truncate_history(history, settings.history_tokens, counts)
     history = format_history(history, settings)
+    if summary:
+        summary = HISTORY_SUMMARY_FORMAT.format(summary=summary)
+        if history:
+            history[0] = Message(role="user", content=summary + "\n\n" + history[0]["content"])
 
     last_parts = []
     vals = dict(
@@ -116,8 +317,10 @@ def inject_guidance(
         )
         last_parts.append(wrapped)
 
+    if summary and not history:
+        last_parts.append(summary)
     last_parts.append(
-        settings.message_format.format(message_id=len(history), message=escape(query), **ALL_PROMPTS)
+        format_message(settings.message_format, message_id=len(history), message=escape(query))
     )
     last_parts.append(format_blocks(docs))
 
@@ -168,7 +371,7 @@ def inject_guidance_hyde(
         last_parts.append(wrapped)
 
     last_parts.append(
-        settings.message_format.format(message_id=len(history), message=escape(query), **ALL_PROMPTS)
+        format_message(settings.message_format, message_id=len(history), message=escape(query))
     )
 
     if settings.hyde_post_message_prompt:
@@ -195,7 +398,7 @@ def inject_guidance_hyde(
 
 
 def format_prompts(template: str, vals: dict) -> str:
-    return template.format(**vals, **ALL_PROMPTS).format(**vals)
+    return render_template(template, vals)
 
 
 def inline_all_templates(prompts: dict) -> dict:
@@ -0,0 +1,400 @@
+"""Provider health tracking, circuit breakers and hedged requests for the LLM calls.
+
+Each provider gets a `ProviderHealth`, which keeps the outcomes of its recent calls, how long its
+streams took to produce a first token, and how long its non streamed calls took to complete. If too many of its calls in the last `LLM_BREAKER_WINDOW`
+seconds failed, its circuit breaker opens, and calls go straight to the equivalent models from
+`LLM_FALLBACK_MODELS` instead. After `LLM_BREAKER_COOLDOWN` seconds, a single probe call is let
+through, which closes the breaker again if it works.
+
+Latency critical calls (e.g. HyDE) can be hedged: if the first model hasn't answered within the
+`LLM_HEDGE_PERCENTILE` percentile of its recent latencies, the same request is also sent to the
+next model, and whichever answers first is used. The slower call is left to finish, so that its
+latency still counts towards the percentile.
+"""
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Awaitable, Callable, Iterable, Sequence, TypeVar
+
+from stampy_chat import logging
+from stampy_chat.env import (
+    LLM_BREAKER_COOLDOWN,
+    LLM_BREAKER_ERROR_RATE,
+    LLM_BREAKER_MIN_CALLS,
+    LLM_BREAKER_WINDOW,
+    LLM_FALLBACK_MODELS,
+    LLM_HEDGE_DELAY,
+    LLM_HEDGE_MIN_SAMPLES,
+    LLM_HEDGE_PERCENTILE,
+    LLM_HEDGE_WORKERS,
+    LLM_LATENCY_SAMPLES,
+    RETRIEVAL_WORKERS,
+)
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Hedged calls come from the HyDE threads, each of which can have its first call and a hedge running
+hedge_executor = ThreadPoolExecutor(
+    max_workers=LLM_HEDGE_WORKERS or 2 * RETRIEVAL_WORKERS, thread_name_prefix="llm-hedge"
+)
+
+
+class CircuitOpen(Exception):
+    """Raised when the circuit breakers of all the models that could handle a call are open."""
+
+    def __init__(self, models: Sequence[str]):
+        self.models = list(models)
+        super().__init__(f"No healthy provider for any of {', '.join(models)}")
+
+
+def provider_of(model: str) -> str:
+    return model.partition("/")[0]
+
+
+def is_provider_error(e: BaseException) -> bool:
+    """Whether the error says something about the provider's health, rather than about the request.
+
+    Client errors (e.g. a prompt that's too long) would fail the same way on every retry, so they
+    neither count against the provider nor get retried elsewhere - apart from timeouts, conflicts and
+    rate limits.
+    """
+    status = getattr(e, "status_code", None) or getattr(e, "code", None)
+    if isinstance(status, int) and 400 <= status < 500:
+        return status in (408, 409, 429)
+    return True
+
+
+class Latencies:
+    """The most recent latencies of something, in seconds."""
+
+    def __init__(self, samples: int = LLM_LATENCY_SAMPLES):
+        self._values: deque[float] = deque(maxlen=samples)
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float):
+        with self._lock:
+            self._values.append(seconds)
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def percentile(self, p: float, min_samples: int = 1) -> float | None:
+        """The `p`th percentile of the latencies, or None if there are fewer than `min_samples` of them."""
+        with self._lock:
+            values = sorted(self._values)
+        if not values or len(values) < min_samples:
+            return None
+        return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class ProviderHealth:
+    """The recent error rate and latencies of a provider, along with its circuit breaker.
+
+    :param str name: the provider
+    :param float window: how many seconds of outcomes to base the error rate on
+    :param int min_calls: the breaker won't open on fewer calls than this in the window
+    :param float error_rate: the fraction of failed calls which opens the breaker
+    :param float cooldown: how long the breaker stays open before letting a probe call through
+    """
+
+    def __init__(
+        self,
+        name: str,
+        window: float = LLM_BREAKER_WINDOW,
+        min_calls: int = LLM_BREAKER_MIN_CALLS,
+        error_rate: float = LLM_BREAKER_ERROR_RATE,
+        cooldown: float = LLM_BREAKER_COOLDOWN,
+    ):
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.max_error_rate = error_rate
+        self.cooldown = cooldown
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.probe_started: float | None = None
+        self.ttft = Latencies()
+        # Non streamed calls only finish once the whole answer is done, so they'd skew the time to first token
+        self.completion = Latencies()
+        self.calls = 0
+        self.failures = 0
+        self.trips = 0
+        self._outcomes: deque[tuple[float, bool]] = deque()
+        self._lock = threading.Lock()
+
+    def _prune(self, now: float):
+        while self._outcomes and self._outcomes[0][0] < now - self.window:
+            self._outcomes.popleft()
+
+    def _can_probe(self, now: float) -> bool:
+        if now - self.opened_at < self.cooldown:
+            return False
+        # A probe that never reported back doesn't block the next one forever
+        return self.probe_started is None or now - self.probe_started >= self.cooldown
+
+    def available(self) -> bool:
+        """Whether a call can be sent to this provider right now."""
+        with self._lock:
+            return self.state == CLOSED or self._can_probe(time.monotonic())
+
+    def start(self):
+        """Mark the start of a call, which is the probe if the breaker isn't closed."""
+        with self._lock:
+            now = time.monotonic()
+            if self.state != CLOSED and self._can_probe(now):
+                self.state = HALF_OPEN
+                self.probe_started = now
+
+    def first_token(self, seconds: float):
+        self.ttft.add(seconds)
+
+    def completed(self, seconds: float):
+        """Record how long a non streamed call took."""
+        self.completion.add(seconds)
+
+    def success(self):
+        with self._lock:
+            now = time.monotonic()
+            self.calls += 1
+            if self.state != CLOSED:
+                logger.warning("%s is working again, closing its circuit breaker", self.name)
+                self.state = CLOSED
+                self.probe_started = None
+                self._outcomes.clear()
+            self._outcomes.append((now, True))
+            self._prune(now)
+
+    def failure(self):
+        with self._lock:
+            now = time.monotonic()
+            self.calls += 1
+            self.failures += 1
+            self._outcomes.append((now, False))
+            self._prune(now)
+            if self.state == HALF_OPEN or (
+                self.state == CLOSED
+                and len(self._outcomes) >= self.min_calls
+                and self._error_rate() >= self.max_error_rate
+            ):
+                logger.warning("Opening the circuit breaker of %s (error rate %.2f)", self.name, self._error_rate())
+                self.state = OPEN
+                self.opened_at = now
+                self.probe_started = None
+                self.trips += 1
+
+    def release(self):
+        """Mark a call as having ended without saying anything about the provider, e.g. when cancelled."""
+        with self._lock:
+            self.probe_started = None
+
+    def error(self, e: BaseException):
+        if is_provider_error(e):
+            self.failure()
+        else:
+            self.release()
+
+    def _error_rate(self) -> float:
+        if not self._outcomes:
+            return 0.0
+        return sum(not ok for _, ok in self._outcomes) / len(self._outcomes)
+
+    def error_rate(self) -> float:
+        with self._lock:
+            self._prune(time.monotonic())
+            return self._error_rate()
+
+    def stats(self) -> dict[str, int | float | str | None]:
+        error_rate = self.error_rate()
+        with self._lock:
+            return {
+                "state": self.state,
+                "error_rate": error_rate,
+                "calls": self.calls,
+                "failures": self.failures,
+                "trips": self.trips,
+                "ttft_p50": self.ttft.percentile(50),
+                "ttft_p95": self.ttft.percentile(95),
+                "completion_p50": self.completion.percentile(50),
+                "completion_p95": self.completion.percentile(95),
+            }
+
+
+_health: dict[str, ProviderHealth] = {}
+_hedge_latencies: dict[str, Latencies] = {}
+_registry_lock = threading.Lock()
+hedges = {"started": 0, "won": 0}
+
+
+def provider_health(provider: str) -> ProviderHealth:
+    with _registry_lock:
+        if provider not in _health:
+            _health[provider] = ProviderHealth(provider)
+        return _health[provider]
+
+
+def hedge_latencies(model: str) -> Latencies:
+    """The latencies of the hedged calls to `model`, which the hedging delay is based on."""
+    with _registry_lock:
+        if model not in _hedge_latencies:
+            _hedge_latencies[model] = Latencies()
+        return _hedge_latencies[model]
+
+
+def hedge_delay(model: str) -> float:
+    """How long to wait for `model` before hedging."""
+    delay = hedge_latencies(model).percentile(LLM_HEDGE_PERCENTILE, LLM_HEDGE_MIN_SAMPLES)
+    return LLM_HEDGE_DELAY if delay is None else delay
+
+
+def fallback_models(model: str) -> list[str]:
+    """The equivalent models to use for `model`, looked up by its full name, then by its provider."""
+    fallbacks = LLM_FALLBACK_MODELS.get(model, LLM_FALLBACK_MODELS.get(provider_of(model), []))
+    if isinstance(fallbacks, str):
+        fallbacks = [fallbacks]
+    return [m for m in fallbacks if m != model]
+
+
+def route(model: str) -> list[str]:
+    """The models to try for a call to `model`, in order, skipping those whose breakers are open.
+
+    :raises CircuitOpen: if none of them are available
+    """
+    candidates = [model] + fallback_models(model)
+    models = [m for m in candidates if provider_health(provider_of(m)).available()]
+    if not models:
+        raise CircuitOpen(candidates)
+    if models[0] != model:
+        logger.info("The circuit breaker of %s is open, using %s instead", provider_of(model), models[0])
+    return models
+
+
+def first_success(models: Iterable[str], attempt: Callable[[str], T]) -> T:
+    """Return `attempt(model)` for the first model for which it works.
+
+    Only provider errors move on to the next model - anything else is raised straight away.
+    If all of them fail, the first error is raised.
+    """
+    errors = []
+    for model in models:
+        try:
+            return attempt(model)
+        except Exception as e:
+            if not is_provider_error(e):
+                raise
+            logger.warning("Call to %s failed: %s", model, e)
+            errors.append(e)
+    raise errors[0]
+
+
+async def afirst_success(models: Iterable[str], attempt: Callable[[str], Awaitable[T]]) -> T:
+    errors = []
+    for model in models:
+        try:
+            return await attempt(model)
+        except Exception as e:
+            if not is_provider_error(e):
+                raise
+            logger.warning("Call to %s failed: %s", model, e)
+            errors.append(e)
+    raise errors[0]
+
+
+def _count_hedge(winner: int):
+    with _registry_lock:
+        if winner > 0:
+            hedges["won"] += 1
+
+
+def _started(call: Callable[[], T], started: Future) -> T:
+    started.set_result(None)
+    return call()
+
+
+def hedged(calls: Sequence[Callable[[], T]], delay: float) -> T:
+    """Run the first call, starting the next one whenever nothing has succeeded for `delay` seconds
+    (or straight away when a call fails), and return the first result.
+
+    The delay is counted from when a call actually starts running, so that time spent waiting for a
+    free thread doesn't look like a slow provider and start hedges that would only add to the queue.
+
+    :raises: the first error, if all the calls failed
+    """
+    remaining = list(enumerate(calls))
+    pending: dict[Future, int] = {}
+    errors = []
+    while remaining or pending:
+        if remaining:
+            index, call = remaining.pop(0)
+            if index > 0:
+                with _registry_lock:
+                    hedges["started"] += 1
+            started = Future()
+            pending[hedge_executor.submit(_started, call, started)] = index
+            wait([started, *pending], return_when=FIRST_COMPLETED)
+
+        done, _ = wait(pending, timeout=delay if remaining else None, return_when=FIRST_COMPLETED)
+        for future in done:
+            index = pending.pop(future)
+            if future.exception() is None:
+                _count_hedge(index)
+                return future.result()
+            errors.append(future.exception())
+        if done and errors and not is_provider_error(errors[-1]):
+            raise errors[-1]
+    raise errors[0]
+
+
+_background: set[asyncio.Task] = set()
+
+
+def _forget(task: asyncio.Task):
+    _background.discard(task)
+    if not task.cancelled():
+        # Make sure errors of calls that lost the race aren't reported as never retrieved
+        task.exception()
+
+
+async def ahedged(calls: Sequence[Callable[[], Awaitable[T]]], delay: float) -> T:
+    """The async version of `hedged`."""
+    remaining = list(enumerate(calls))
+    pending: dict[asyncio.Task, int] = {}
+    errors = []
+    try:
+        while remaining or pending:
+            if remaining:
+                index, call = remaining.pop(0)
+                if index > 0:
+                    with _registry_lock:
+                        hedges["started"] += 1
+                pending[asyncio.ensure_future(call())] = index
+
+            done, _ = await asyncio.wait(pending, timeout=delay if remaining else None, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                index = pending.pop(task)
+                if task.exception() is None:
+                    _count_hedge(index)
+                    return task.result()
+                errors.append(task.exception())
+            if done and errors and not is_provider_error(errors[-1]):
+                raise errors[-1]
+        raise errors[0]
+    finally:
+        # Let the slower calls finish in the background
+        for task in pending:
+            _background.add(task)
+            task.add_done_callback(_forget)
+
+
+def stats() -> dict:
+    with _registry_lock:
+        providers = list(_health.values())
+        hedge_stats = dict(hedges)
+    return {"providers": {health.name: health.stats() for health in providers}, "hedges": hedge_stats}
@@ -0,0 +1,202 @@
+"""Server side storage of conversations, keyed by session id.
+
+Clients used to send the whole history with every request. They can still do so, but they can also
+just send the latest query, in which case the history is taken from here. Conversations are kept in
+memory, along with the number of tokens in each message, so only new messages ever need counting.
+A conversation that isn't in memory (e.g. it was handled by another worker, or this one restarted) is
+rebuilt from the `interactions` table.
+
+Session ids aren't secret (they're e.g. sent with ratings), so the stored conversation is only used
+for requests with the session's token. Tokens are only handed out for sessions that don't have
+anything stored yet, i.e. to the client that starts the conversation. Checking that only needs an
+(indexed) existence query rather than loading the conversation, and if the database can't be asked,
+no token is handed out.
+
+Interactions are written to the database in the background, so another worker might be missing the
+last turn or so of a conversation for a second or two after it happened.
+"""
+import hashlib
+import hmac
+import re
+import secrets
+import uuid
+from typing import NamedTuple, Sequence
+
+from sqlalchemy import false, select
+from sqlalchemy.exc import SQLAlchemyError
+
+from stampy_chat import logging
+from stampy_chat.cache import TTLCache
+from stampy_chat.citations import Message
+from stampy_chat.db.models import Interaction
+from stampy_chat.db.session import make_session
+from stampy_chat.env import SESSION_CACHE_BYTES, SESSION_LOAD_FROM_DB, SESSION_SECRET, SESSION_TTL
+from stampy_chat.tokens import count_tokens
+
+logger = logging.getLogger(__name__)
+
+# The logger appends the HyDE document to the logged query
+HYDE_SUFFIX = re.compile(r"\n\n\(hyde: .*\)\Z", re.DOTALL)
+
+
+class Conversation(NamedTuple):
+    messages: tuple[Message, ...] = ()
+    # The number of tokens in each message
+    counts: tuple[int, ...] = ()
+
+    @classmethod
+    def of(cls, messages: Sequence[Message]) -> "Conversation":
+        """Make a conversation out of the messages, skipping any that were deleted or errors."""
+        return cls().add(*messages)
+
+    def add(self, *messages: Message) -> "Conversation":
+        messages = tuple(
+            Message(role=m["role"], content=m.get("content") or "")
+            for m in messages
+            if m.get("role") in ("user", "assistant")
+        )
+        return Conversation(
+            self.messages + messages,
+            self.counts + tuple(count_tokens(m["content"]) for m in messages),
+        )
+
+
+def strip_hyde(query: str) -> str:
+    return HYDE_SUFFIX.sub("", query)
+
+
+class HistoryUnavailable(Exception):
+    """Raised when the stored history of a session couldn't be read from the database."""
+
+
+def parse_session_id(session_id: str) -> uuid.UUID | None:
+    try:
+        return uuid.UUID(str(session_id))
+    except ValueError:
+        return None
+
+
+class SessionStore:
+    """Conversations by session id, in memory and optionally backed by the database.
+
+    :param TTLCache cache: where to keep the conversations in memory
+    :param bool load_from_db: whether to rebuild conversations that aren't in memory from the interactions table
+    :param str secret: the key session tokens are signed with. If empty, a random one is used, which
+      means tokens only work in this process
+    """
+
+    def __init__(self, cache: TTLCache, load_from_db: bool = SESSION_LOAD_FROM_DB, secret: str = SESSION_SECRET):
+        self.cache = cache
+        self.load_from_db = load_from_db
+        if not secret:
+            logger.warning(
+                "SESSION_SECRET is not set, so session tokens will only work on this worker until it restarts"
+            )
+            secret = secrets.token_hex(32)
+        self.secret = secret.encode("utf-8")
+
+    def token(self, session_id: str | None) -> str | None:
+        """The token that gives access to the session's stored conversation, or None if it can't have one."""
+        session_uuid = session_id and parse_session_id(session_id)
+        if not session_uuid:
+            return None
+        return hmac.new(self.secret, str(session_uuid).encode("utf-8"), hashlib.sha256).hexdigest()
+
+    def check_token(self, session_id: str | None, token: str | None) -> bool:
+        expected = self.token(session_id)
+        return bool(expected and token) and hmac.compare_digest(expected, str(token))
+
+    def start(self, session_id: str | None) -> str | None:
+        """Return the token of the session if nothing is stored for it yet, so it's up for grabs."""
+        if self.token(session_id) is None:
+            return None
+        try:
+            if self.exists(session_id):
+                return None
+        except HistoryUnavailable:
+            # The session might well have a history, so its token can't be handed out
+            return None
+        return self.token(session_id)
+
+    def exists(self, session_id: str) -> bool:
+        """Whether anything is stored for the session, without loading it.
+
+        :raises HistoryUnavailable: if the database couldn't be checked
+        """
+        conversation = self.cache.get(session_id)
+        if conversation is not None:
+            return bool(conversation.messages)
+        session_uuid = parse_session_id(session_id)
+        if not self.load_from_db or session_uuid is None:
+            return False
+
+        try:
+            with make_session() as session:
+                found = session.execute(
+                    select(Interaction.id).where(Interaction.session_id == session_uuid).limit(1)
+                ).first()
+        except SQLAlchemyError as e:
+            logger.error("Could not check for the history of %s: %s", session_id, e)
+            raise HistoryUnavailable(session_id) from e
+        return found is not None
+
+    def load(self, session_id: str) -> Conversation:
+        """Rebuild the conversation from the logged interactions.
+
+        :raises HistoryUnavailable: if the database couldn't be read
+        """
+        session_uuid = parse_session_id(session_id)
+        if session_uuid is None:
+            return Conversation()
+
+        try:
+            with make_session() as session:
+                rows = session.execute(
+                    select(Interaction.interaction_no, Interaction.query, Interaction.response)
+                    .where(Interaction.session_id == session_uuid, Interaction.cancelled == false())
+                    .order_by(Interaction.interaction_no, Interaction.id)
+                ).all()
+        except SQLAlchemyError as e:
+            logger.error("Could not load the history of %s: %s", session_id, e)
+            raise HistoryUnavailable(session_id) from e
+
+        # Cancelled answers never made it to the client. If a turn was logged more than once, the last one wins
+        turns = {row.interaction_no: row for row in rows}
+        messages = []
+        for row in turns.values():
+            messages.append(Message(role="user", content=strip_hyde(row.query or "")))
+            messages.append(Message(role="assistant", content=row.response or ""))
+        return Conversation.of(messages)
+
+    def get(self, session_id: str | None) -> Conversation:
+        """Return the conversation so far, or an empty one if nothing is known about it (or it can't be loaded)."""
+        if not session_id:
+            return Conversation()
+        conversation = self.cache.get(session_id)
+        if conversation is None:
+            if not self.load_from_db:
+                return Conversation()
+            try:
+                conversation = self.load(session_id)
+            except HistoryUnavailable:
+                return Conversation()
+            if conversation.messages:
+                self.cache.set(session_id, conversation)
+        return conversation
+
+    def set(self, session_id: str | None, history: Sequence[Message]) -> Conversation:
+        """Replace the conversation with the history sent by the client."""
+        conversation = Conversation.of(history)
+        if session_id:
+            self.cache.set(session_id, conversation)
+        return conversation
+
+    def add_turn(self, session_id: str | None, conversation: Conversation, query: str, response: str) -> Conversation:
+        """Record the latest question and its answer."""
+        conversation = conversation.add(Message(role="user", content=query), Message(role="assistant", content=response))
+        if session_id:
+            self.cache.set(session_id, conversation)
+        return conversation
+
+
+session_store = SessionStore(TTLCache("sessions", max_bytes=SESSION_CACHE_BYTES, ttl=SESSION_TTL))
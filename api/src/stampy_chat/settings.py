@@ -1,5 +1,10 @@
-from collections import namedtuple
-from typing import Any, Literal, TypedDict
+import copy
+import dataclasses
+import functools
+import threading
+import weakref
+from collections import OrderedDict, namedtuple
+from typing import Any, Hashable, Literal, TypedDict
 from dataclasses import dataclass
 
 from stampy_chat.env import MODEL
@@ -185,8 +190,9 @@ class Settings:
             model = modelID
         assert not any("hyde" in x for x in _kwargs.keys()), f"derp: {str(_kwargs)}"
 
-        # Freeze prompts and filters to ensure immutability
-        frozen_prompts = deepfreeze(prompts)
+        # Freeze prompts and filters to ensure immutability. Prompts from the prompt registry
+        # are already frozen, so there's no need to walk the whole tree again
+        frozen_prompts = prompts if isinstance(prompts, frozendict) else deepfreeze(prompts)
         frozen_filters = deepfreeze(filters)
 
         # Validate mode
@@ -223,7 +229,7 @@ class Settings:
 
         # Validate token allocation
         context_tokens = int(maxNumTokens * contextFraction) - num_tokens(
-            frozen_prompts.get("system", "")
+            frozen_prompts.get("system", frozen_prompts.get("context", ""))
         )
         history_tokens = int(maxNumTokens * historyFraction) - num_tokens(
             frozen_prompts.get("history", "")
@@ -236,36 +242,44 @@ class Settings:
                 f"max total tokens: {maxNumTokens}, minimum response tokens {min_response_tokens}"
             )
 
+        # Settings are used as cache keys on the hot path, so everything derived from them is
+        # computed once here, rather than on each access
+        key = (
+            frozen_prompts,
+            mode,
+            model,
+            maxNumTokens,
+            topKBlocks,
+            tokensBuffer,
+            maxHistory,
+            maxHistorySummaryTokens,
+            historyFraction,
+            contextFraction,
+            min_response_tokens,
+            thinking_budget,
+            enable_hyde,
+            hyde_max_tokens,
+            frozen_filters,
+        )
+        object.__setattr__(self, "_key", key)
+        object.__setattr__(self, "_hash", hash(key))
+        object.__setattr__(self, "_context_tokens", context_tokens)
+        object.__setattr__(self, "_history_tokens", history_tokens)
+        object.__setattr__(self, "_max_response_tokens", self._calc_max_response_tokens())
+        object.__setattr__(self, "_miri_filters", self._calc_miri_filters())
+
     def __repr__(self) -> str:
         return f"<Settings mode: {self.mode}, model: {self.model}, tokens: {self.maxNumTokens}"
 
     def __hash__(self) -> int:
-        def freeze_deep(obj):
-            if isinstance(obj, dict):
-                return frozendict({k: freeze_deep(v) for k, v in obj.items()})
-            elif isinstance(obj, list):
-                return tuple(freeze_deep(item) for item in obj)
-            return obj
-
-        return hash(
-            (
-                freeze_deep(self.prompts),
-                self.mode,
-                self.model,
-                self.maxNumTokens,
-                self.topKBlocks,
-                self.tokensBuffer,
-                self.maxHistory,
-                self.maxHistorySummaryTokens,
-                self.historyFraction,
-                self.contextFraction,
-                self.min_response_tokens,
-                self.thinking_budget,
-                self.enable_hyde,
-                self.hyde_max_tokens,
-                freeze_deep(self.filters),
-            )
-        )
+        return self._hash
+
+    def __eq__(self, other) -> bool:
+        if self is other:
+            return True
+        if not isinstance(other, Settings):
+            return NotImplemented
+        return self._hash == other._hash and self._key == other._key
 
     @property
     def prompt_modes(self) -> dict[Mode, str]:
@@ -318,19 +332,18 @@ class Settings:
     @property
     def context_tokens(self):
         """The max number of tokens to be used for the context"""
-        return int(self.maxNumTokens * self.contextFraction) - num_tokens(
-            self.system_prompt
-        )
+        return self._context_tokens
 
     @property
     def history_tokens(self):
         """The max number of tokens to be used for the history"""
-        return int(self.maxNumTokens * self.historyFraction) - num_tokens(
-            self.history_prompt
-        )
+        return self._history_tokens
 
     @property
     def max_response_tokens(self):
+        return self._max_response_tokens
+
+    def _calc_max_response_tokens(self):
         available_tokens = (
             self.maxNumTokens
             - self.maxHistorySummaryTokens
@@ -368,6 +381,10 @@ class Settings:
 
     @property
     def miri_filters(self) -> dict[str, Any]:
+        """The Pinecone filter for these settings. Settings are shared, so this is a fresh copy each time."""
+        return copy.deepcopy(self._miri_filters)
+
+    def _calc_miri_filters(self) -> dict[str, Any]:
         filters = {}
         if self.filters.get("needs_tech"):
             filters["needs_tech"] = True
@@ -377,5 +394,73 @@ class Settings:
         if confidence := self.filters.get("miri_confidence"):
             filters["miri_confidence"] = {"$gte": confidence}
         if distance := self.filters.get("miri_distance"):
-            filters["miri_distance"] = {"$in": distance}
+            filters["miri_distance"] = {"$in": list(distance)}
         return filters
+
+    @functools.cached_property
+    def docs_settings(self) -> "Settings":
+        """The settings to be used for HyDE and retrieval, i.e. the same but without thinking."""
+        return intern_settings(dataclasses.replace(self, thinking_budget=0))
+
+
+_interned: weakref.WeakValueDictionary[int, Settings] = weakref.WeakValueDictionary()
+# The most recently made settings, keyed by the arguments they were made from, so repeated requests don't even
+# need to build them. These are kept alive (unlike `_interned`), as requests usually don't overlap
+RECENT_SETTINGS = 256
+_by_kwargs: OrderedDict[frozenset, Settings] = OrderedDict()
+_interned_lock = threading.Lock()
+
+
+def intern_settings(settings: Settings) -> Settings:
+    """Return the canonical instance of `settings`, so that equal settings are the same object."""
+    with _interned_lock:
+        existing = _interned.get(settings._hash)
+        if existing is None:
+            _interned[settings._hash] = settings
+            return settings
+    # In the case of a hash collision just use the new object, without interning it
+    return existing if existing == settings else settings
+
+
+def kwargs_key(kwargs: dict) -> frozenset | None:
+    """A hashable key for the arguments of `make_settings`, or None if making one would cost as much as `Settings`.
+
+    Prompts from the prompt registry are already frozen (and cache their hash), so they can be used as is. Plain
+    dict prompts would have to be frozen first, which is most of the work of making the settings in the first place.
+    """
+    prompts = kwargs.get("prompts")
+    if prompts is not None and not isinstance(prompts, frozendict):
+        return None
+    # `deepfreeze` is slow even for scalars, and the other arguments are small, so they're frozen by hand
+    key = frozenset((name, value if name == "prompts" else _freeze(value)) for name, value in kwargs.items())
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+def _freeze(value: Any) -> Hashable:
+    if isinstance(value, dict):
+        return frozenset((k, _freeze(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def make_settings(**kwargs) -> Settings:
+    """Create a `Settings` object from the provided values, reusing an existing one if possible."""
+    key = kwargs_key(kwargs)
+    if key is not None:
+        with _interned_lock:
+            if (existing := _by_kwargs.get(key)) is not None:
+                _by_kwargs.move_to_end(key)
+                return existing
+
+    settings = intern_settings(Settings(**kwargs))
+    if key is not None:
+        with _interned_lock:
+            _by_kwargs[key] = settings
+            while len(_by_kwargs) > RECENT_SETTINGS:
+                _by_kwargs.popitem(last=False)
+    return settings
@@ -0,0 +1,63 @@
+"""Counting tokens with a local tokenizer.
+
+Counts are cached by the hash of the text, as the same blocks and prompt templates get counted over
+and over. If the tokenizer can't be loaded (e.g. tiktoken can't download its encoding files), this
+falls back to the same estimate as `settings.num_tokens`.
+"""
+import hashlib
+import threading
+
+import tiktoken
+
+from stampy_chat import logging
+from stampy_chat.cache import TTLCache
+from stampy_chat.env import TOKEN_CACHE_BYTES, TOKENIZER_ENCODING
+from stampy_chat.settings import num_tokens
+
+logger = logging.getLogger(__name__)
+
+# Token counts never change, so the entries only get evicted when the cache is full
+token_counts = TTLCache("tokens", max_bytes=TOKEN_CACHE_BYTES, ttl=24 * 60 * 60)
+
+MISSING = object()
+_encoding = MISSING
+_lock = threading.Lock()
+
+
+def get_encoding():
+    """Return the tiktoken encoding, or None if it isn't available."""
+    global _encoding
+    if _encoding is MISSING:
+        with _lock:
+            if _encoding is MISSING:
+                try:
+                    _encoding = tiktoken.get_encoding(TOKENIZER_ENCODING)
+                except Exception as e:
+                    logger.warning("Could not load the %s tokenizer, estimating token counts: %s", TOKENIZER_ENCODING, e)
+                    _encoding = None
+    return _encoding
+
+
+def encode_count(text: str) -> int:
+    encoding = get_encoding()
+    if encoding is None:
+        return num_tokens(text)
+    return len(encoding.encode_ordinary(text))
+
+
+def count_tokens(text: str, cache: bool = True) -> int:
+    """Return the number of tokens in `text`.
+
+    :param bool cache: whether to cache the count - pointless for text that is only counted once
+    """
+    if not text:
+        return 0
+    if not cache:
+        return encode_count(text)
+
+    key = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+    count = token_counts.get(key)
+    if count is None:
+        count = encode_count(text)
+        token_counts.set(key, count)
+    return count
@@ -0,0 +1,410 @@
+"""Vector search backends.
+
+Retrieval only needs "the top k chunks for this vector that match this filter", so anything that
+can do that can stand in for Pinecone. Two backends are provided:
+
+* `PineconeIndex` - the hosted index, queried over the network
+* `LocalIndex` - an in-process index over a memory-mapped float32 matrix. Search is an exact,
+  vectorized dot product, or an approximate IVF search over int8 codes (reranked with the exact
+  vectors) for larger corpora. It understands the same metadata filters as Pinecone, so the filters
+  from `Settings.miri_filters` and the MCP server work unchanged
+
+A local index is built from a snapshot of a Pinecone namespace, which is a JSON lines file with
+one `{"id": ..., "values": [...], "metadata": {...}}` object per vector:
+
+    python -m stampy_chat.vector_index export snapshot.jsonl
+    python -m stampy_chat.vector_index build snapshot.jsonl index_dir --lists 1024
+
+and can be pushed back to Pinecone with `import`. Set `VECTOR_BACKEND=local` and
+`LOCAL_INDEX_PATH=index_dir` to use it.
+"""
+import argparse
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Iterable, Iterator, NamedTuple, Protocol
+
+import numpy as np
+
+from stampy_chat import logging
+from stampy_chat.clients import get_client
+from stampy_chat.env import (
+    LOCAL_INDEX_NPROBE,
+    LOCAL_INDEX_PATH,
+    PINECONE_API_KEY,
+    PINECONE_ENVIRONMENT,
+    PINECONE_INDEX_NAME,
+    PINECONE_NAMESPACE,
+    VECTOR_BACKEND,
+)
+
+logger = logging.getLogger(__name__)
+
+VECTORS_FILE = "vectors.npy"
+METADATA_FILE = "metadata.jsonl"
+IVF_FILE = "ivf.npz"
+
+# How many candidates per result to rerank with the exact vectors in IVF mode
+RERANK_FACTOR = 4
+# How many distinct filters to keep precomputed masks for
+MASK_CACHE_SIZE = 64
+
+
+class Match(NamedTuple):
+    id: str
+    score: float
+    metadata: dict[str, Any]
+
+
+class VectorIndex(Protocol):
+    def query(self, vector: list[float], top_k: int, filter: dict | None = None) -> list[Match]:
+        """Return the `top_k` best matches for `vector`, best first, skipping any that don't match `filter`."""
+        ...
+
+
+### Filters ###
+
+Predicate = Callable[[dict], bool]
+
+
+def _compare(op: str, value: Any, expected: Any) -> bool:
+    # Pinecone only orders numbers, and the different types can't be compared anyway
+    if not all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in (value, expected)):
+        return False
+    if op == "$gt":
+        return value > expected
+    if op == "$gte":
+        return value >= expected
+    if op == "$lt":
+        return value < expected
+    return value <= expected
+
+
+def _operator(field: str, op: str, expected: Any) -> Predicate:
+    def values(metadata: dict) -> list:
+        # List fields (e.g. authors) match if any of their items match
+        value = metadata.get(field)
+        if value is None:
+            return []
+        return value if isinstance(value, list) else [value]
+
+    if op == "$eq":
+        return lambda metadata: expected in values(metadata)
+    if op == "$ne":
+        return lambda metadata: expected not in values(metadata)
+    if op == "$in":
+        expected = list(expected)
+        return lambda metadata: any(v in expected for v in values(metadata))
+    if op == "$nin":
+        expected = list(expected)
+        return lambda metadata: not any(v in expected for v in values(metadata))
+    if op in ("$gt", "$gte", "$lt", "$lte"):
+        return lambda metadata: any(_compare(op, v, expected) for v in values(metadata))
+    raise ValueError(f"Unsupported filter operator: {op}")
+
+
+def compile_filter(filter: dict | None) -> Predicate:
+    """Turn a Pinecone metadata filter into a function that checks whether metadata matches it.
+
+    Supports `$eq`, `$ne`, `$gt`, `$gte`, `$lt`, `$lte`, `$in`, `$nin`, `$and` and `$or`, along with
+    the `{"field": value}` shorthand for `$eq`.
+    """
+    if not filter:
+        return lambda metadata: True
+
+    predicates = []
+    for key, value in filter.items():
+        if key in ("$and", "$or"):
+            combine = all if key == "$and" else any
+            parts = [compile_filter(f) for f in value]
+            predicates.append(lambda metadata, parts=parts, combine=combine: combine(p(metadata) for p in parts))
+        elif key.startswith("$"):
+            raise ValueError(f"Unsupported filter operator: {key}")
+        elif isinstance(value, dict):
+            predicates.extend(_operator(key, op, expected) for op, expected in value.items())
+        else:
+            predicates.append(_operator(key, "$eq", value))
+
+    if len(predicates) == 1:
+        return predicates[0]
+    return lambda metadata: all(p(metadata) for p in predicates)
+
+
+### Pinecone ###
+
+
+class PineconeIndex:
+    def __init__(self, index_name: str = PINECONE_INDEX_NAME, namespace: str = PINECONE_NAMESPACE):
+        self.index_name = index_name
+        self.namespace = namespace
+
+    @property
+    def index(self):
+        from pinecone import Pinecone
+
+        return get_client(
+            ("pinecone", self.index_name),
+            lambda: Pinecone(api_key=PINECONE_API_KEY, environment=PINECONE_ENVIRONMENT).Index(self.index_name),
+        )
+
+    def query(self, vector: list[float], top_k: int, filter: dict | None = None) -> list[Match]:
+        results = self.index.query_namespaces(
+            vector=list(vector),
+            metric="cosine",
+            top_k=top_k,
+            include_metadata=True,
+            namespaces=[self.namespace],
+            filter=filter,
+        )
+        return [Match(match.id, match.score, dict(match.metadata or {})) for match in results.matches]
+
+    def export(self, batch_size: int = 100) -> Iterator[dict]:
+        """Yield every vector in the namespace, as snapshot records."""
+        for ids in self.index.list(namespace=self.namespace):
+            for start in range(0, len(ids), batch_size):
+                fetched = self.index.fetch(ids=ids[start : start + batch_size], namespace=self.namespace)
+                for id, vector in fetched.vectors.items():
+                    yield {"id": id, "values": list(vector.values), "metadata": dict(vector.metadata or {})}
+
+    def upsert(self, records: Iterable[dict], batch_size: int = 100) -> int:
+        """Upload the snapshot records into the namespace, returning how many were uploaded."""
+        count = 0
+        batch = []
+        for record in records:
+            batch.append((record["id"], record["values"], record.get("metadata") or {}))
+            if len(batch) >= batch_size:
+                count += self.index.upsert(vectors=batch, namespace=self.namespace).upserted_count
+                batch = []
+        if batch:
+            count += self.index.upsert(vectors=batch, namespace=self.namespace).upserted_count
+        return count
+
+
+### Local ###
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def quantize(vectors: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Encode each row as int8, returning the codes and the per row scales needed to decode them."""
+    scales = np.abs(vectors).max(axis=1) / 127
+    scales[scales == 0] = 1
+    return np.round(vectors / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+
+
+def kmeans(vectors: np.ndarray, clusters: int, iterations: int = 10, seed: int = 0) -> np.ndarray:
+    """A basic spherical k-means, returning the (normalized) centroids."""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), size=clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        for cluster in range(clusters):
+            members = vectors[assignments == cluster]
+            if len(members):
+                centroids[cluster] = members.mean(axis=0)
+        centroids = normalize_rows(centroids)
+    return centroids
+
+
+class LocalIndex:
+    """An in-process vector index, stored in a directory.
+
+    :param str path: the directory with the index files, as written by `LocalIndex.build`
+    :param int nprobe: how many IVF lists to search, if the index has them. Ignored for exact search
+    """
+
+    def __init__(self, path: str, nprobe: int = LOCAL_INDEX_NPROBE):
+        self.path = path
+        self.nprobe = nprobe
+        # Memory mapped, so workers share the page cache rather than each loading a copy
+        self.vectors = np.load(os.path.join(path, VECTORS_FILE), mmap_mode="r")
+        with open(os.path.join(path, METADATA_FILE)) as f:
+            records = [json.loads(line) for line in f]
+        self.ids = [record["id"] for record in records]
+        self.metadata = [record.get("metadata") or {} for record in records]
+
+        self.ivf = None
+        if os.path.exists(ivf_path := os.path.join(path, IVF_FILE)):
+            ivf = np.load(ivf_path)
+            order = np.argsort(ivf["assignments"], kind="stable")
+            bounds = np.searchsorted(ivf["assignments"][order], np.arange(len(ivf["centroids"]) + 1))
+            self.ivf = {
+                "centroids": ivf["centroids"],
+                "codes": ivf["codes"],
+                "scales": ivf["scales"],
+                "lists": [order[bounds[i] : bounds[i + 1]] for i in range(len(bounds) - 1)],
+            }
+
+        self._masks: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, records: Iterable[dict], path: str, lists: int = 0) -> "LocalIndex":
+        """Write a new index from snapshot records.
+
+        :param records: `{"id": ..., "values": [...], "metadata": {...}}` dicts
+        :param str path: the directory to write the index into
+        :param int lists: how many IVF lists to cluster the vectors into - 0 means only exact search
+        """
+        os.makedirs(path, exist_ok=True)
+        vectors = []
+        with open(os.path.join(path, METADATA_FILE), "w") as f:
+            for record in records:
+                vectors.append(np.asarray(record["values"], dtype=np.float32))
+                f.write(json.dumps({"id": record["id"], "metadata": record.get("metadata") or {}}) + "\n")
+
+        matrix = normalize_rows(np.stack(vectors)) if vectors else np.zeros((0, 0), dtype=np.float32)
+        np.save(os.path.join(path, VECTORS_FILE), matrix.astype(np.float32))
+
+        ivf_path = os.path.join(path, IVF_FILE)
+        if lists and len(matrix) >= lists:
+            centroids = kmeans(matrix, lists)
+            codes, scales = quantize(matrix)
+            assignments = np.argmax(matrix @ centroids.T, axis=1).astype(np.int32)
+            np.savez(ivf_path, centroids=centroids, assignments=assignments, codes=codes, scales=scales)
+        elif os.path.exists(ivf_path):
+            os.remove(ivf_path)
+        return cls(path)
+
+    def records(self) -> Iterator[dict]:
+        """Yield all the vectors as snapshot records."""
+        for id, vector, metadata in zip(self.ids, self.vectors, self.metadata):
+            yield {"id": id, "values": vector.tolist(), "metadata": metadata}
+
+    def mask(self, filter: dict | None) -> np.ndarray | None:
+        """Return which rows match `filter`. Masks are cached, as there are only a handful of distinct filters."""
+        if not filter:
+            return None
+        key = json.dumps(filter, sort_keys=True, default=str)
+        with self._lock:
+            if (mask := self._masks.get(key)) is not None:
+                self._masks.move_to_end(key)
+                return mask
+
+        predicate = compile_filter(filter)
+        mask = np.fromiter((predicate(metadata) for metadata in self.metadata), dtype=bool, count=len(self))
+        with self._lock:
+            self._masks[key] = mask
+            if len(self._masks) > MASK_CACHE_SIZE:
+                self._masks.popitem(last=False)
+        return mask
+
+    def candidates(self, query: np.ndarray, top_k: int, mask: np.ndarray | None) -> np.ndarray | None:
+        """Return the rows worth scoring exactly, or None if that's all of them.
+
+        Scoring all the rows is done on the (memory mapped) matrix directly - indexing it with a list
+        of rows would copy the whole thing for every query.
+        """
+        if self.ivf is None:
+            return np.flatnonzero(mask) if mask is not None else None
+
+        probes = np.argsort(-(self.ivf["centroids"] @ query))[: self.nprobe]
+        rows = np.concatenate([self.ivf["lists"][i] for i in probes])
+        if mask is not None:
+            rows = rows[mask[rows]]
+
+        limit = top_k * RERANK_FACTOR
+        if len(rows) > limit:
+            approx = (self.ivf["codes"][rows] @ query) * self.ivf["scales"][rows]
+            rows = rows[np.argpartition(-approx, limit)[:limit]]
+        return np.sort(rows)
+
+    def query(self, vector: list[float], top_k: int, filter: dict | None = None) -> list[Match]:
+        if not len(self):
+            return []
+        query = normalize_rows(np.asarray(vector, dtype=np.float32))
+        rows = self.candidates(query, top_k, self.mask(filter))
+        if rows is None:
+            scores = self.vectors @ query
+        elif not len(rows):
+            return []
+        else:
+            scores = self.vectors[rows] @ query
+
+        if len(scores) > top_k:
+            best = np.argpartition(-scores, top_k)[:top_k]
+        else:
+            best = np.arange(len(scores))
+        best = best[np.argsort(-scores[best], kind="stable")]
+        if rows is not None:
+            return [Match(self.ids[rows[i]], float(scores[i]), self.metadata[rows[i]]) for i in best]
+        return [Match(self.ids[i], float(scores[i]), self.metadata[i]) for i in best]
+
+
+### Snapshots ###
+
+
+def write_snapshot(records: Iterable[dict], path: str) -> int:
+    count = 0
+    with open(path, "w") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+            count += 1
+    return count
+
+
+def read_snapshot(path: str) -> Iterator[dict]:
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+_index: VectorIndex | None = None
+_index_lock = threading.Lock()
+
+
+def vector_index() -> VectorIndex:
+    """Return the configured backend. The local index is loaded once per process, on first use."""
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                if VECTOR_BACKEND == "local":
+                    _index = LocalIndex(LOCAL_INDEX_PATH)
+                    logger.info("Loaded local vector index with %s vectors from %s", len(_index), LOCAL_INDEX_PATH)
+                elif VECTOR_BACKEND == "pinecone":
+                    _index = PineconeIndex()
+                else:
+                    raise ValueError(f"Unknown VECTOR_BACKEND: {VECTOR_BACKEND}")
+    return _index
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(description="Manage local vector index snapshots")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export = commands.add_parser("export", help="Dump a Pinecone namespace into a snapshot")
+    export.add_argument("snapshot")
+    export.add_argument("--namespace", default=PINECONE_NAMESPACE)
+
+    upload = commands.add_parser("import", help="Upload a snapshot into a Pinecone namespace")
+    upload.add_argument("snapshot")
+    upload.add_argument("--namespace", default=PINECONE_NAMESPACE)
+
+    build = commands.add_parser("build", help="Build a local index from a snapshot")
+    build.add_argument("snapshot")
+    build.add_argument("path")
+    build.add_argument("--lists", type=int, default=0, help="The number of IVF lists, 0 for exact search")
+
+    args = parser.parse_args(argv)
+    if args.command == "export":
+        count = write_snapshot(PineconeIndex(namespace=args.namespace).export(), args.snapshot)
+        print(f"Exported {count} vectors to {args.snapshot}")
+    elif args.command == "import":
+        count = PineconeIndex(namespace=args.namespace).upsert(read_snapshot(args.snapshot))
+        print(f"Imported {count} vectors into {args.namespace}")
+    else:
+        index = LocalIndex.build(read_snapshot(args.snapshot), args.path, lists=args.lists)
+        print(f"Built an index of {len(index)} vectors in {args.path}")
+
+
+if __name__ == "__main__":
+    main()
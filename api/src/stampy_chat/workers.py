@@ -0,0 +1,146 @@
+"""A shared, bounded pool of threads to run chat pipelines in.
+
+Every streamed answer needs a thread to run the pipeline in, while the request thread sends the
+results to the client. Rather than starting a new thread per request, pipelines are run in a fixed
+size pool, and once `max_in_flight` pipelines are running or waiting for a free thread, new ones
+are rejected with `Saturated`, which the API turns into a 503 with a `Retry-After` header.
+
+The ASGI app runs pipelines as tasks rather than in the pool, but admits them the same way, with an
+`InFlightLimit`.
+"""
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable
+
+from stampy_chat.env import CHAT_ASYNC_MAX_IN_FLIGHT, CHAT_MAX_IN_FLIGHT, CHAT_RETRY_AFTER, CHAT_WORKERS
+from stampy_chat.metrics import Gauge
+
+
+class Saturated(Exception):
+    """Raised when the pool has no room for another pipeline.
+
+    :param int retry_after: how many seconds the client should wait before trying again
+    """
+
+    def __init__(self, retry_after: int = CHAT_RETRY_AFTER):
+        self.retry_after = retry_after
+        super().__init__(f"Too many requests in flight, try again in {retry_after}s")
+
+
+class ChatPool:
+    """A thread pool that refuses work once too much is in flight, rather than queueing it without limit.
+
+    :param int max_workers: how many pipelines can run at the same time
+    :param int max_in_flight: how many pipelines can be running or waiting for a thread
+    """
+
+    def __init__(self, max_workers: int = CHAT_WORKERS, max_in_flight: int = CHAT_MAX_IN_FLIGHT):
+        self.max_workers = max_workers
+        self.max_in_flight = max(max_in_flight, max_workers)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="chat")
+        self.in_flight = 0
+        self.running = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def submit(self, function: Callable[..., Any], *args, **kwargs) -> Future:
+        """Run `function` in the pool.
+
+        :raises Saturated: if `max_in_flight` pipelines are already running or waiting
+        """
+        with self._lock:
+            if self.in_flight >= self.max_in_flight:
+                self.rejected += 1
+                raise Saturated()
+            self.in_flight += 1
+
+        def run():
+            with self._lock:
+                self.running += 1
+            try:
+                return function(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.running -= 1
+                    self.in_flight -= 1
+
+        try:
+            return self.executor.submit(run)
+        except Exception:
+            with self._lock:
+                self.in_flight -= 1
+            raise
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "running": self.running,
+                "queued": self.in_flight - self.running,
+                "max_workers": self.max_workers,
+                "max_in_flight": self.max_in_flight,
+                "rejected": self.rejected,
+            }
+
+
+class InFlightLimit:
+    """Counts pipelines that don't need a pool thread (e.g. asyncio tasks), refusing new ones past `max_in_flight`.
+
+    :param int max_in_flight: how many pipelines can be running at the same time
+    """
+
+    def __init__(self, max_in_flight: int = CHAT_ASYNC_MAX_IN_FLIGHT):
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> Callable[[], None]:
+        """Take a slot, returning the function that gives it back. Calling that more than once is fine.
+
+        :raises Saturated: if `max_in_flight` pipelines are already running
+        """
+        with self._lock:
+            if self.in_flight >= self.max_in_flight:
+                self.rejected += 1
+                raise Saturated()
+            self.in_flight += 1
+
+        released = False
+
+        def release():
+            nonlocal released
+            with self._lock:
+                if not released:
+                    released = True
+                    self.in_flight -= 1
+
+        return release
+
+    @contextmanager
+    def slot(self):
+        release = self.acquire()
+        try:
+            yield
+        finally:
+            release()
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {"in_flight": self.in_flight, "max_in_flight": self.max_in_flight, "rejected": self.rejected}
+
+
+chat_pool = ChatPool()
+async_chat_limit = InFlightLimit()
+
+Gauge("stampy_chat_pool_running", "How many chat pipelines are running", function=lambda: chat_pool.running)
+Gauge(
+    "stampy_chat_pool_queued",
+    "How many chat pipelines are waiting for a thread",
+    function=lambda: chat_pool.in_flight - chat_pool.running,
+)
+Gauge(
+    "stampy_chat_async_in_flight",
+    "How many chat pipelines are running as tasks",
+    function=lambda: async_chat_limit.in_flight,
+)
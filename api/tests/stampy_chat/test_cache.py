@@ -0,0 +1,94 @@
+from unittest.mock import patch
+
+import pytest
+
+from stampy_chat.cache import CACHES, ENTRY_OVERHEAD, TTLCache, caches_stats, clear_caches, entry_size, sizeof
+
+
+@pytest.fixture
+def cache():
+    cache = TTLCache("test", max_bytes=2000, ttl=10)
+    yield cache
+    CACHES.pop("test", None)
+
+
+def test_sizeof():
+    assert sizeof("a" * 1000) > 1000
+    assert sizeof(["a" * 1000, "b" * 1000]) > 2000
+    assert sizeof({"key": ["a" * 1000]}) > 1000
+
+
+def test_get_set(cache):
+    assert cache.get("key") is None
+    assert cache.get("key", "default") == "default"
+
+    cache.set("key", "value")
+    assert cache.get("key") == "value"
+    assert "key" in cache
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 2
+
+
+def test_expiry(cache):
+    with patch("stampy_chat.cache.time.monotonic", return_value=100):
+        cache.set("key", "value")
+        cache.set("short", "value", ttl=1)
+    with patch("stampy_chat.cache.time.monotonic", return_value=105):
+        assert cache.get("key") == "value"
+        assert cache.get("short") is None
+    with patch("stampy_chat.cache.time.monotonic", return_value=111):
+        assert cache.get("key") is None
+
+    assert cache.stats()["expirations"] == 2
+    assert cache.stats()["bytes"] == 0
+
+
+def test_evicts_by_size(cache):
+    cache.set("a", "a" * 600)
+    cache.set("b", "b" * 600)
+    cache.get("a")
+    cache.set("c", "c" * 600)
+
+    assert "a" in cache
+    assert "b" not in cache
+    assert "c" in cache
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["bytes"] <= 2000
+
+
+def test_too_large_values_are_skipped(cache):
+    cache.set("a", "a" * 4000)
+    assert "a" not in cache
+
+
+def test_replace_updates_size(cache):
+    cache.set("a", "a" * 400)
+    cache.set("a", "a")
+    assert cache.stats()["bytes"] == entry_size("a", "a")
+
+
+def test_counts_keys_and_overhead(cache):
+    cache.set("k" * 500, 1)
+    assert cache.stats()["bytes"] >= 500 + ENTRY_OVERHEAD
+    # Many small entries fill the cache up too, rather than looking almost free
+    for i in range(100):
+        cache.set(i, i)
+    assert cache.stats()["bytes"] <= 2000
+    assert len(cache) < 20
+
+
+def test_unregistered(cache):
+    TTLCache("unregistered test", max_bytes=1000, ttl=10, register=False)
+    assert "unregistered test" not in CACHES
+
+
+def test_clear_caches(cache):
+    other = TTLCache("other test", max_bytes=1000, ttl=10)
+    cache.set("a", "a")
+    other.set("a", "a")
+
+    assert clear_caches("test") == ["test"]
+    assert "a" not in cache
+    assert "a" in other
+    assert caches_stats()["other test"]["entries"] == 1
+    CACHES.pop("other test")
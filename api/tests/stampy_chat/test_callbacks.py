@@ -1,4 +1,10 @@
-from stampy_chat.callbacks import stream_callback
+import asyncio
+import threading
+from unittest.mock import patch
+
+import pytest
+
+from stampy_chat.callbacks import Coalescer, astream_callback, stream_callback
 
 
 def test_stream_callback_generates():
@@ -30,3 +36,176 @@ def test_stream_callback_on_error():
     assert list(stream_callback(caller_backer)) == [
         f'value no {i}' for i in range(5)
     ] + ['this is a pen']
+
+
+async def collect(iterator):
+    return [item async for item in iterator]
+
+
+def test_astream_callback_generates():
+    async def caller_backer(callback):
+        for i in range(3):
+            callback(f'value no {i}')
+        # Callbacks can also come from other threads
+        await asyncio.to_thread(callback, 'from a thread')
+
+    assert asyncio.run(collect(astream_callback(caller_backer))) == [
+        f'value no {i}' for i in range(3)
+    ] + ['from a thread']
+
+
+def test_astream_callback_on_error():
+    async def caller_backer(callback):
+        callback('value')
+        raise ValueError('this is a pen')
+
+    assert asyncio.run(collect(astream_callback(caller_backer, str))) == ['value', 'this is a pen']
+
+
+def test_coalescer_sends_first_chunk_immediately():
+    coalescer = Coalescer(window=10)
+    assert coalescer.add({"state": "streaming", "content": "Hel"}) == [{"state": "streaming", "content": "Hel"}]
+    assert coalescer.add({"state": "streaming", "content": "lo"}) == []
+    assert coalescer.add({"state": "streaming", "content": " there"}) == []
+    assert coalescer.flush() == [{"state": "streaming", "content": "lo there"}]
+    assert coalescer.flush() == []
+
+
+def test_coalescer_keeps_order():
+    coalescer = Coalescer(window=10)
+    coalescer.add({"state": "thinking", "content": "a"})
+    assert coalescer.add({"state": "thinking", "content": "b"}) == []
+    assert coalescer.add({"state": "streaming", "content": "c"}) == [{"state": "thinking", "content": "b"}]
+    assert coalescer.add({"state": "done"}) == [{"state": "streaming", "content": "c"}, {"state": "done"}]
+
+
+def test_coalescer_max_chars():
+    coalescer = Coalescer(window=10, max_chars=5)
+    coalescer.add({"state": "streaming", "content": "a"})
+    assert coalescer.add({"state": "streaming", "content": "bcd"}) == []
+    assert coalescer.add({"state": "streaming", "content": "efg"}) == [{"state": "streaming", "content": "bcdefg"}]
+
+
+def test_coalescer_window():
+    with patch("stampy_chat.callbacks.time.monotonic", return_value=100):
+        coalescer = Coalescer(window=0.05)
+        coalescer.add({"state": "streaming", "content": "a"})
+        coalescer.add({"state": "streaming", "content": "b"})
+        assert coalescer.timeout() == pytest.approx(0.05)
+    with patch("stampy_chat.callbacks.time.monotonic", return_value=100.06):
+        assert coalescer.add({"state": "streaming", "content": "c"}) == [{"state": "streaming", "content": "bc"}]
+
+
+def test_coalescer_disabled():
+    coalescer = Coalescer(window=0)
+    for chunk in "abc":
+        assert coalescer.add({"state": "streaming", "content": chunk}) == [{"state": "streaming", "content": chunk}]
+
+
+def test_stream_callback_coalesces():
+    def caller_backer(callback):
+        for i in range(5):
+            callback({"state": "streaming", "content": str(i)})
+        callback({"state": "done"})
+
+    assert list(stream_callback(caller_backer, flush_window=10)) == [
+        str({"state": "streaming", "content": "0"}),
+        str({"state": "streaming", "content": "1234"}),
+        str({"state": "done"}),
+    ]
+
+
+def test_astream_callback_flushes_after_window():
+    async def caller_backer(callback):
+        callback({"state": "streaming", "content": "a"})
+        callback({"state": "streaming", "content": "b"})
+        await asyncio.sleep(0.1)
+        callback({"state": "streaming", "content": "c"})
+
+    assert asyncio.run(collect(astream_callback(caller_backer, flush_window=0.02))) == [
+        str({"state": "streaming", "content": "a"}),
+        str({"state": "streaming", "content": "b"}),
+        str({"state": "streaming", "content": "c"}),
+    ]
+
+
+def test_astream_callback_applies_backpressure():
+    produced = []
+
+    async def producer(callback):
+        for i in range(100):
+            callback(i)
+            produced.append(i)
+            await callback.drain()
+
+    async def run():
+        stream = astream_callback(producer)
+        assert await stream.__anext__() == "0"
+        await asyncio.sleep(0.1)
+        # The producer can't get more than the queue size ahead of the consumer
+        assert len(produced) <= 7
+        assert [item async for item in stream] == [str(i) for i in range(1, 100)]
+
+    with patch("stampy_chat.callbacks.STREAM_QUEUE_SIZE", 5):
+        asyncio.run(asyncio.wait_for(run(), timeout=5))
+
+
+def test_astream_callback_gives_up_on_slow_clients():
+    cancelled = []
+
+    async def producer(callback):
+        try:
+            while True:
+                callback("value")
+                await callback.drain()
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def run():
+        stream = astream_callback(producer)
+        assert await stream.__anext__() == "value"
+        await asyncio.sleep(0.2)
+        assert cancelled == [True]
+        # Whatever was queued still gets sent, and then the stream ends
+        assert 0 < len([item async for item in stream]) <= 5
+
+    with patch("stampy_chat.callbacks.STREAM_QUEUE_SIZE", 5), patch("stampy_chat.callbacks.STREAM_SEND_TIMEOUT", 0.05):
+        asyncio.run(asyncio.wait_for(run(), timeout=5))
+
+
+def test_stream_callback_cancels_when_closed():
+    cancel = threading.Event()
+    stopped = threading.Event()
+
+    def caller_backer(callback):
+        while not cancel.wait(timeout=0.01):
+            callback('value')
+        stopped.set()
+
+    stream = stream_callback(caller_backer, cancel=cancel)
+    assert next(stream) == 'value'
+    stream.close()
+
+    assert stopped.wait(timeout=5)
+
+
+def test_astream_callback_cancels_task_when_closed():
+    cancelled = []
+
+    async def caller_backer(callback):
+        callback('value')
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def run():
+        stream = astream_callback(caller_backer)
+        assert await stream.__anext__() == 'value'
+        await stream.aclose()
+        await asyncio.sleep(0)
+
+    asyncio.run(run())
+    assert cancelled == [True]
@@ -0,0 +1,277 @@
+import asyncio
+import threading
+import uuid
+from unittest.mock import Mock, patch
+
+import pytest
+
+from stampy_chat import chat
+from stampy_chat.cache import TTLCache
+from stampy_chat.chat import query_variants, retrieve_with_hyde
+from stampy_chat.citations import Message
+from stampy_chat.sessions import SessionStore
+from stampy_chat.settings import DEFAULT_PROMPTS, Settings
+
+
+def match(id):
+    return Mock(
+        id=id,
+        score=0.5,
+        metadata={"hash_id": id, "title": id, "url": f"http://example.org/{id}", "authors": [], "text": id},
+    )
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    chat.hyde_cache.clear()
+    chat.retrieval_cache.clear()
+    yield
+    chat.hyde_cache.clear()
+    chat.retrieval_cache.clear()
+
+
+def test_query_variants():
+    assert query_variants("why?", []) == ["why?"]
+    assert query_variants("why?", [
+        Message(role="user", content="what is AGI?"),
+        Message(role="assistant", content="bla"),
+    ]) == ["why?", "what is AGI?\n\nwhy?"]
+
+
+def test_retrieve_with_hyde_overlaps():
+    raw_searched = threading.Event()
+    searched = []
+
+    def hyde(*args):
+        # Only finish once the raw query has been searched for
+        assert raw_searched.wait(timeout=5)
+        return "hypothetical document"
+
+    def search(queries, settings):
+        searched.append(queries)
+        raw_searched.set()
+        return [[match(q)] for q in queries]
+
+    callback = Mock()
+    with patch("stampy_chat.chat.generate_hyde", side_effect=hyde):
+        with patch("stampy_chat.chat.search_queries_cached", side_effect=search):
+            blocks = retrieve_with_hyde("query", [], Settings(), [callback])
+
+    assert searched == [["query"], ["hypothetical document"]]
+    assert {b["id"] for b in blocks} == {"query", "hypothetical document"}
+    callback.on_hyde_done.assert_called_once_with("hypothetical document")
+
+
+def test_retrieve_with_hyde_cached_batches_queries():
+    settings = Settings()
+    chat.hyde_cache.set(chat.hyde_key("query", (), settings), "hypothetical document")
+
+    with patch("stampy_chat.chat.search_queries", return_value=[[match("a")], [match("b")]]) as search:
+        retrieve_with_hyde("query", [], settings, [])
+
+    search.assert_called_once_with(["hypothetical document", "query"], settings)
+
+
+def test_generate_hyde_cached():
+    with patch("stampy_chat.chat.query_llm", return_value="hypothetical document") as llm:
+        assert chat.generate_hyde("query", (), Settings()) == "hypothetical document"
+        assert chat.generate_hyde("query", (), Settings(mode="concise")) == "hypothetical document"
+    llm.assert_called_once()
+
+
+@pytest.mark.parametrize("document", (None, "", "  \n"))
+def test_empty_hyde_is_ignored(document):
+    settings, callback = Settings(), Mock()
+    with patch("stampy_chat.chat.query_llm", return_value=document):
+        with patch("stampy_chat.chat.search_queries_cached", return_value=[[match("a")]]) as search:
+            blocks = retrieve_with_hyde("query", [], settings, [callback])
+
+    assert [b["id"] for b in blocks] == ["a"]
+    search.assert_called_once_with(["query"], settings)
+    callback.on_hyde_done.assert_not_called()
+    assert chat.hyde_cache.get(chat.hyde_key("query", (), settings)) is None
+
+
+def test_search_queries_cached_keys():
+    with patch("stampy_chat.chat.search_queries", side_effect=lambda qs, s: [[match(q)] for q in qs]) as search:
+        chat.search_queries_cached(["a", "b"], Settings())
+        # Different prompts don't change what gets retrieved
+        chat.search_queries_cached(["b", "c"], Settings(prompts={**DEFAULT_PROMPTS, "system": "bla"}))
+        # ...but different filters do
+        chat.search_queries_cached(["a"], Settings(filters={"miri_confidence": 2}))
+
+    assert [c.args[0] for c in search.call_args_list] == [["a", "b"], ["c"], ["a"]]
+
+
+def test_retrieve_with_hyde_failure():
+    callback = Mock()
+    with patch("stampy_chat.chat.generate_hyde", side_effect=ValueError("bla")):
+        with patch("stampy_chat.chat.search_queries_cached", return_value=[[match("a")]]):
+            blocks = retrieve_with_hyde("query", [], Settings(), [callback])
+
+    assert [b["id"] for b in blocks] == ["a"]
+    callback.on_hyde_done.assert_not_called()
+
+
+def test_arun_query():
+    async def stream():
+        yield {"type": "thinking", "text": "hmm"}
+        yield {"type": "response", "text": "Hello"}
+        yield {"type": "response", "text": " there"}
+
+    async def aquery_llm(*args, **kwargs):
+        return stream()
+
+    async def search(queries, settings):
+        return [[match(q)] for q in queries]
+
+    events = []
+    with patch("stampy_chat.chat.aquery_llm", side_effect=aquery_llm):
+        with patch("stampy_chat.chat.asearch_queries", side_effect=search):
+            with patch("stampy_chat.callbacks.logger"):
+                result = asyncio.run(
+                    chat.arun_query(None, "query", [], Settings(enable_hyde=False), events.append, followups=False)
+                )
+
+    assert result == {"response": "Hello there", "followups": []}
+    states = [e and e["state"] for e in events]
+    assert states[0] == "citations"
+    assert states[-5:] == ["thinking", "streaming", "streaming", "done", None]
+    assert events[0]["citations"][0]["id"] == "query"
+
+
+def test_run_query_cancelled():
+    cancel = threading.Event()
+    closed = []
+
+    def chunks():
+        try:
+            yield {"type": "response", "text": "Hello"}
+            cancel.set()
+            yield {"type": "response", "text": " there"}
+            yield {"type": "response", "text": " again"}
+        finally:
+            closed.append(True)
+
+    events = []
+    logger = Mock()
+    with patch("stampy_chat.chat.query_llm", return_value=chunks()):
+        with patch("stampy_chat.chat.search_queries", return_value=[[match("a")]]):
+            with patch("stampy_chat.chat.search_followups") as followups:
+                with patch("stampy_chat.callbacks.logger", logger):
+                    result = chat.run_query(
+                        None, "query", [], Settings(enable_hyde=False), events.append, followups=False, cancel=cancel
+                    )
+
+    assert result == {"response": "Hello", "followups": []}
+    assert closed == [True]
+    followups.assert_not_called()
+    assert events[-1] is None
+    assert {"state": "done"} not in events
+    assert logger.interaction.call_args.kwargs["cancelled"] is True
+    assert logger.interaction.call_args.args[2] == "Hello"
+
+
+def test_arun_query_cancelled():
+    closed = asyncio.Event()
+    started = asyncio.Event()
+
+    async def stream():
+        try:
+            yield {"type": "response", "text": "Hello"}
+            started.set()
+            await asyncio.sleep(10)
+            yield {"type": "response", "text": " there"}
+        finally:
+            closed.set()
+
+    async def aquery_llm(*args, **kwargs):
+        return stream()
+
+    async def search(queries, settings):
+        return [[match(q)] for q in queries]
+
+    logged = threading.Event()
+    logger = Mock()
+    logger.interaction.side_effect = lambda *args, **kwargs: logged.set()
+
+    async def run():
+        task = asyncio.create_task(
+            chat.arun_query(None, "query", [], Settings(enable_hyde=False), Mock(), followups=False)
+        )
+        await started.wait()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert closed.is_set()
+
+    with patch("stampy_chat.chat.aquery_llm", side_effect=aquery_llm):
+        with patch("stampy_chat.chat.asearch_queries", side_effect=search):
+            with patch("stampy_chat.callbacks.logger", logger):
+                asyncio.run(run())
+                assert logged.wait(timeout=5)
+
+    assert logger.interaction.call_args.args[2] == "Hello"
+    assert logger.interaction.call_args.kwargs["cancelled"] is True
+
+
+def test_run_query_uses_stored_history():
+    sessions = SessionStore(TTLCache("test-chat-sessions", max_bytes=1024 * 1024, ttl=60, register=False), load_from_db=False)
+    session_id = str(uuid.uuid4())
+    prompts, events = [], []
+
+    def query_llm(prompt, settings):
+        prompts.append(prompt)
+        yield {"type": "response", "text": f"answer {len(prompts)}"}
+
+    with patch("stampy_chat.chat.session_store", sessions):
+        with patch("stampy_chat.chat.query_llm", side_effect=query_llm):
+            with patch("stampy_chat.chat.search_queries", return_value=[[match("a")]]):
+                with patch("stampy_chat.callbacks.logger"):
+                    chat.run_query(session_id, "first question", [], Settings(enable_hyde=False), events.append, followups=False)
+                    # The client that started the session gets its token
+                    (token,) = [e["sessionToken"] for e in events if e and e["state"] == "session"]
+                    events.clear()
+                    # No history is sent, so the stored one gets used
+                    chat.run_query(
+                        session_id, "second question", None, Settings(enable_hyde=False), events.append,
+                        followups=False, session_token=token,
+                    )
+
+    assert [m["role"] for m in prompts[1] if m["role"] != "system"] == ["user", "assistant", "user"]
+    assert "first question" in prompts[1][-3]["content"]
+    assert prompts[1][-2]["content"] == "answer 1"
+    assert [m["content"] for m in sessions.get(session_id).messages] == [
+        "first question", "answer 1", "second question", "answer 2"
+    ]
+    # The stored history isn't sent back
+    (prompt,) = [e["promptedHistory"] for e in events if e and e["state"] == "prompt"]
+    assert [m["role"] for m in prompt if m["role"] != "system"] == ["user"]
+
+
+def test_run_query_stored_history_needs_token():
+    sessions = SessionStore(TTLCache("test-chat-sessions", max_bytes=1024 * 1024, ttl=60, register=False), load_from_db=False)
+    session_id = str(uuid.uuid4())
+    prompts, events = [], []
+
+    def query_llm(prompt, settings):
+        prompts.append(prompt)
+        yield {"type": "response", "text": "answer"}
+
+    with patch("stampy_chat.chat.session_store", sessions):
+        with patch("stampy_chat.chat.query_llm", side_effect=query_llm):
+            with patch("stampy_chat.chat.search_queries", return_value=[[match("a")]]):
+                with patch("stampy_chat.callbacks.logger"):
+                    chat.run_query(session_id, "secret question", [], Settings(enable_hyde=False), followups=False)
+                    # Someone else who knows the session id
+                    chat.run_query(session_id, "what was asked?", None, Settings(enable_hyde=False), events.append, followups=False)
+                    chat.run_query(
+                        session_id, "what was asked?", None, Settings(enable_hyde=False), events.append,
+                        followups=False, session_token="made up",
+                    )
+                    # ...can't get a token by starting the session again
+                    chat.run_query(session_id, "hello", [], Settings(enable_hyde=False), events.append, followups=False)
+
+    assert all("secret question" not in m["content"] for prompt in prompts[1:] for m in prompt)
+    assert not [e for e in events if e and e["state"] == "session"]
+    assert [m["content"] for m in sessions.get(session_id).messages] == ["secret question", "answer"]
@@ -0,0 +1,56 @@
+from unittest.mock import Mock, patch
+
+from stampy_chat.citations import blocks_from_matches, fuse_results, search_queries
+from stampy_chat.settings import Settings
+
+
+def match(id, score=0.5, title=None, url=None):
+    return Mock(
+        id=id,
+        score=score,
+        metadata={
+            "hash_id": id,
+            "title": title or f"Title {id}",
+            "url": url or f"http://example.org/{id}",
+            "authors": ["Author"],
+            "date_published": "2023-01-01",
+            "text": f"Text of {id}",
+        },
+    )
+
+
+def test_fuse_results_single_list_keeps_scores():
+    a, b = match("a", 0.9), match("b", 0.3)
+    assert fuse_results([[a, b]]) == [(0.9, a), (0.3, b)]
+
+
+def test_fuse_results_reciprocal_rank():
+    a, b, c = match("a"), match("b"), match("c")
+    fused = fuse_results([[a, b, c], [c, b]], k=1)
+
+    assert [m.id for _, m in fused] == ["c", "b", "a"]
+    assert [score for score, _ in fused] == [1 / 4 + 1 / 2, 1 / 3 + 1 / 3, 1 / 2]
+
+
+def test_blocks_from_matches_deduplicates_documents():
+    matches = [
+        (0.9, match("a1", title="Doc A")),
+        (0.8, match("b", title="Doc B")),
+        (0.7, match("a2", title="Doc A")),
+    ]
+
+    blocks = blocks_from_matches(matches)
+    assert [(b["id"], b["reference"]) for b in blocks] == [("a1", "1"), ("b", "2")]
+
+    blocks = blocks_from_matches(matches, snippets_per_doc=2)
+    assert [(b["id"], b["reference"]) for b in blocks] == [("a1", "1"), ("b", "2"), ("a2", "1")]
+
+
+def test_search_queries_embeds_once():
+    results = {1: [match("a")], 2: [match("b")]}
+    with patch("stampy_chat.citations.embed_queries", return_value=[[1], [2]]) as embed:
+        with patch("stampy_chat.citations.search_vector", side_effect=lambda v, f: results[v[0]]) as search:
+            assert search_queries(["query 1", "query 2"], Settings(), {"bla": True}) == [results[1], results[2]]
+
+    embed.assert_called_once()
+    assert search.call_count == 2
@@ -0,0 +1,57 @@
+import threading
+from unittest.mock import Mock, patch
+
+import pytest
+
+from stampy_chat import clients
+from stampy_chat.clients import get_client, reset_clients
+
+
+@pytest.fixture(autouse=True)
+def empty_registry():
+    reset_clients()
+    yield
+    reset_clients()
+
+
+def test_get_client_reuses_client():
+    factory = Mock(side_effect=lambda: object())
+
+    first = get_client(("bla", None), factory)
+    assert get_client(("bla", None), factory) is first
+    factory.assert_called_once()
+
+
+def test_get_client_separate_keys():
+    assert get_client(("bla", None), object) is not get_client(("bla", "http://example.org"), object)
+
+
+def test_get_client_threads_share_client():
+    factory = Mock(side_effect=lambda: object())
+    results = []
+
+    threads = [threading.Thread(target=lambda: results.append(get_client("key", factory))) for _ in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len({id(r) for r in results}) == 1
+    factory.assert_called_once()
+
+
+def test_reset_clients():
+    first = get_client("key", object)
+    reset_clients()
+    assert get_client("key", object) is not first
+
+
+def test_openrouter_client_uses_own_pool():
+    with patch("stampy_chat.clients.OPENAI_API_KEY", "sk-bla"):
+        with patch("stampy_chat.clients.OPENROUTER_API_KEY", "sk-or-bla"):
+            openai = clients.openai_client(api_key="sk-bla")
+            openrouter = clients.openrouter_client()
+
+    assert openai is not openrouter
+    assert str(openrouter.base_url).startswith(clients.OPENROUTER_BASE_URL)
+    assert clients.openrouter_client() is openrouter
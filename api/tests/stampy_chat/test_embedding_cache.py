@@ -0,0 +1,89 @@
+import sqlite3
+from unittest.mock import Mock, patch
+
+import pytest
+
+from stampy_chat.citations import embed_queries
+from stampy_chat.embedding_cache import EmbeddingCache, cache_key
+from stampy_chat.settings import Settings
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return EmbeddingCache(str(tmp_path / "embeddings.sqlite3"), max_entries=3)
+
+
+def test_cache_key_normalizes_whitespace():
+    assert cache_key("model", "query", "  what is\n AGI? ") == cache_key("model", "query", "what is AGI?")
+    assert cache_key("model", "query", "what is AGI?") != cache_key("model", "document", "what is AGI?")
+    assert cache_key("model", "query", "what is AGI?") != cache_key("other model", "query", "what is AGI?")
+
+
+def test_get_many_misses(cache):
+    assert cache.get_many("model", "query", ["bla", "ble"]) == [None, None]
+    assert cache.stats()["misses"] == 2
+
+
+def test_put_and_get(cache):
+    cache.put_many("model", "query", ["bla", "ble"], [[0.5, -0.25], [1.0, 2.0]])
+
+    assert cache.get_many("model", "query", ["ble", "blu", "bla"]) == [[1.0, 2.0], None, [0.5, -0.25]]
+    assert cache.stats()["hits"] == 2
+    assert cache.stats()["misses"] == 1
+
+
+def test_int8_vectors(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "embeddings.sqlite3"), dtype="int8")
+    cache.put_many("model", "query", ["bla"], [[0.5, -0.25, 0.01]])
+
+    (vector,) = cache.get_many("model", "query", ["bla"])
+    assert vector == pytest.approx([0.5, -0.25, 0.01], abs=0.005)
+
+
+def test_shared_between_instances(cache):
+    cache.put_many("model", "query", ["bla"], [[1.0]])
+    assert EmbeddingCache(cache.path).get_many("model", "query", ["bla"]) == [[1.0]]
+
+
+def test_evicts_least_recently_used(cache):
+    with patch("stampy_chat.embedding_cache.time.time", side_effect=range(100)):
+        cache.put_many("model", "query", ["a", "b", "c"], [[1.0], [2.0], [3.0]])
+        cache.get_many("model", "query", ["a"])
+        cache.put_many("model", "query", ["d"], [[4.0]])
+
+    assert cache.get_many("model", "query", ["a", "b", "c", "d"]) == [[1.0], None, [3.0], [4.0]]
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["entries"] == 3
+
+
+def test_only_prunes_every_so_often(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "embeddings.sqlite3"), max_entries=2, prune_every=3)
+    with patch.object(cache, "evict", wraps=cache.evict) as evict:
+        cache.put_many("model", "query", ["a", "b"], [[1.0], [2.0]])
+        cache.put_many("model", "query", ["c"], [[3.0]])
+        cache.put_many("model", "query", ["d"], [[4.0]])
+
+    assert evict.call_count == 1
+    # "d" was stored after the last prune, so the cache is over the limit until the next one
+    assert cache.stats()["entries"] == 3
+
+
+def test_database_errors_are_misses(cache):
+    with patch.object(cache, "_connection", side_effect=sqlite3.OperationalError("database is locked")):
+        assert cache.get_many("model", "query", ["bla"]) == [None]
+        cache.put_many("model", "query", ["bla"], [[1.0]])
+    assert cache.stats()["errors"] == 2
+
+
+def test_embed_queries_only_embeds_missing(cache):
+    client = Mock()
+    client.embed.return_value.embeddings = [[2.0]]
+    cache.put_many("voyage-3", None, ["cached"], [[1.0]])
+
+    with patch("stampy_chat.citations.embedding_cache", cache):
+        with patch("stampy_chat.citations.VOYAGEAI_EMBEDDINGS_MODEL", "voyage-3"):
+            with patch("stampy_chat.citations.voyage_client", return_value=client):
+                assert embed_queries(["cached", "new"], Settings()) == [[1.0], [2.0]]
+                assert embed_queries(["new"], Settings()) == [[2.0]]
+
+    client.embed.assert_called_once_with(["new"], model="voyage-3")
@@ -0,0 +1,123 @@
+import json
+import os
+from unittest.mock import patch
+
+import numpy as np
+import pytest
+
+from stampy_chat.followup_index import FollowupIndex, FollowupIndexLoader, read_questions
+
+QUESTIONS = [
+    {"pageid": "1", "title": "What is AGI?"},
+    {"pageid": "2", "title": "What is alignment?"},
+    {"pageid": "3", "title": "Why is AI dangerous?"},
+    {"pageid": "1", "title": "A repeated page id"},
+    {"pageid": "4", "title": "   "},
+]
+VECTORS = {
+    "What is AGI?": [1.0, 0.0, 0.0],
+    "What is alignment?": [0.8, 0.6, 0.0],
+    "Why is AI dangerous?": [0.0, 0.0, 2.0],
+}
+
+
+def embed(texts):
+    return [VECTORS[text] for text in texts]
+
+
+@pytest.fixture
+def index():
+    return FollowupIndex.build(QUESTIONS, embed)
+
+
+def test_build_skips_bad_questions(index):
+    assert index.pageids == ["1", "2", "3"]
+    assert index.titles == ["What is AGI?", "What is alignment?", "Why is AI dangerous?"]
+    assert np.allclose(np.linalg.norm(index.vectors, axis=1), 1)
+
+
+def test_build_in_batches():
+    calls = []
+
+    def counting_embed(texts):
+        calls.append(len(texts))
+        return embed(texts)
+
+    with patch("stampy_chat.followup_index.EMBED_BATCH_SIZE", 2):
+        FollowupIndex.build(QUESTIONS, counting_embed)
+    assert calls == [2, 1]
+
+
+def test_search(index):
+    results = index.search([[2.0, 0.0, 0.0], [0.0, 0.0, 1.0], [0.0, -1.0, 0.0]], threshold=0.4, limit=3)
+    assert results == [
+        [
+            {"text": "What is AGI?", "pageid": "1", "score": pytest.approx(1.0)},
+            {"text": "What is alignment?", "pageid": "2", "score": pytest.approx(0.8)},
+        ],
+        [{"text": "Why is AI dangerous?", "pageid": "3", "score": pytest.approx(1.0)}],
+        [],
+    ]
+
+
+def test_search_limit(index):
+    assert [r["pageid"] for r in index.search([[1.0, 0.1, 0.0]], threshold=0.0, limit=1)[0]] == ["1"]
+
+
+def test_search_empty():
+    empty = FollowupIndex(np.zeros((0, 3)), [], [])
+    assert empty.search([[1.0, 0.0, 0.0]], threshold=0.4, limit=3) == [[]]
+
+
+def test_save_and_load(index, tmp_path):
+    path = str(tmp_path / "index.npz")
+    index.save(path)
+    loaded = FollowupIndex.load(path)
+
+    assert loaded.pageids == index.pageids
+    assert loaded.titles == index.titles
+    assert np.array_equal(loaded.vectors, index.vectors)
+    assert os.listdir(tmp_path) == ["index.npz"]
+
+
+@pytest.mark.parametrize("format", (json.dumps, lambda items: "\n".join(json.dumps(i) for i in items)))
+def test_read_questions(tmp_path, format):
+    path = tmp_path / "questions.json"
+    path.write_text(format(QUESTIONS))
+    assert read_questions(str(path)) == QUESTIONS
+
+
+def test_loader_reloads_changed_snapshots(index, tmp_path):
+    path = str(tmp_path / "index.npz")
+    loader = FollowupIndexLoader(path, refresh=3600)
+    assert not loader.reload()
+    assert loader.stats()["questions"] == 0
+
+    index.save(path)
+    assert loader.reload()
+    assert not loader.reload()
+    assert loader.stats()["questions"] == 3
+
+    FollowupIndex(index.vectors[:1], index.pageids[:1], index.titles[:1]).save(path)
+    os.utime(path, (0, 0))
+    assert loader.reload()
+    assert len(loader.index) == 1
+
+
+def test_loader_rebuilds_stale_snapshots(index, tmp_path):
+    path = str(tmp_path / "index.npz")
+    source = tmp_path / "questions.json"
+    source.write_text(json.dumps(QUESTIONS))
+    loader = FollowupIndexLoader(path, source=str(source), refresh=3600)
+
+    with patch("stampy_chat.followup_index.embed_titles", side_effect=embed) as embed_titles:
+        assert loader.rebuild()
+        # The snapshot is fresh, so there's no need to rebuild it
+        assert not loader.rebuild()
+        os.utime(path, (0, 0))
+        assert loader.rebuild()
+    assert embed_titles.call_count == 2
+
+
+def test_loader_without_source(tmp_path):
+    assert not FollowupIndexLoader(str(tmp_path / "index.npz")).rebuild()
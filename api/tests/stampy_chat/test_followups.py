@@ -0,0 +1,179 @@
+from concurrent.futures import Future
+from unittest.mock import ANY, Mock, patch
+
+import httpx
+import numpy as np
+import pytest
+from pytest import approx
+
+from stampy_chat.cache import TTLCache
+from stampy_chat.followup_index import FollowupIndex
+from stampy_chat.followups import (
+    Followup,
+    FollowupSearch,
+    merge_followups,
+    multisearch_authored,
+    normalize_query,
+    search_followups,
+    start_followups,
+)
+
+
+def followup(pageid, score):
+    return Followup(text=f"question {pageid}", pageid=pageid, score=score)
+
+
+def test_merge_followups():
+    assert merge_followups([
+        [followup("1", 0.5), followup("2", 0.9), followup("3", 0.1)],
+        [followup("1", 0.7), followup("4", 0.6), followup("5", 0.45)],
+    ]) == [followup("2", 0.9), followup("1", 0.7), followup("4", 0.6)]
+
+
+def test_multisearch_authored():
+    results = {"query": [followup("1", 0.5)], "response": [followup("2", 0.8)]}
+    with patch("stampy_chat.followups.get_followups", side_effect=results.get):
+        assert multisearch_authored(["query", "response"]) == [followup("2", 0.8), followup("1", 0.5)]
+
+
+def test_search_followups_uses_started_search():
+    started = Future()
+    started.set_result([followup("1", 0.5)])
+    callback = Mock()
+
+    with patch("stampy_chat.followups.get_followups", return_value=[followup("2", 0.8)]) as get_followups:
+        follows = search_followups("query", "response", [callback], started)
+
+    get_followups.assert_called_once_with("response")
+    assert follows == [followup("2", 0.8), followup("1", 0.5)]
+    callback.on_followups_start.assert_called_once_with({"query": "query", "response": "response"})
+    callback.on_followups_end.assert_called_once_with(follows)
+
+
+def test_search_followups_failed_query_search():
+    started = Future()
+    started.set_exception(ValueError("bla"))
+
+    with patch("stampy_chat.followups.get_followups", return_value=[followup("2", 0.8)]):
+        assert search_followups("query", "response", [], started) == [followup("2", 0.8)]
+
+
+@pytest.fixture
+def api():
+    """A fake search API, which records the queries it gets."""
+    queries = []
+
+    def handler(request):
+        query = request.url.params["query"]
+        queries.append(query)
+        if query == "slow":
+            raise httpx.ReadTimeout("too slow", request=request)
+        if query == "broken":
+            return httpx.Response(500)
+        return httpx.Response(200, json=[{"title": f"about {query}", "pageid": "1", "score": 0.7}])
+
+    client = httpx.Client(transport=httpx.MockTransport(handler))
+    with patch("stampy_chat.followups.followups_client", return_value=client):
+        yield queries
+
+
+def search():
+    return FollowupSearch("http://search.test/api/search", TTLCache("test-followups", max_bytes=1024 * 1024, ttl=60, register=False))
+
+
+def test_normalize_query():
+    assert normalize_query("  What is\n AGI? ") == "what is agi?"
+    assert len(normalize_query("a" * 10_000)) == 4093
+
+
+def test_followup_search_caches(api):
+    followups = search()
+    assert followups.search("What is AGI?") == [Followup(text="about what is agi?", pageid="1", score=0.7)]
+    assert followups.search("what is  agi?") == [Followup(text="about what is agi?", pageid="1", score=0.7)]
+    assert followups.search("   ") == []
+
+    assert api == ["what is agi?"]
+    stats = followups.stats()
+    assert stats["requests"] == 1
+    assert stats["cache_hits"] == 1
+    assert stats["hit_rate"] == 0.5
+
+
+def test_followup_search_failures(api):
+    followups = search()
+    assert followups.search("slow") == []
+    assert followups.search("broken") == []
+    # Failures aren't cached
+    assert followups.search("broken") == []
+
+    assert api == ["slow", "broken", "broken"]
+    stats = followups.stats()
+    assert stats["timeouts"] == 1
+    assert stats["errors"] == 2
+    assert stats["requests"] == 3
+
+
+def test_multisearch_authored_deduplicates():
+    with patch("stampy_chat.followups.get_followups", return_value=[followup("1", 0.5)]) as get_followups:
+        assert multisearch_authored(["query", "query"]) == [followup("1", 0.5)]
+    get_followups.assert_called_once_with("query")
+
+
+@pytest.fixture
+def local_index():
+    index = FollowupIndex(
+        np.array([[1.0, 0.0], [0.8, 0.6], [0.0, 1.0]]), ["1", "2", "3"], ["question 1", "question 2", "question 3"]
+    )
+    # Only the query was embedded for retrieval - the response isn't in the embeddings cache
+    vectors = {"query": [1.0, 0.0], "other query": [0.0, 1.0]}
+    with (
+        patch("stampy_chat.followups.local_index", return_value=index),
+        patch("stampy_chat.followups.cached_embeddings", side_effect=lambda texts: [vectors.get(t) for t in texts]) as cached,
+        patch("stampy_chat.followups.get_followups") as get_followups,
+    ):
+        yield cached
+    get_followups.assert_not_called()
+
+
+def test_multisearch_authored_local(local_index):
+    assert multisearch_authored(["query", "other query", "response", "query"]) == [
+        followup("1", approx(1.0)), followup("3", approx(1.0)), followup("2", approx(0.8))
+    ]
+    local_index.assert_called_once_with(["query", "other query", "response"])
+
+
+def test_search_followups_local(local_index):
+    started = Future()
+    assert search_followups("query", "response", [], started) == [followup("1", approx(1.0)), followup("2", approx(0.8))]
+    assert started.cancelled()
+
+
+def test_search_followups_local_threshold(local_index):
+    # Scores under the local threshold are dropped, even though they'd be good enough for the remote search
+    with patch("stampy_chat.followups.FOLLOWUP_INDEX_THRESHOLD", 0.9):
+        assert search_followups("query", "response", []) == [followup("1", approx(1.0))]
+
+
+def test_start_followups_local(local_index):
+    assert start_followups("query") is None
+
+
+def test_local_search_never_embeds(local_index):
+    with patch("stampy_chat.citations.voyage_client") as voyage:
+        search_followups("query", "response", [])
+    voyage.assert_not_called()
+
+
+@pytest.mark.parametrize("cached", [
+    Mock(side_effect=ValueError("no embeddings cache")),
+    Mock(side_effect=lambda texts: [None] * len(texts)),
+])
+def test_local_search_falls_back_to_remote(cached):
+    index = FollowupIndex(np.array([[1.0, 0.0]]), ["1"], ["question 1"])
+    with (
+        patch("stampy_chat.followups.local_index", return_value=index),
+        patch("stampy_chat.followups.cached_embeddings", cached),
+        patch("stampy_chat.followups.get_followups", return_value=[followup("2", 0.5)]),
+    ):
+        assert multisearch_authored(["query"]) == [followup("2", 0.5)]
+        assert search_followups("query", "response", []) == [followup("2", 0.5)]
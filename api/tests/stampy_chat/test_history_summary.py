@@ -0,0 +1,95 @@
+from unittest.mock import patch
+
+import pytest
+
+from stampy_chat.citations import Message
+from stampy_chat.history_summary import apply_summary, summaries, summarize_later, update_summary
+from stampy_chat.prompts import inject_guidance
+from stampy_chat.settings import Settings
+
+
+def conversation(turns):
+    history = []
+    for i in range(turns):
+        history.append(Message(role="user", content=f"question {i}"))
+        history.append(Message(role="assistant", content=f"answer {i}"))
+    return history
+
+
+@pytest.fixture(autouse=True)
+def clear_summaries():
+    summaries.clear()
+    yield
+    summaries.clear()
+
+
+def test_update_summary_folds_old_messages():
+    history = conversation(5)
+    with patch("stampy_chat.history_summary.query_llm", return_value=" the summary ") as llm:
+        state = update_summary("session", history, Settings())
+
+    assert state.summary == "the summary"
+    assert state.covered == 4
+    prompt = llm.call_args[0][0]
+    assert "question 0" in prompt[1]["content"] and "answer 1" in prompt[1]["content"]
+    assert "question 2" not in prompt[1]["content"]
+    assert llm.call_args[1]["max_tokens"] == Settings().maxHistorySummaryTokens
+
+
+def test_update_summary_is_incremental():
+    history = conversation(6)
+    with patch("stampy_chat.history_summary.query_llm", side_effect=["first", "second"]) as llm:
+        update_summary("session", history[:10], Settings())
+        state = update_summary("session", history, Settings())
+
+    assert state == ("second", 6, state.fingerprint)
+    # Only the previous summary and the newly old messages are sent
+    content = llm.call_args[0][0][1]["content"]
+    assert "first" in content
+    assert "question 3" not in content
+    assert "question 4" not in content and "answer 2" in content
+
+
+def test_update_summary_short_conversations():
+    with patch("stampy_chat.history_summary.query_llm") as llm:
+        assert update_summary("session", conversation(3), Settings()) is None
+    llm.assert_not_called()
+
+
+def test_apply_summary():
+    history = conversation(5)
+    with patch("stampy_chat.history_summary.query_llm", return_value="the summary"):
+        update_summary("session", history, Settings())
+
+    recent, summary = apply_summary("session", history + [Message(role="deleted", content="bla")])
+    assert summary == "the summary"
+    assert recent == history[4:]
+
+    # Other sessions, or histories that don't start with the summarized messages, don't get the summary
+    assert apply_summary("other session", history) == (history, None)
+    edited = [Message(role="user", content="something else")] + history[1:]
+    assert apply_summary("session", edited) == (edited, None)
+    assert apply_summary(None, history) == (history, None)
+
+
+def test_summarize_later_skips_short_conversations():
+    with patch("stampy_chat.history_summary.summary_executor") as executor:
+        summarize_later("session", conversation(3), Settings())
+        summarize_later(None, conversation(10), Settings())
+        executor.submit.assert_not_called()
+
+        summarize_later("session", conversation(10), Settings())
+        executor.submit.assert_called_once()
+
+
+def test_inject_guidance_with_summary():
+    history = conversation(2)
+    prompt = inject_guidance("query", history, [], Settings(), summary="the summary")
+
+    assert all("the summary" not in m["content"] for m in prompt if m["role"] == "system")
+    assert prompt[2]["role"] == "user"
+    assert prompt[2]["content"].startswith("<conversation-summary>\nthe summary\n</conversation-summary>")
+    assert "question 0" in prompt[2]["content"]
+
+    prompt = inject_guidance("query", [], [], Settings(), summary="the summary")
+    assert "the summary" in prompt[-1]["content"]
@@ -0,0 +1,158 @@
+import json
+from unittest.mock import Mock, patch
+
+import httpx
+import pytest
+
+from stampy_chat.cache import TTLCache
+from stampy_chat.human_content import HumanContentProxy, page_title, rewrite_links
+
+BODY = json.dumps({"data": {"title": "What is AGI?", "text": '<a href="/?state=6207&question=What">'}})
+
+
+@pytest.fixture
+def api():
+    """A fake aisafety.info, which records the requests it gets."""
+    requests = []
+    pages = {"1": BODY}
+
+    def handler(request):
+        requests.append(request)
+        id = request.url.path.split("/")[-1]
+        if id.endswith("broken"):
+            raise httpx.ConnectError("down", request=request)
+        if id.endswith("failing"):
+            return httpx.Response(500, text='{"error": "oops"}')
+        if id not in pages:
+            return httpx.Response(404, text='{"error": "not found"}')
+        if request.headers.get("If-None-Match") == f'"{id}"':
+            return httpx.Response(304)
+        return httpx.Response(200, text=pages[id], headers={"ETag": f'"{id}"'})
+
+    client = httpx.Client(transport=httpx.MockTransport(handler))
+    with (
+        patch("stampy_chat.human_content.human_content_client", return_value=client),
+        # Run background refreshes straight away
+        patch("stampy_chat.human_content.executor", Mock(submit=lambda f: f())),
+    ):
+        yield requests
+
+
+@pytest.fixture
+def clock():
+    with patch("stampy_chat.human_content.time.monotonic", return_value=1000.0) as monotonic:
+        yield monotonic
+
+
+def proxy():
+    return HumanContentProxy(
+        "http://aisafety.test/questions/{id}", TTLCache("test-human", max_bytes=1024 * 1024, ttl=3600, register=False), ttl=10, stale_ttl=20
+    )
+
+
+def test_rewrite_links():
+    assert rewrite_links(json.dumps('<a href="/?state=6207&question=What">')) == json.dumps(
+        '<a href="https://aisafety.info/?state=6207&question=What">'
+    )
+
+
+def test_page_title():
+    assert page_title(BODY) == "What is AGI?"
+    assert page_title("not json") is None
+    assert page_title('{"data": null}') is None
+
+
+def test_get_caches_rewritten_pages(api, clock):
+    pages = proxy()
+    page = pages.get("1")
+    assert page.status == 200
+    assert page.title == "What is AGI?"
+    assert "https://aisafety.info/?state=6207" in page.body
+    assert pages.get("1") is page
+
+    assert len(api) == 1
+    assert pages.stats()["fresh"] == 1
+
+
+def test_get_serves_stale_while_revalidating(api, clock):
+    pages = proxy()
+    pages.get("1")
+
+    clock.return_value += 15
+    assert pages.get("1").status == 200
+    assert pages.stats()["stale"] == 1
+    # The background refresh was a conditional request
+    assert api[-1].headers["If-None-Match"] == '"1"'
+    assert pages.stats()["not_modified"] == 1
+
+    # ...which made the page fresh again
+    assert pages.get("1").fetched == clock.return_value
+    assert len(api) == 2
+
+
+def test_get_revalidates_old_pages(api, clock):
+    pages = proxy()
+    pages.get("1")
+
+    clock.return_value += 100
+    assert pages.get("1").fetched == clock.return_value
+    assert api[-1].headers["If-None-Match"] == '"1"'
+    assert pages.stats()["stale"] == 0
+
+
+def test_get_serves_old_pages_on_errors(api, clock):
+    pages = proxy()
+    old = pages.update("1")
+    pages.cache.set("broken", old)
+
+    clock.return_value += 100
+    assert pages.get("broken") is old
+    assert pages.get("missing-and-broken") is None
+    assert pages.stats()["errors"] == 2
+
+
+def test_get_serves_old_pages_on_error_statuses(api, clock):
+    pages = proxy()
+    old = pages.update("1")
+    pages.cache.set("failing", old)
+    pages.cache.set("gone", old)
+
+    clock.return_value += 100
+    assert pages.get("failing") is old
+    assert pages.get("gone") is old
+    # The error responses didn't replace the cached pages
+    assert pages.cache.get("failing") is old
+    assert pages.cache.get("gone") is old
+    assert pages.stats()["errors"] == 2
+
+
+def test_get_missing_pages_arent_cached(api, clock):
+    pages = proxy()
+    page = pages.get("2")
+    assert page.status == 404
+    assert pages.cache_control(page) == "no-cache"
+    pages.get("2")
+    assert len(api) == 2
+
+
+def test_cache_control(api, clock):
+    pages = proxy()
+    page = pages.get("1")
+    assert pages.cache_control(page) == "public, max-age=10, stale-while-revalidate=20"
+    clock.return_value += 4
+    assert pages.cache_control(page) == "public, max-age=6, stale-while-revalidate=20"
+
+
+def test_prefetch(api, clock):
+    pages = proxy()
+    pages.get("1")
+    assert pages.prefetch(["1", "2", "2", "broken"]) == ["2", "broken"]
+    assert [r.url.path for r in api] == ["/questions/1", "/questions/2", "/questions/broken"]
+
+
+def test_refresh_later_deduplicates(clock):
+    pages = proxy()
+    with patch("stampy_chat.human_content.executor") as executor:
+        assert pages.refresh_later("1")
+        assert not pages.refresh_later("1")
+    executor.submit.assert_called_once()
@@ -0,0 +1,196 @@
+import asyncio
+import time
+from unittest.mock import MagicMock, Mock, patch
+
+import pytest
+
+from stampy_chat import routing
+from stampy_chat.metrics import Histogram
+from stampy_chat.citations import Message
+from stampy_chat.llms import CACHE_CONTROL, LLMChunk, add_cache_breakpoints, anthropic_stream, aquery_llm, query_llm
+from stampy_chat.settings import Settings
+
+
+def test_add_cache_breakpoints_system_and_history():
+    system, messages = add_cache_breakpoints([
+        Message(role="system", content="reference documents"),
+        Message(role="system", content="history prompt"),
+        Message(role="user", content="first question"),
+        Message(role="assistant", content="first answer"),
+        Message(role="user", content="second question"),
+    ])
+
+    assert system == [
+        {"type": "text", "text": "reference documents"},
+        {"type": "text", "text": "history prompt", "cache_control": CACHE_CONTROL},
+    ]
+    assert messages == [
+        {"role": "user", "content": [{"type": "text", "text": "first question"}]},
+        {"role": "assistant", "content": [{"type": "text", "text": "first answer", "cache_control": CACHE_CONTROL}]},
+        {"role": "user", "content": [{"type": "text", "text": "second question"}]},
+    ]
+
+
+def test_add_cache_breakpoints_single_message():
+    system, messages = add_cache_breakpoints([Message(role="user", content="a question")])
+
+    assert system == []
+    assert messages == [{"role": "user", "content": [{"type": "text", "text": "a question"}]}]
+
+
+def test_anthropic_stream_reports_usage():
+    usage = Mock(input_tokens=12, output_tokens=1, cache_creation_input_tokens=0, cache_read_input_tokens=40000)
+    events = [
+        Mock(type="message_start", message=Mock(usage=usage)),
+        Mock(type="content_block_delta", delta=Mock(type="thinking_delta", thinking="hmm")),
+        Mock(type="content_block_delta", delta=Mock(type="text_delta", text="Hello")),
+        Mock(type="message_delta", usage=Mock(output_tokens=34)),
+        Mock(type="message_stop"),
+    ]
+
+    assert list(anthropic_stream(events)) == [
+        LLMChunk(type="thinking", text="hmm"),
+        LLMChunk(type="response", text="Hello"),
+        LLMChunk(
+            type="usage",
+            text="",
+            usage={
+                "input_tokens": 12,
+                "output_tokens": 34,
+                "cache_creation_input_tokens": 0,
+                "cache_read_input_tokens": 40000,
+            },
+        ),
+    ]
+
+
+def test_anthropic_stream_closes_response():
+    response = MagicMock()
+    response.__iter__.return_value = iter([
+        Mock(type="content_block_delta", delta=Mock(type="text_delta", text="Hello")),
+        Mock(type="content_block_delta", delta=Mock(type="text_delta", text=" there")),
+    ])
+
+    stream = anthropic_stream(response)
+    assert next(stream) == LLMChunk(type="response", text="Hello")
+    stream.close()
+
+    response.close.assert_called_once()
+
+
+class Overloaded(Exception):
+    status_code = 529
+
+
+@pytest.fixture
+def providers():
+    """Fake providers: "anthropic" fails before the first chunk, "google" works."""
+    def anthropic_call(history, model, max_tokens, thinking_budget, stream):
+        raise Overloaded()
+
+    def google_call(history, model, max_tokens, thinking_budget, stream):
+        if not stream:
+            return f"{model} says hi"
+        return (chunk for chunk in [LLMChunk(type="response", text=model), LLMChunk(type="response", text=" says hi")])
+
+    calls = {"anthropic": Mock(side_effect=anthropic_call), "google": Mock(side_effect=google_call)}
+    with (
+        patch.dict(routing._health, clear=True),
+        patch.dict("stampy_chat.llms.PROVIDERS", calls),
+        patch("stampy_chat.routing.LLM_FALLBACK_MODELS", {"anthropic": ["google/gemini-2.5-flash"]}),
+    ):
+        yield calls
+
+
+def test_query_llm_falls_back_before_first_chunk(providers):
+    settings = Settings(model="anthropic/claude-sonnet-4-20250514")
+    chunks = list(query_llm([{"role": "user", "content": "hi"}], settings))
+
+    assert "".join(c["text"] for c in chunks) == "gemini-2.5-flash says hi"
+    assert routing.provider_health("anthropic").failures == 1
+    assert routing.provider_health("google").calls == 1
+    # Google always thinks
+    assert providers["google"].call_args.args[3] == 2048
+
+
+def test_query_llm_stream_errors_after_first_chunk(providers):
+    def broken(*args, **kwargs):
+        yield LLMChunk(type="response", text="Hello")
+        raise Overloaded()
+
+    providers["anthropic"].side_effect = broken
+    chunks = query_llm([], Settings(model="anthropic/claude-sonnet-4-20250514"))
+    assert next(chunks) == LLMChunk(type="response", text="Hello")
+    with pytest.raises(Overloaded):
+        next(chunks)
+    providers["google"].assert_not_called()
+    assert routing.provider_health("anthropic").failures == 1
+
+
+def test_query_llm_bad_requests_not_retried(providers):
+    class BadRequest(Exception):
+        status_code = 400
+
+    providers["anthropic"].side_effect = BadRequest()
+    with pytest.raises(BadRequest):
+        query_llm([], Settings(model="anthropic/claude-sonnet-4-20250514"), stream=False)
+    providers["google"].assert_not_called()
+    assert routing.provider_health("anthropic").failures == 0
+
+
+def test_query_llm_hedges(providers):
+    def slow(*args, **kwargs):
+        time.sleep(1)
+        return "slow"
+
+    providers["anthropic"].side_effect = slow
+    with patch("stampy_chat.llms.hedge_delay", return_value=0.05):
+        text = query_llm([], Settings(model="anthropic/claude-sonnet-4-20250514"), stream=False, hedge=True)
+    assert text == "gemini-2.5-flash says hi"
+
+
+def test_query_llm_timer_labels_answering_model(providers):
+    timer = Histogram("test_llm_seconds", "A test", ("model", "provider"))
+    query_llm([], Settings(model="anthropic/claude-sonnet-4-20250514"), stream=False, timer=timer)
+
+    samples = list(timer.samples())
+    assert 'test_llm_seconds_count{model="google/gemini-2.5-flash",provider="google"} 1' in samples
+    assert not [s for s in samples if "anthropic" in s]
+
+
+def test_query_llm_keeps_completion_times_out_of_ttft(providers):
+    settings = Settings(model="google/gemini-2.5-flash")
+    query_llm([], settings, stream=False)
+    health = routing.provider_health("google")
+    assert (len(health.completion), len(health.ttft)) == (1, 0)
+
+    list(query_llm([], settings))
+    assert (len(health.completion), len(health.ttft)) == (1, 1)
+
+
+def test_query_llm_unknown_provider():
+    with pytest.raises(ValueError):
+        query_llm([], Settings(model="bla/model"))
+
+
+def test_aquery_llm_falls_back_before_first_chunk():
+    async def anthropic_call(*args, **kwargs):
+        raise Overloaded()
+
+    async def google_call(history, model, max_tokens, thinking_budget, stream):
+        async def chunks():
+            yield LLMChunk(type="response", text=model)
+        return chunks()
+
+    async def run():
+        chunks = await aquery_llm([], Settings(model="anthropic/claude-sonnet-4-20250514"))
+        return [chunk async for chunk in chunks]
+
+    with (
+        patch.dict(routing._health, clear=True),
+        patch.dict("stampy_chat.llms.ASYNC_PROVIDERS", {"anthropic": anthropic_call, "google": google_call}),
+        patch("stampy_chat.routing.LLM_FALLBACK_MODELS", {"anthropic": ["google/gemini-2.5-flash"]}),
+    ):
+        assert asyncio.run(run()) == [LLMChunk(type="response", text="gemini-2.5-flash")]
+        assert routing.provider_health("anthropic").failures == 1
+        assert routing.provider_health("google").calls == 1
@@ -3,6 +3,7 @@ from unittest.mock import patch, Mock, call
 
 from stampy_chat.logging import *
 from stampy_chat.citations import Message
+from stampy_chat.prompt_store import KnownBlobs, reconstruct_prompt
 
 
 def test_emit_ignore_internal():
@@ -168,28 +169,19 @@ def test_ChatLogger_interaction():
         for i in range(5)
     ]
     response = "This is the response from the LLM to the user's query"
-    prompt = (
-        "System: This is where the system prompt would go\n"
-        "User: Q: Die monster. You don’t belong in this world!\n"
-        "Assistant: It was not by my hand[x] I am once again given flesh. I was called\n"
-        "User: Q: Tribute!?! You steal men's souls and make them your slaves!\n"
-        "Assistant: Perhaps the same could be said[x] of all religions...\n"
-        "User: Q: Your words are as empty as your soul! Mankind ill needs a savior such as you!\n",
-        "Assistant: What is a man? A[x] miserable little pile of secrets\n"
-        "User: In your answer, please cite any claims you make back to each "
-        "source using the format: [a], [b], etc. If you use multiple "
-        'sources to make a claim cite all of them. For example: "AGI is '
-        'concerning [c, d, e]."\n'
-        "\n"
-        "Q: to be or not to be?",
-    )
+    system = "\n\n".join(f"[{i}] Block{i} - Author{i} - 2021-01-0{i + 1}\n" + "Block text " * 50 for i in range(5))
+    prompt = [
+        Message(role="system", content=system),
+        *history,
+        Message(role="user", content="Q: to be or not to be?"),
+    ]
 
     logger = ChatLogger("tester")
-    with patch.object(logger, "item_adder") as adder:
+    with patch.object(logger, "item_adder") as adder, patch("stampy_chat.logging.known_blobs", KnownBlobs()):
         logger.interaction(
             "session id", "what is this?", response, history, prompt, blocks
         )
-        interaction = adder.add.call_args_list[0][0][0]
+        *blobs, interaction = adder.add.call_args_list[0][0]
         assert interaction.session_id == "session id"
         assert interaction.interaction_no == 3
         assert interaction.query == "what is this?"
@@ -197,5 +189,84 @@ def test_ChatLogger_interaction():
             interaction.response
             == "This is the response from the LLM to the user's query"
         )
-        assert interaction.prompt == prompt
+        assert interaction.prompt is None
+        assert blobs and all(isinstance(b, PromptBlob) for b in blobs)
+        assert reconstruct_prompt(interaction.prompt_segments, {b.hash: b.content for b in blobs}) == prompt
         assert interaction.chunks == ",".join(b.get("id") for b in blocks)
+
+
+def test_emit_batches_messages():
+    handler = DiscordHandler()
+    record = Mock(exc_info=None, exc_text=None, stack_info=None, levelno=WARN)
+    record.name = "bla"
+    record.getMessage.side_effect = ["first", "second", "first"]
+
+    with patch("stampy_chat.logging.DISCORD_LOGGING_URL", "http://example.org"):
+        with patch.object(handler, "_ensure_thread"):
+            with patch.object(handler, "to_discord") as sender:
+                for _ in range(3):
+                    handler.emit(record)
+                sender.assert_not_called()
+
+                handler.flush()
+                sender.assert_called_once_with("first\n(repeated 2 times)\nsecond")
+                assert handler.pending == []
+
+
+def test_emit_drops_when_too_many_pending():
+    handler = DiscordHandler(max_pending=2)
+    with patch("stampy_chat.logging.DISCORD_LOGGING_URL", "http://example.org"):
+        with patch.object(handler, "_ensure_thread"):
+            for i in range(5):
+                handler.add(f"message {i}")
+    assert handler.pending == ["message 0", "message 1"]
+    assert handler.batches(handler.pending, handler.dropped) == [
+        "message 0\nmessage 1",
+        "... and 3 more log lines were dropped",
+    ]
+
+
+def test_batches_split_and_limit():
+    with patch("stampy_chat.logging.MAX_MESSAGE_LEN", 10):
+        assert DiscordHandler.batches(["abc", "def", "0123456789abc"]) == ["abc\ndef", "0123456789", "abc"]
+        with patch("stampy_chat.logging.DISCORD_MAX_BATCHES", 2):
+            assert DiscordHandler.batches(["abcdefgh", "ijklmnop", "qrstuvwx"]) == [
+                "abcdefgh",
+                "... and 2 more log lines were dropped",
+            ]
+
+
+def test_queue_handler_does_not_block():
+    target = Mock(level=0)
+    handler = NonBlockingQueueHandler(Queue(maxsize=1), target)
+    logger = Logger("tester")
+    logger.addHandler(handler)
+
+    with patch.object(handler, "_ensure_listener"):
+        logger.warning("bla")
+        logger.warning("ble")
+
+    assert handler.stats() == {"queued": 1, "dropped": 1}
+    target.handle.assert_not_called()
+
+
+def test_queue_handler_passes_records_on():
+    target = Mock(level=0)
+    handler = NonBlockingQueueHandler(Queue(), target)
+    logger = Logger("tester")
+    logger.addHandler(handler)
+
+    logger.warning("bla %s", "ble")
+    handler.stop()
+
+    (record,), _ = target.handle.call_args
+    assert record.getMessage() == "bla ble"
+
+
+def test_ChatLogger_marks_records():
+    logger = ChatLogger("tester")
+    handler = Mock(level=0)
+    logger.addHandler(handler)
+    logger.warning("bla")
+    (record,), _ = handler.handle.call_args
+    assert record.chat_logger
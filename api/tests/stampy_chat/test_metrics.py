@@ -0,0 +1,114 @@
+import pytest
+
+from stampy_chat import metrics
+from stampy_chat.metrics import Counter, Gauge, Histogram, authorized
+
+
+@pytest.fixture(autouse=True)
+def registry():
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(metrics, "REGISTRY", {})
+        yield metrics.REGISTRY
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram("test_seconds", "A test", ("model",), buckets=(0.1, 1))
+    histogram.observe(0.05, model="a")
+    histogram.observe(0.5, model="a")
+    histogram.observe(5, model="a")
+
+    assert list(histogram.samples()) == [
+        'test_seconds_bucket{model="a",le="0.1"} 1',
+        'test_seconds_bucket{model="a",le="1"} 2',
+        'test_seconds_bucket{model="a",le="+Inf"} 3',
+        'test_seconds_sum{model="a"} 5.55',
+        'test_seconds_count{model="a"} 3',
+    ]
+
+
+def test_histogram_bucket_bounds_are_inclusive():
+    histogram = Histogram("test_seconds", "A test", buckets=(1, 2))
+    histogram.observe(1)
+
+    assert 'test_seconds_bucket{le="1"} 1' in histogram.samples()
+
+
+def test_histogram_time():
+    histogram = Histogram("test_seconds", "A test")
+
+    with histogram.time():
+        pass
+
+    @histogram.time()
+    def timed():
+        return 42
+
+    assert timed() == 42
+    assert "test_seconds_count 2" in histogram.samples()
+
+
+def test_histogram_time_counts_errors():
+    histogram = Histogram("test_seconds", "A test")
+
+    with pytest.raises(ValueError):
+        with histogram.time():
+            raise ValueError("oops")
+
+    assert "test_seconds_count 1" in histogram.samples()
+
+
+def test_labels_must_match():
+    counter = Counter("test_total", "A test", ("model", "provider"))
+
+    with pytest.raises(ValueError):
+        counter.inc(model="a")
+    with pytest.raises(ValueError):
+        counter.inc(model="a", server="b")
+
+
+def test_label_values_are_escaped():
+    counter = Counter("test_total", "A test", ("model",))
+    counter.inc(model='a "quoted"\\model\n')
+
+    assert list(counter.samples()) == ['test_total{model="a \\"quoted\\"\\\\model\\n"} 1']
+
+
+def test_gauge_track():
+    gauge = Gauge("test_in_flight", "A test", ("server",))
+
+    with gauge.track(server="wsgi"):
+        assert list(gauge.samples()) == ['test_in_flight{server="wsgi"} 1']
+    assert list(gauge.samples()) == ['test_in_flight{server="wsgi"} 0']
+
+
+def test_gauge_function_is_read_when_scraped():
+    values = [3]
+    gauge = Gauge("test_depth", "A test", function=lambda: values[0])
+    assert list(gauge.samples()) == ["test_depth 3"]
+
+    values[0] = 5
+    assert list(gauge.samples()) == ["test_depth 5"]
+
+
+def test_gauge_function_errors_are_skipped():
+    Gauge("test_depth", "A test", function=lambda: 1 / 0)
+    Counter("test_total", "A test").inc()
+
+    assert metrics.render() == (
+        "# HELP test_depth A test\n"
+        "# TYPE test_depth gauge\n"
+        "# HELP test_total A test\n"
+        "# TYPE test_total counter\n"
+        "test_total 1\n"
+    )
+
+
+@pytest.mark.parametrize("header, token, expected", (
+    (None, None, True),
+    ("Bearer whatever", None, True),
+    (None, "secret", False),
+    ("Bearer wrong", "secret", False),
+    ("Bearer secret", "secret", True),
+))
+def test_authorized(header, token, expected):
+    assert authorized(header, token) == expected
@@ -0,0 +1,105 @@
+import pytest
+from unittest.mock import patch
+from frozendict import frozendict
+
+from stampy_chat.prompt_registry import (
+    DEFAULT_PROMPTS_HASH,
+    PromptRegistry,
+    PromptsTooLarge,
+    UnknownPrompts,
+    hash_prompts,
+    registry,
+    resolve_prompts,
+)
+from stampy_chat.settings import DEFAULT_PROMPTS, Settings
+
+
+def test_hash_prompts_ignores_key_order():
+    assert hash_prompts({"a": "1", "b": {"c": "2"}}) == hash_prompts({"b": {"c": "2"}, "a": "1"})
+    assert hash_prompts({"a": "1"}) != hash_prompts({"a": "2"})
+
+
+def test_registry_returns_frozen_prompts():
+    reg = PromptRegistry()
+    prompts_hash = reg.register({"system": "bla", "modes": {"default": ""}})
+
+    prompts = reg.get(prompts_hash)
+    assert isinstance(prompts, frozendict)
+    assert isinstance(prompts["modes"], frozendict)
+    assert reg.get(prompts_hash) is prompts
+
+
+def test_registry_register_twice():
+    reg = PromptRegistry()
+    first = reg.register({"system": "bla"})
+    prompts = reg.get(first)
+
+    assert reg.register({"system": "bla"}) == first
+    assert reg.get(first) is prompts
+    assert len(reg) == 1
+
+
+def test_registry_evicts_least_recently_used():
+    reg = PromptRegistry(max_size=2)
+    first = reg.register({"system": "1"})
+    second = reg.register({"system": "2"})
+    reg.get(first)
+    third = reg.register({"system": "3"})
+
+    assert first in reg
+    assert second not in reg
+    assert third in reg
+
+
+def test_registry_evicts_by_bytes():
+    reg = PromptRegistry(max_bytes=120)
+    first = reg.register({"system": "a" * 40})
+    second = reg.register({"system": "b" * 40})
+    third = reg.register({"system": "c" * 40})
+
+    assert first not in reg
+    assert second in reg
+    assert third in reg
+    assert reg.bytes <= 120
+
+
+def test_registry_rejects_large_prompts():
+    reg = PromptRegistry(max_entry_bytes=50)
+    with pytest.raises(PromptsTooLarge):
+        reg.register({"system": "a" * 50})
+    assert len(reg) == 0 and reg.bytes == 0
+
+
+def test_registry_unknown_hash():
+    with pytest.raises(UnknownPrompts):
+        PromptRegistry().get("not a hash")
+
+
+def test_resolve_prompts_by_hash():
+    prompts_hash = registry.register({**DEFAULT_PROMPTS, "system": "a custom system prompt"})
+    settings = resolve_prompts({"promptsHash": prompts_hash, "mode": "concise"})
+
+    assert settings == {"prompts": registry.get(prompts_hash), "mode": "concise"}
+    assert Settings(**settings).prompts is registry.get(prompts_hash)
+
+
+def test_resolve_prompts_full_prompts_win():
+    prompts = {**DEFAULT_PROMPTS, "system": "bla"}
+    assert resolve_prompts({"promptsHash": "whatever", "prompts": prompts}) == {"prompts": prompts}
+
+
+def test_resolve_prompts_no_prompts():
+    assert resolve_prompts({"mode": "rookie"}) == {"mode": "rookie"}
+
+
+def test_resolve_prompts_unknown_hash():
+    with pytest.raises(UnknownPrompts):
+        resolve_prompts({"promptsHash": "not a hash"})
+
+
+def test_resolve_prompts_default_always_available():
+    reg = PromptRegistry(max_size=1)
+    reg.register({"system": "bla"})
+
+    with patch("stampy_chat.prompt_registry.registry", reg):
+        assert resolve_prompts({"promptsHash": DEFAULT_PROMPTS_HASH})["prompts"] == DEFAULT_PROMPTS
@@ -0,0 +1,83 @@
+from unittest.mock import Mock
+
+from stampy_chat.db.models import Interaction, PromptBlob
+from stampy_chat.prompt_store import (
+    BLOB_MIN_CHARS,
+    KnownBlobs,
+    load_prompt,
+    reconstruct_prompt,
+    segment_prompt,
+    split_content,
+)
+
+STATIC = "\n\n".join(f"Instruction {i}: " + "always cite your sources " * 10 for i in range(40))
+
+
+def test_split_content_round_trip():
+    text = STATIC + "\n\nQ: what is this?\n\n\n\nA: no idea"
+    chunks = split_content(text)
+    assert len(chunks) > 1
+    assert "\n\n".join(chunks) == text
+    assert split_content("") == [""]
+
+
+def test_split_content_same_text_same_chunks():
+    # The static part should be chunked the same way, whatever is after it
+    first = split_content(STATIC + "\n\nQ: what is this?")
+    second = split_content(STATIC + "\n\nQ: something completely different, and much longer " * 3)
+    assert first[:-1] == second[:-1]
+
+
+def test_segment_prompt_round_trip():
+    prompt = [
+        {"role": "system", "content": STATIC},
+        {"role": "user", "content": "Q: short question"},
+        {"role": "assistant", "content": ""},
+    ]
+    segments, blobs = segment_prompt(prompt)
+
+    assert segments[1] == {"role": "user", "content": ["Q: short question"]}
+    assert all(len(content) >= BLOB_MIN_CHARS for content in blobs.values())
+    assert any(isinstance(s, dict) for s in segments[0]["content"])
+    assert reconstruct_prompt(segments, blobs) == prompt
+
+
+def test_segment_prompt_shares_blobs():
+    _, first = segment_prompt([{"role": "system", "content": STATIC + "\n\nQ: one"}])
+    _, second = segment_prompt([{"role": "system", "content": STATIC + "\n\nQ: two"}])
+    assert set(first) & set(second)
+
+
+def test_known_blobs():
+    known = KnownBlobs(size=2)
+    assert known.new(["a", "b"]) == ["a", "b"]
+    # Nothing is known until it has been stored
+    assert known.new(["a", "b"]) == ["a", "b"]
+
+    known.add(["a", "b"])
+    assert known.new(["a", "c"]) == ["c"]
+    known.add(["c"])
+    # b was the least recently seen, so was forgotten
+    assert known.new(["b"]) == ["b"]
+
+
+def test_known_blobs_written():
+    known = KnownBlobs()
+    known.written([PromptBlob(hash="a", content="bla"), Interaction(session_id="s")])
+    assert known.new(["a", "b"]) == ["b"]
+
+
+def test_load_prompt():
+    prompt = [{"role": "system", "content": STATIC}, {"role": "user", "content": "Q: a"}]
+    segments, blobs = segment_prompt(prompt)
+    session = Mock()
+    session.execute.return_value.all.return_value = list(blobs.items())
+
+    assert load_prompt(session, Interaction(prompt_segments=segments)) == prompt
+
+
+def test_load_prompt_old_interactions():
+    session = Mock()
+    old = "[{'role': 'user', 'content': 'bla'}]"
+    assert load_prompt(session, Interaction(prompt=old)) == old
+    session.execute.assert_not_called()
@@ -0,0 +1,152 @@
+import pytest
+from unittest.mock import patch
+
+from stampy_chat.prompts import (
+    ALL_PROMPTS,
+    Slot,
+    compile_template,
+    format_message,
+    format_prompts,
+    inline_all_templates,
+    pack_blocks,
+    prompt_tokens,
+    trim_to_tokens,
+)
+from stampy_chat.settings import DEFAULT_PROMPTS
+from stampy_chat.tokens import token_counts
+
+VALS = dict(modelname="Claude", date="October 17, 2026", message_id=3, mode="be {modelname} concise")
+
+
+def old_format_prompts(template, vals):
+    return template.format(**vals, **ALL_PROMPTS).format(**vals)
+
+
+@pytest.fixture
+def prompts():
+    with patch.dict(ALL_PROMPTS, {"test-prompt": "Hi {modelname}, it's {{not a field}}", "plain": "nothing to see"}):
+        compile_template.cache_clear()
+        yield
+    compile_template.cache_clear()
+
+
+@pytest.mark.parametrize("name", ("system", "history", "history_summary", "pre_message", "post_message", "hyde_post_message"))
+def test_format_prompts_matches_double_format(name):
+    template = DEFAULT_PROMPTS[name]
+    assert format_prompts(template, VALS) == old_format_prompts(template, VALS)
+
+
+@pytest.mark.parametrize(
+    "template",
+    (
+        "",
+        "no fields at all",
+        "{plain}",
+        "{test-prompt} - {date}",
+        "{date:>20}|{modelname!r}|{{date}}|{{{{literal}}}}",
+        "{mode}",
+    ),
+)
+def test_format_prompts_matches_double_format_edge_cases(prompts, template):
+    assert format_prompts(template, VALS) == old_format_prompts(template, VALS)
+
+
+def test_compile_template_inlines_prompts(prompts):
+    assert compile_template("<{plain}> {date}") == ("<nothing to see> ", Slot("date", None, "", reformat=True))
+    assert compile_template("{test-prompt}") == (
+        "Hi ",
+        Slot("modelname", None, ""),
+        ", it's {not a field}",
+    )
+
+
+def test_compile_template_is_cached(prompts):
+    assert compile_template("{plain} {date}") is compile_template("{plain} {date}")
+
+
+def test_format_prompts_missing_value(prompts):
+    with pytest.raises(KeyError):
+        format_prompts("{not-a-prompt}", VALS)
+
+
+def test_format_message_single_pass(prompts):
+    template = "<msg id={message_id}>{message}</msg>"
+    assert format_message(template, message_id=1, message="{date} {{") == "<msg id=1>{date} {{</msg>"
+
+
+def test_inline_all_templates(prompts):
+    assert inline_all_templates({"a": "{test-prompt}", "modes": {"b": "{plain} {mode}"}, "c": None}) == {
+        "a": "Hi {modelname}, it's {not a field}",
+        "modes": {"b": "nothing to see {mode}"},
+        "c": None,
+    }
+
+
+@pytest.fixture
+def estimated_tokens():
+    """Count tokens as characters // 4, so the tests don't depend on the tokenizer."""
+    token_counts.clear()
+    with patch("stampy_chat.tokens.get_encoding", return_value=None):
+        yield
+    token_counts.clear()
+
+
+def block(i, text):
+    return {"id": str(i), "reference": i, "title": f"Block {i}", "authors": ["Author"], "date_published": "2021", "text": text}
+
+
+def test_trim_to_tokens(estimated_tokens):
+    text = "One sentence here. Another one follows! Is this the third? Yes."
+    assert trim_to_tokens(text, 100) == text
+    assert trim_to_tokens(text, 10) == "One sentence here. Another one follows!"
+    assert trim_to_tokens(text, 4) == "One sentence here."
+    assert trim_to_tokens(text, 3) == ""
+
+
+def test_pack_blocks_fills_budget_in_order(estimated_tokens):
+    blocks = [block(i, "word " * 200) for i in range(5)]
+    packed, stats = pack_blocks(blocks, max_tokens=1100)
+
+    assert [b["id"] for b in packed] == ["0", "1", "2"]
+    assert stats["blocks"] == 3
+    # The others don't fit, and have no sentence boundaries to trim them at
+    assert stats["dropped"] == 2
+    assert stats["context_tokens"] <= 1100
+
+
+def test_pack_blocks_max_blocks(estimated_tokens):
+    packed, stats = pack_blocks([block(i, "short.") for i in range(5)], max_tokens=10_000, max_blocks=2)
+    assert [b["id"] for b in packed] == ["0", "1"]
+
+
+def test_pack_blocks_trims_at_sentences(estimated_tokens):
+    long_text = " ".join(f"This is sentence number {i} of the long block." for i in range(200))
+    blocks = [block(0, "A short block."), block(1, long_text), block(2, "Another short one.")]
+    packed, stats = pack_blocks(blocks, max_tokens=1000)
+
+    # The trimmed block takes up the rest of the budget
+    assert [b["id"] for b in packed] == ["0", "1"]
+    assert stats["trimmed"] == 1
+    assert stats["dropped"] == 1
+    assert stats["context_tokens"] <= 1000
+    assert packed[1]["text"].endswith("of the long block.")
+    assert long_text.startswith(packed[1]["text"])
+    # The original block isn't modified
+    assert blocks[1]["text"] == long_text
+
+
+def test_pack_blocks_skips_hopeless_blocks(estimated_tokens):
+    blocks = [block(0, "Not. Worth. Trimming. " * 100)]
+    packed, stats = pack_blocks(blocks, max_tokens=120)
+    assert packed == []
+    assert stats == {"context_tokens": 0, "context_budget": 120, "blocks": 0, "trimmed": 0, "dropped": 1}
+
+
+def test_prompt_tokens(estimated_tokens):
+    prompt = [
+        {"role": "system", "content": "s" * 40},
+        {"role": "user", "content": "u" * 8},
+        {"role": "assistant", "content": "a" * 12},
+        {"role": "user", "content": "m" * 20},
+    ]
+    assert prompt_tokens(prompt) == {"system_tokens": 10, "history_tokens": 5, "message_tokens": 5, "prompt_tokens": 20}
@@ -0,0 +1,212 @@
+import asyncio
+import time
+from unittest.mock import Mock, patch
+
+import pytest
+
+from stampy_chat import routing
+from stampy_chat.routing import (
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+    CircuitOpen,
+    Latencies,
+    ProviderHealth,
+    ahedged,
+    fallback_models,
+    first_success,
+    hedged,
+    is_provider_error,
+    route,
+)
+
+
+class StatusError(Exception):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+@pytest.fixture(autouse=True)
+def fresh_health():
+    with patch.dict(routing._health, clear=True), patch.dict(routing.hedges, {"started": 0, "won": 0}):
+        yield
+
+
+@pytest.fixture
+def clock():
+    with patch("stampy_chat.routing.time.monotonic", return_value=1000.0) as monotonic:
+        yield monotonic
+
+
+@pytest.mark.parametrize(
+    "error, expected",
+    (
+        (StatusError(400), False),
+        (StatusError(404), False),
+        (StatusError(429), True),
+        (StatusError(500), True),
+        (StatusError(529), True),
+        (ConnectionError("down"), True),
+    ),
+)
+def test_is_provider_error(error, expected):
+    assert is_provider_error(error) == expected
+
+
+def test_latencies_percentile():
+    latencies = Latencies(samples=100)
+    assert latencies.percentile(90) is None
+    for i in range(1, 101):
+        latencies.add(i / 100)
+    assert latencies.percentile(50) == 0.51
+    assert latencies.percentile(90) == 0.91
+    assert latencies.percentile(100) == 1.0
+    assert latencies.percentile(90, min_samples=200) is None
+
+
+def test_breaker_opens_on_errors(clock):
+    health = ProviderHealth("test", window=60, min_calls=4, error_rate=0.5, cooldown=30)
+    health.success()
+    health.failure()
+    health.failure()
+    # Too few calls to tell
+    assert health.state == CLOSED
+    health.failure()
+    assert health.state == OPEN
+    assert not health.available()
+
+
+def test_breaker_forgets_old_errors(clock):
+    health = ProviderHealth("test", window=60, min_calls=2, error_rate=0.5, cooldown=30)
+    health.failure()
+    clock.return_value += 61
+    health.success()
+    health.success()
+    health.failure()
+    assert health.state == CLOSED
+    assert health.error_rate() == pytest.approx(1 / 3)
+
+
+def test_breaker_probes_after_cooldown(clock):
+    health = ProviderHealth("test", window=60, min_calls=1, error_rate=0.5, cooldown=30)
+    health.failure()
+    clock.return_value += 31
+    assert health.available()
+
+    health.start()
+    assert health.state == HALF_OPEN
+    # Only one probe at a time
+    assert not health.available()
+
+    # A failed probe opens the breaker again...
+    health.failure()
+    assert health.state == OPEN
+    clock.return_value += 31
+    health.start()
+    # ...and a successful one closes it
+    health.success()
+    assert health.state == CLOSED
+    assert health.error_rate() == 0
+    assert health.stats()["trips"] == 2
+
+
+def test_breaker_cancelled_probe(clock):
+    health = ProviderHealth("test", window=60, min_calls=1, error_rate=0.5, cooldown=30)
+    health.failure()
+    clock.return_value += 31
+    health.start()
+    health.release()
+    assert health.available()
+
+
+def test_fallback_models():
+    fallbacks = {"anthropic": ["google/gemini"], "anthropic/special": "openai/gpt", "google": ["google/gemini"]}
+    with patch("stampy_chat.routing.LLM_FALLBACK_MODELS", fallbacks):
+        assert fallback_models("anthropic/claude") == ["google/gemini"]
+        assert fallback_models("anthropic/special") == ["openai/gpt"]
+        assert fallback_models("google/gemini") == []
+        assert fallback_models("openai/gpt") == []
+
+
+def test_route_skips_open_breakers():
+    with patch("stampy_chat.routing.LLM_FALLBACK_MODELS", {"anthropic": ["google/gemini"]}):
+        assert route("anthropic/claude") == ["anthropic/claude", "google/gemini"]
+
+        routing.provider_health("anthropic").state = OPEN
+        routing.provider_health("anthropic").opened_at = time.monotonic()
+        assert route("anthropic/claude") == ["google/gemini"]
+
+        routing.provider_health("google").state = OPEN
+        routing.provider_health("google").opened_at = time.monotonic()
+        with pytest.raises(CircuitOpen):
+            route("anthropic/claude")
+
+
+def test_first_success():
+    def attempt(model):
+        if model == "bad":
+            raise StatusError(500)
+        if model == "invalid":
+            raise StatusError(400)
+        return model
+
+    assert first_success(["bad", "good", "other"], attempt) == "good"
+    with pytest.raises(StatusError) as e:
+        first_success(["bad", "bad"], attempt)
+    assert e.value.status_code == 500
+    # Bad requests aren't retried elsewhere
+    with pytest.raises(StatusError):
+        first_success(["invalid", "good"], attempt)
+
+
+def slow(result, seconds=0.0, error=None):
+    def call():
+        time.sleep(seconds)
+        if error:
+            raise error
+        return result
+    return call
+
+
+def test_hedged_fast_first_call():
+    assert hedged([slow("first"), slow("second")], delay=1) == "first"
+    assert routing.hedges == {"started": 0, "won": 0}
+
+
+def test_hedged_slow_first_call():
+    assert hedged([slow("first", 1), slow("second")], delay=0.05) == "second"
+    assert routing.hedges == {"started": 1, "won": 1}
+
+
+def test_hedged_failed_first_call():
+    start = time.monotonic()
+    assert hedged([slow(None, error=StatusError(500)), slow("second")], delay=10) == "second"
+    # The hedge was started as soon as the first call failed
+    assert time.monotonic() - start < 1
+
+
+def test_hedged_delay_starts_when_call_runs():
+    busy = routing.ThreadPoolExecutor(max_workers=1)
+    with patch("stampy_chat.routing.hedge_executor", busy):
+        busy.submit(time.sleep, 0.3)
+        # Waiting for a thread isn't the first model being slow
+        assert hedged([slow("first"), slow("second")], delay=0.05) == "first"
+    busy.shutdown()
+    assert routing.hedges == {"started": 0, "won": 0}
+
+
+def test_hedged_all_fail():
+    with pytest.raises(StatusError):
+        hedged([slow(None, error=StatusError(500)), slow(None, error=StatusError(503))], delay=0.01)
+
+
+def test_ahedged():
+    def aslow(result, seconds=0.0):
+        async def call():
+            await asyncio.sleep(seconds)
+            return result
+        return call
+
+    assert asyncio.run(ahedged([aslow("first"), aslow("second")], delay=1)) == "first"
+    assert asyncio.run(ahedged([aslow("first", 1), aslow("second")], delay=0.05)) == "second"
+    assert routing.hedges == {"started": 1, "won": 1}
@@ -0,0 +1,138 @@
+import threading
+from unittest.mock import Mock, patch
+
+import pytest
+from sqlalchemy import Integer, String, create_engine, select
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import DeclarativeBase, Mapped, Session, mapped_column
+
+from stampy_chat.db.session import ItemAdder, is_transient
+
+
+class Base(DeclarativeBase):
+    pass
+
+
+class Item(Base):
+    __tablename__ = "items"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    name: Mapped[str] = mapped_column(String(100))
+    count: Mapped[int] = mapped_column(Integer, default=3)
+
+
+class Blob(Base):
+    __tablename__ = "blobs"
+    __insert_ignore__ = True
+
+    hash: Mapped[str] = mapped_column(String(64), primary_key=True)
+    content: Mapped[str] = mapped_column(String(100))
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.sqlite3'}")
+    Base.metadata.create_all(engine)
+    return engine
+
+
+def names(engine):
+    with Session(engine) as session:
+        return [item.name for item in session.scalars(select(Item).order_by(Item.id))]
+
+
+def test_add_writes_in_background(engine):
+    adder = ItemAdder(engine, batch_size=10, save_every=60)
+    adder.add(Item(name="a"), Item(name="b"))
+    assert adder.flush(timeout=5)
+
+    assert names(engine) == ["a", "b"]
+    with Session(engine) as session:
+        assert session.scalars(select(Item.count)).all() == [3, 3]
+    assert adder.stats()["written"] == 2
+
+
+def test_add_does_not_block(engine):
+    adder = ItemAdder(engine)
+    release = threading.Event()
+    with patch.object(adder, "write", side_effect=lambda items: release.wait(5)):
+        adder.add(Item(name="a"))
+        # The write is blocked, but adding more is still instant
+        adder.add(Item(name="b"))
+        release.set()
+        assert adder.flush(timeout=5)
+
+
+def test_batches_by_size(engine):
+    adder = ItemAdder(engine, batch_size=2, save_every=60)
+    batches = []
+    with patch.object(adder, "write", side_effect=batches.append):
+        adder.add(*[Item(name=str(i)) for i in range(5)])
+        assert adder.flush(timeout=5)
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+
+
+def test_drops_when_full(engine):
+    adder = ItemAdder(engine, max_queue=2)
+    release = threading.Event()
+    with patch.object(adder, "write", side_effect=lambda items: release.wait(5)):
+        adder.add(Item(name="a"))
+        adder.flush(timeout=0.1)  # make sure the writer is busy with the first item
+        adder.add(*[Item(name=str(i)) for i in range(5)])
+        assert adder.stats()["dropped"] > 0
+        release.set()
+
+
+def test_retries_transient_errors(engine):
+    adder = ItemAdder(engine, max_retries=3)
+    error = OperationalError("INSERT", {}, Exception("lost connection"))
+    write = Mock(side_effect=[error, None])
+    with patch.object(adder, "write", write), patch("tenacity.nap.time.sleep"):
+        adder.add(Item(name="a"))
+        assert adder.flush(timeout=5)
+    assert write.call_count == 2
+    assert adder.stats()["retries"] == 1
+    assert adder.stats()["written"] == 1
+
+
+def test_gives_up_on_other_errors(engine):
+    adder = ItemAdder(engine, max_retries=3)
+    write = Mock(side_effect=IntegrityError("INSERT", {}, Exception("duplicate")))
+    with patch.object(adder, "write", write):
+        adder.add(Item(name="a"))
+        assert adder.flush(timeout=5)
+    assert write.call_count == 1
+    assert adder.stats()["failed"] == 1
+
+
+def test_on_written_only_after_commit(engine):
+    adder = ItemAdder(engine, max_retries=1)
+    written = []
+    adder.on_written.append(written.extend)
+    item = Item(name="a")
+    with patch.object(adder, "write", Mock(side_effect=IntegrityError("INSERT", {}, Exception("duplicate")))):
+        adder.add(item)
+        assert adder.flush(timeout=5)
+    assert written == []
+
+    adder.add(item)
+    assert adder.flush(timeout=5)
+    assert written == [item]
+
+
+def test_insert_ignore(engine):
+    adder = ItemAdder(engine, batch_size=10, save_every=60)
+    adder.add(Blob(hash="a", content="bla"), Item(name="a"), Blob(hash="a", content="bla"))
+    adder.add(Blob(hash="a", content="bla"), Blob(hash="b", content="ble"))
+    assert adder.flush(timeout=5)
+
+    assert adder.stats()["failed"] == 0
+    assert names(engine) == ["a"]
+    with Session(engine) as session:
+        assert session.scalars(select(Blob.hash).order_by(Blob.hash)).all() == ["a", "b"]
+
+
+def test_is_transient():
+    assert is_transient(OperationalError("bla", {}, Exception()))
+    assert is_transient(IntegrityError("bla", {}, Mock(errno=1213)))
+    assert not is_transient(IntegrityError("bla", {}, Mock(errno=1062)))
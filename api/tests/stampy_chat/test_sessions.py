@@ -0,0 +1,141 @@
+import uuid
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+import pytest
+from sqlalchemy.exc import OperationalError
+
+from stampy_chat.cache import TTLCache
+from stampy_chat.citations import Message
+from stampy_chat.prompts import truncate_history
+from stampy_chat.sessions import Conversation, HistoryUnavailable, SessionStore
+from stampy_chat.tokens import count_tokens
+
+SESSION_ID = str(uuid.uuid4())
+
+
+def store(load_from_db=False):
+    return SessionStore(TTLCache("test-sessions", max_bytes=1024 * 1024, ttl=60, register=False), load_from_db=load_from_db)
+
+
+def test_conversation_counts_tokens():
+    conversation = Conversation.of([
+        Message(role="user", content="a" * 40),
+        Message(role="deleted", content="bla"),
+        Message(role="assistant", content="b" * 8),
+        Message(role="error", content="oops"),
+    ])
+    assert [m["role"] for m in conversation.messages] == ["user", "assistant"]
+    assert conversation.counts == (count_tokens("a" * 40), count_tokens("b" * 8))
+
+    conversation = conversation.add(Message(role="user", content="c" * 12))
+    assert conversation.counts[2] == count_tokens("c" * 12)
+
+
+def test_store_remembers_turns():
+    sessions = store()
+    assert sessions.get(SESSION_ID) == Conversation()
+
+    conversation = sessions.set(SESSION_ID, [Message(role="user", content="q1"), Message(role="assistant", content="a1")])
+    sessions.add_turn(SESSION_ID, conversation, "q2", "a2")
+
+    assert [m["content"] for m in sessions.get(SESSION_ID).messages] == ["q1", "a1", "q2", "a2"]
+    assert sessions.get("other session") == Conversation()
+
+
+def test_store_without_session_id():
+    sessions = store()
+    conversation = sessions.add_turn(None, Conversation(), "q", "a")
+    assert len(conversation.messages) == 2
+    assert len(sessions.cache) == 0
+
+
+def test_store_loads_from_db():
+    rows = [
+        SimpleNamespace(interaction_no=0, query="q1\n\n(hyde: some document\n\nwith paragraphs)", response="a1"),
+        SimpleNamespace(interaction_no=1, query="q2", response="first try"),
+        SimpleNamespace(interaction_no=1, query="q2", response="a2"),
+    ]
+    session = MagicMock()
+    session.execute.return_value.all.return_value = rows
+    sessions = store(load_from_db=True)
+
+    with patch("stampy_chat.sessions.make_session") as make_session:
+        make_session.return_value.__enter__.return_value = session
+        assert [m["content"] for m in sessions.get(SESSION_ID).messages] == ["q1", "a1", "q2", "a2"]
+        # The second time it comes from memory
+        sessions.get(SESSION_ID)
+    make_session.assert_called_once()
+
+
+def test_store_load_errors():
+    sessions = store(load_from_db=True)
+    with patch("stampy_chat.sessions.make_session", side_effect=OperationalError("select", {}, Exception("gone"))):
+        with pytest.raises(HistoryUnavailable):
+            sessions.load(SESSION_ID)
+        assert sessions.get(SESSION_ID) == Conversation()
+    with patch("stampy_chat.sessions.make_session") as make_session:
+        assert sessions.get("not a uuid") == Conversation()
+    make_session.assert_not_called()
+
+
+def test_session_tokens():
+    sessions = store()
+    token = sessions.token(SESSION_ID)
+    assert sessions.check_token(SESSION_ID, token)
+    assert not sessions.check_token(SESSION_ID, None)
+    assert not sessions.check_token(SESSION_ID, "bla")
+    assert not sessions.check_token(str(uuid.uuid4()), token)
+    assert sessions.token("not a uuid") is None
+    assert SessionStore(sessions.cache, secret="other").token(SESSION_ID) != token
+
+
+def test_missing_secret_warns():
+    cache = TTLCache("test-sessions", max_bytes=1024 * 1024, ttl=60, register=False)
+    with patch("stampy_chat.sessions.logger") as logger:
+        first, second = SessionStore(cache, secret=""), SessionStore(cache, secret="")
+    assert logger.warning.call_count == 2
+    # Each process makes up its own secret, so tokens don't carry over
+    assert first.token(SESSION_ID) != second.token(SESSION_ID)
+
+
+def test_start_only_new_sessions():
+    sessions = store()
+    assert sessions.start(SESSION_ID) == sessions.token(SESSION_ID)
+    sessions.set(SESSION_ID, [Message(role="user", content="q1"), Message(role="assistant", content="a1")])
+    assert sessions.start(SESSION_ID) is None
+    assert sessions.start("not a uuid") is None
+
+
+def test_truncate_history_uses_counts():
+    history = [
+        Message(role="user", content="q1"),
+        Message(role="assistant", content="a1"),
+        Message(role="user", content="q2"),
+        Message(role="assistant", content="a2"),
+    ]
+    assert truncate_history(history, 10, counts=[5, 5, 5, 5]) == history[2:]
+    assert truncate_history(history, 10, counts=[1, 1, 1, 20]) == []
+    assert truncate_history(history, 100) == history
+
+
+def test_start_checks_db_without_loading():
+    session = MagicMock()
+    session.execute.return_value.first.return_value = None
+    sessions = store(load_from_db=True)
+
+    with patch("stampy_chat.sessions.make_session") as make_session, patch.object(sessions, "load") as load:
+        make_session.return_value.__enter__.return_value = session
+        assert sessions.start(SESSION_ID) == sessions.token(SESSION_ID)
+
+        # A session with logged interactions isn't up for grabs
+        session.execute.return_value.first.return_value = SimpleNamespace(id=1)
+        assert sessions.start(SESSION_ID) is None
+    load.assert_not_called()
+    assert "LIMIT" in str(session.execute.call_args[0][0])
+
+
+def test_start_refuses_when_db_is_down():
+    sessions = store(load_from_db=True)
+    with patch("stampy_chat.sessions.make_session", side_effect=OperationalError("select", {}, Exception("gone"))):
+        assert sessions.start(SESSION_ID) is None
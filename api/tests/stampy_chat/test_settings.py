@@ -0,0 +1,90 @@
+from unittest.mock import patch
+
+import pytest
+from frozendict import deepfreeze
+
+from stampy_chat.settings import DEFAULT_PROMPTS, Settings, intern_settings, make_settings
+
+
+def test_settings_equal_hash():
+    first = Settings(prompts=dict(DEFAULT_PROMPTS), mode="concise")
+    second = Settings(prompts=dict(DEFAULT_PROMPTS), mode="concise")
+
+    assert first is not second
+    assert first == second
+    assert hash(first) == hash(second)
+
+
+def test_settings_not_equal():
+    assert Settings(mode="concise") != Settings(mode="rookie")
+    assert Settings(filters={"miri_confidence": 3}) != Settings(filters={"miri_confidence": 4})
+    assert Settings() != "Settings"
+
+
+def test_settings_usable_as_key():
+    cache = {Settings(mode="concise"): "bla"}
+    assert cache[Settings(mode="concise")] == "bla"
+
+
+def test_make_settings_interns():
+    first = make_settings(mode="rookie", thinking_budget=123)
+    assert make_settings(mode="rookie", thinking_budget=123) is first
+    assert make_settings(mode="rookie", thinking_budget=124) is not first
+
+
+def test_make_settings_reuses_without_building():
+    prompts = deepfreeze({**DEFAULT_PROMPTS, "system": "a registered system prompt"})
+    first = make_settings(prompts=prompts, mode="concise", filters={"miri_distance": ["core"]})
+
+    with patch("stampy_chat.settings.Settings", side_effect=AssertionError("Settings were built again")):
+        assert make_settings(prompts=prompts, filters={"miri_distance": ["core"]}, mode="concise") is first
+
+
+def test_make_settings_plain_prompts():
+    prompts = {**DEFAULT_PROMPTS, "system": "an uploaded system prompt"}
+    first = make_settings(prompts=prompts)
+    # Plain prompts still have to be frozen, but the result is still interned
+    assert make_settings(prompts=dict(prompts)) is first
+
+
+def test_intern_settings_collision():
+    settings = make_settings(mode="rookie")
+    other = Settings(mode="concise")
+    object.__setattr__(other, "_hash", settings._hash)
+
+    assert intern_settings(other) is other
+
+
+def test_settings_derived_values():
+    settings = Settings(maxNumTokens=10_000, contextFraction=0.5, historyFraction=0.25)
+    assert settings.context_tokens == 5000 - len(settings.system_prompt) // 4
+    assert settings.history_tokens == 2500 - len(settings.history_prompt) // 4
+    assert settings.max_response_tokens <= settings.maxCompletionTokens
+
+
+def test_settings_miri_filters():
+    settings = Settings(filters={"needs_tech": True, "miri_confidence": 5, "miri_distance": ["core"]})
+    assert settings.miri_filters == {
+        "needs_tech": True,
+        "miri_confidence": {"$gte": 5},
+        "miri_distance": {"$in": ["core"]},
+    }
+    assert Settings().miri_filters == {"needs_tech": {"$ne": True}, "miri_confidence": {"$gte": 6}}
+
+    # Settings are shared, so changing the filters mustn't change them for everyone else
+    settings.miri_filters["miri_distance"]["$in"].append("bla")
+    assert settings.miri_filters["miri_distance"] == {"$in": ["core"]}
+
+
+def test_docs_settings():
+    settings = make_settings(mode="concise", thinking_budget=4000)
+
+    assert settings.docs_settings.thinking_budget == 0
+    assert settings.docs_settings.mode == "concise"
+    assert settings.docs_settings is settings.docs_settings
+    assert settings.docs_settings is make_settings(mode="concise", thinking_budget=0)
+
+
+def test_settings_invalid_model():
+    with pytest.raises(ValueError):
+        Settings(model="bla/bla")
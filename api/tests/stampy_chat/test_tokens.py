@@ -0,0 +1,37 @@
+from unittest.mock import Mock, patch
+
+import pytest
+
+from stampy_chat.tokens import count_tokens, token_counts
+
+
+@pytest.fixture(autouse=True)
+def clear_counts():
+    token_counts.clear()
+    yield
+    token_counts.clear()
+
+
+def test_count_tokens_uses_encoding():
+    encoding = Mock()
+    encoding.encode_ordinary.return_value = [1, 2, 3]
+    with patch("stampy_chat.tokens.get_encoding", return_value=encoding):
+        assert count_tokens("some text") == 3
+    encoding.encode_ordinary.assert_called_once_with("some text")
+
+
+def test_count_tokens_is_cached():
+    encoding = Mock()
+    encoding.encode_ordinary.return_value = [1, 2]
+    with patch("stampy_chat.tokens.get_encoding", return_value=encoding):
+        assert count_tokens("some text") == 2
+        assert count_tokens("some text") == 2
+        assert count_tokens("other text", cache=False) == 2
+        assert count_tokens("other text", cache=False) == 2
+    assert encoding.encode_ordinary.call_count == 3
+
+
+def test_count_tokens_falls_back_to_estimate():
+    with patch("stampy_chat.tokens.get_encoding", return_value=None):
+        assert count_tokens("a" * 40) == 10
+    assert count_tokens("") == 0
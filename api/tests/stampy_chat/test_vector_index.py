@@ -0,0 +1,126 @@
+from unittest.mock import Mock, patch
+
+import numpy as np
+import pytest
+
+from stampy_chat.citations import search_vector
+from stampy_chat.settings import Settings
+from stampy_chat.vector_index import LocalIndex, Match, compile_filter, read_snapshot, write_snapshot
+
+
+def record(id, values, **metadata):
+    return {"id": id, "values": values, "metadata": metadata}
+
+
+RECORDS = [
+    record("a", [1.0, 0.0, 0.0], miri_confidence=9, authors=["Eliezer Yudkowsky"], needs_tech=False),
+    record("b", [0.9, 0.1, 0.0], miri_confidence=5, authors=["Paul Christiano"], needs_tech=True),
+    record("c", [0.0, 1.0, 0.0], miri_confidence=7, authors=["Paul Christiano", "Eliezer Yudkowsky"]),
+    record("d", [0.0, 0.0, 1.0], miri_confidence=2, miri_distance="core"),
+]
+
+
+@pytest.fixture
+def index(tmp_path):
+    return LocalIndex.build(RECORDS, str(tmp_path / "index"))
+
+
+@pytest.mark.parametrize(
+    "filter, expected",
+    (
+        (None, "abcd"),
+        ({}, "abcd"),
+        ({"miri_confidence": 7}, "c"),
+        ({"miri_confidence": {"$eq": 7}}, "c"),
+        ({"miri_confidence": {"$gte": 7}}, "ac"),
+        ({"miri_confidence": {"$gt": 7}}, "a"),
+        ({"miri_confidence": {"$lt": 5}}, "d"),
+        ({"miri_confidence": {"$lte": 5}}, "bd"),
+        ({"miri_confidence": {"$gte": 3, "$lte": 8}}, "bc"),
+        ({"needs_tech": {"$ne": True}}, "acd"),
+        ({"authors": "Paul Christiano"}, "bc"),
+        ({"authors": {"$in": ["Eliezer Yudkowsky"]}}, "ac"),
+        ({"authors": {"$nin": ["Eliezer Yudkowsky"]}}, "bd"),
+        ({"miri_distance": {"$in": ["core", "wider"]}}, "d"),
+        ({"$and": [{"miri_confidence": {"$gte": 5}}, {"authors": "Paul Christiano"}]}, "bc"),
+        ({"$or": [{"miri_confidence": {"$gte": 9}}, {"miri_distance": "core"}]}, "ad"),
+        ({"miri_confidence": {"$gte": "2020-01-01"}}, ""),
+    ),
+)
+def test_compile_filter(filter, expected):
+    predicate = compile_filter(filter)
+    assert "".join(r["id"] for r in RECORDS if predicate(r["metadata"])) == expected
+
+
+@pytest.mark.parametrize("filter", ({"$not": {}}, {"field": {"$regex": "bla"}}))
+def test_compile_filter_unsupported(filter):
+    with pytest.raises(ValueError):
+        compile_filter(filter)
+
+
+def test_local_index_query(index):
+    matches = index.query([1.0, 0.05, 0.0], top_k=2)
+
+    assert [m.id for m in matches] == ["a", "b"]
+    assert matches[0].score == pytest.approx(0.99875, abs=1e-4)
+    assert matches[0].metadata["miri_confidence"] == 9
+
+
+def test_local_index_query_filter(index):
+    filter = {"needs_tech": {"$ne": True}, "miri_confidence": {"$gte": 5}}
+    assert [m.id for m in index.query([1.0, 0.05, 0.0], top_k=10, filter=filter)] == ["a", "c"]
+    assert index.query([1.0, 0.0, 0.0], top_k=10, filter={"miri_confidence": 100}) == []
+
+
+def test_local_index_caches_masks(index):
+    filter = {"miri_confidence": {"$gte": 5}}
+    with patch("stampy_chat.vector_index.compile_filter", wraps=compile_filter) as compiled:
+        index.query([1.0, 0.0, 0.0], top_k=2, filter=filter)
+        index.query([0.0, 1.0, 0.0], top_k=2, filter=dict(filter))
+    compiled.assert_called_once()
+
+
+def test_local_index_is_memory_mapped(index):
+    assert isinstance(LocalIndex(index.path).vectors, np.memmap)
+
+
+def test_local_index_exact_query_scores_matrix_directly(index):
+    # Unfiltered exact queries score the mapped matrix as is, rather than a copy of all its rows
+    assert index.candidates(np.array([1.0, 0.0, 0.0], dtype=np.float32), 2, None) is None
+
+    matches = index.query([1.0, 0.05, 0.0], top_k=10)
+    assert len(matches) == len(index)
+    assert [m.score for m in matches] == sorted((m.score for m in matches), reverse=True)
+
+
+def test_local_index_ivf(tmp_path):
+    rng = np.random.default_rng(1)
+    vectors = rng.normal(size=(500, 16)).astype(np.float32)
+    records = [record(str(i), v.tolist(), even=i % 2 == 0) for i, v in enumerate(vectors)]
+
+    exact = LocalIndex.build(records, str(tmp_path / "exact"))
+    ivf = LocalIndex.build(records, str(tmp_path / "ivf"), lists=8)
+    ivf.nprobe = 8  # probing all the lists should find everything the exact search does
+
+    assert ivf.ivf is not None
+    for query in vectors[:10]:
+        assert [m.id for m in ivf.query(query, top_k=5)] == [m.id for m in exact.query(query, top_k=5)]
+        assert all(m.metadata["even"] for m in ivf.query(query, top_k=5, filter={"even": True}))
+
+
+def test_snapshot_round_trip(tmp_path, index):
+    path = str(tmp_path / "snapshot.jsonl")
+    assert write_snapshot(index.records(), path) == 4
+
+    rebuilt = LocalIndex.build(read_snapshot(path), str(tmp_path / "rebuilt"))
+    assert rebuilt.ids == index.ids
+    assert rebuilt.metadata == index.metadata
+    assert np.allclose(rebuilt.vectors, index.vectors)
+
+
+def test_search_vector_uses_configured_index():
+    index = Mock()
+    index.query.return_value = [Match("a", 0.9, {})]
+    with patch("stampy_chat.citations.vector_index", return_value=index):
+        assert search_vector([1.0], Settings().miri_filters) == [Match("a", 0.9, {})]
+    index.query.assert_called_once_with([1.0], 50, Settings().miri_filters)
@@ -0,0 +1,107 @@
+import threading
+
+import pytest
+
+from stampy_chat.callbacks import stream_callback
+from stampy_chat.workers import ChatPool, InFlightLimit, Saturated
+
+
+def test_pool_runs_functions():
+    pool = ChatPool(max_workers=2, max_in_flight=4)
+    assert pool.submit(lambda x: x * 2, 21).result(timeout=5) == 42
+    assert pool.stats()["running"] == 0
+    assert pool.stats()["queued"] == 0
+
+
+def test_pool_rejects_when_saturated():
+    pool = ChatPool(max_workers=1, max_in_flight=2)
+    release = threading.Event()
+    started = threading.Event()
+
+    def block():
+        started.set()
+        release.wait(timeout=5)
+
+    futures = [pool.submit(block), pool.submit(block)]
+    assert started.wait(timeout=5)
+    assert pool.stats() == {"running": 1, "queued": 1, "max_workers": 1, "max_in_flight": 2, "rejected": 0}
+
+    with pytest.raises(Saturated) as e:
+        pool.submit(block)
+    assert e.value.retry_after > 0
+    assert pool.stats()["rejected"] == 1
+
+    release.set()
+    for future in futures:
+        future.result(timeout=5)
+    assert pool.submit(lambda: "ok").result(timeout=5) == "ok"
+
+
+def test_in_flight_limit():
+    limit = InFlightLimit(max_in_flight=2)
+    release = limit.acquire()
+    with limit.slot():
+        with pytest.raises(Saturated):
+            limit.acquire()
+    assert limit.stats() == {"in_flight": 1, "max_in_flight": 2, "rejected": 1}
+
+    release()
+    release()
+    assert limit.stats()["in_flight"] == 0
+
+
+def test_stream_callback_saturated():
+    pool = ChatPool(max_workers=1, max_in_flight=1)
+    release = threading.Event()
+    pool.submit(release.wait, 5)
+
+    with pytest.raises(Saturated):
+        stream_callback(lambda callback: callback("value"), pool=pool)
+    release.set()
+
+
+def test_stream_callback_applies_backpressure():
+    produced = []
+    cancel = threading.Event()
+
+    def producer(callback):
+        for i in range(100):
+            callback(i)
+            produced.append(i)
+
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr("stampy_chat.callbacks.STREAM_QUEUE_SIZE", 5)
+        stream = stream_callback(producer, cancel=cancel, pool=ChatPool(max_workers=1, max_in_flight=1))
+        assert next(stream) == "0"
+        # The producer can't get more than the queue size ahead of the consumer
+        assert not cancel.wait(timeout=0.2)
+        assert len(produced) <= 7
+        stream.close()
+
+    assert cancel.is_set()
+
+
+def test_stream_callback_ends_after_send_timeout():
+    done = threading.Event()
+
+    def producer(callback):
+        for i in range(100):
+            callback(i)
+        done.set()
+
+    rest = []
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr("stampy_chat.callbacks.STREAM_QUEUE_SIZE", 5)
+        mp.setattr("stampy_chat.callbacks.STREAM_SEND_TIMEOUT", 0.05)
+        stream = stream_callback(producer, pool=ChatPool(max_workers=1, max_in_flight=1))
+        assert next(stream) == "0"
+        # The client stops reading, so the producer gives up and drops everything after that
+        assert done.wait(timeout=5)
+
+        consumer = threading.Thread(target=lambda: rest.extend(stream))
+        consumer.start()
+        consumer.join(timeout=5)
+
+    # Whatever was queued still gets sent, and then the stream ends
+    assert not consumer.is_alive()
+    assert 0 < len(rest) <= 5